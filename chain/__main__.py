@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
+import sys
 
-from chain.p2p import P2PServer as Server
+from chain import BlockChain
+from chain.p2p import LightServer, P2PServer as Server
+from chain.snapshot import Snapshot
 from chain.utils.log import logger
 
 parser = argparse.ArgumentParser()
@@ -20,11 +23,77 @@ parser.add_argument(
 
 parser.add_argument("-m", "--mine", action="store_true", help="Mining blocks")
 
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Mining processes, defaults to the number of CPUs",
+)
+
+parser.add_argument(
+    "-d", "--datadir", help="Directory to store blocks, in memory if not given"
+)
+
+parser.add_argument(
+    "-a",
+    "--address",
+    help="Public key to pay mining rewards to, "
+    "otherwise a key kept in --datadir is used, or a throwaway one without it",
+)
+
+parser.add_argument(
+    "-l", "--light", action="store_true", help="Keep block headers only"
+)
+
+parser.add_argument(
+    "-s", "--snapshot", help="Start from a snapshot file instead of genesis"
+)
+
+parser.add_argument(
+    "--snapshot-hash", help="Hash the snapshot must have, from a trusted source"
+)
+
+parser.add_argument(
+    "-e",
+    "--export",
+    metavar="FILE",
+    help="Write a snapshot of the chain in --datadir to FILE and exit",
+)
+
 parser.add_argument("-D", "--debug", action="store_true", help="Debug mode")
 
 args = parser.parse_args()
 
-server = Server(mining=args.mine)
+if args.mine and not (args.address or args.datadir):
+    parser.error("--mine needs --address or --datadir")
+
+if args.export:
+    if not args.datadir:
+        parser.error("--export needs --datadir")
+    blockchain = BlockChain.load(args.datadir)
+    print(Snapshot.from_blockchain(blockchain).save(args.export))
+    blockchain.close()
+    sys.exit()
+
+snapshot = None
+if args.snapshot:
+    if args.datadir or args.light:
+        parser.error("--snapshot cannot be used with --datadir or --light")
+    snapshot = Snapshot.load(args.snapshot, args.snapshot_hash)
+    if args.snapshot_hash is None:
+        logger.warning(f"Snapshot {snapshot.hash} is trusted until backfilled")
+
+if args.light:
+    server = LightServer()
+else:
+    server = Server(
+        mining=args.mine,
+        workers=args.workers,
+        datadir=args.datadir,
+        address=args.address,
+        snapshot=snapshot,
+    )
 server.listen(args.port)
 
 loop = asyncio.get_event_loop()
@@ -44,7 +113,7 @@ try:
     else:
         loop.run_forever()
 except KeyboardInterrupt:
-    logger.debug(server.blockchain[-5:])
+    logger.debug(server.headers[-5:] if args.light else server.blockchain[-5:])
     server.stop()
 finally:
     loop.close()
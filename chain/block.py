@@ -1,19 +1,174 @@
 from chain import Hash
-from dataclasses import dataclass
+from chain.merkle import Proof, merkle_proof, merkle_root, verify_proof
+from chain.transaction import Transaction, decode_transactions
+from chain.utils.hexstr import HexStr, compact, expand, is_hex
+from typing import Callable, List, Optional, Tuple
 
 
-@dataclass(frozen=True)
-class Block:
+def _is_root(s: str) -> bool:
+    # shaped like a merkle root, so legacy data like this would be ambiguous
+    return len(s) == 64 and is_hex(s)
+
+
+def _meets_target(h: HexStr, target: HexStr) -> bool:
+    # equal length big-endian bytes compare like the integers they encode
+    if isinstance(h, bytes) and isinstance(target, bytes):
+        if len(h) == len(target) == 32:
+            return h <= target
+    return Block.validate_difficulty(expand(h), expand(target))
+
+
+class _Linked:
+    """
+    Immutable fields shared by `Block` and `BlockHeader`, those linking blocks
+    and proving their work. Hex fields are kept as raw bytes.
+    """
+
+    __slots__ = ("index", "_prev_hash", "timestamp", "nonce", "_target", "_hash")
+
     index: int
-    prev_hash: str
     timestamp: int
-    data: str
     nonce: int
-    target: str
-    hash: str
+    _prev_hash: HexStr
+    _target: HexStr
+    _hash: HexStr
+
+    def __init__(
+        self,
+        index: int,
+        prev_hash: str,
+        timestamp: int,
+        nonce: int,
+        target: str,
+        hash: str,
+    ) -> None:
+        setattr_ = object.__setattr__
+        setattr_(self, "index", index)
+        setattr_(self, "_prev_hash", compact(prev_hash))
+        setattr_(self, "timestamp", timestamp)
+        setattr_(self, "nonce", nonce)
+        setattr_(self, "_target", compact(target))
+        setattr_(self, "_hash", compact(hash))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"cannot delete field '{name}'")
 
     def __hash__(self) -> int:
-        return int(self.hash, 16)
+        h = self._hash
+        return int(h, 16) if isinstance(h, str) else int.from_bytes(h, "big")
+
+    @property
+    def prev_hash(self) -> str:
+        return expand(self._prev_hash)
+
+    @property
+    def target(self) -> str:
+        return expand(self._target)
+
+    @property
+    def hash(self) -> str:
+        return expand(self._hash)
+
+
+class Block(_Linked):
+    """
+    Immutable block. Hex fields are kept as raw bytes and exposed as hex strings.
+
+    A block with a `merkle_root` commits to its data through the root, which is
+    hashed in place of the data, so the header alone proves the work done.
+    Legacy blocks without one are only valid as genesis, so a block cannot be
+    passed off as a legacy one with the root as its data.
+    """
+
+    __slots__ = ("data", "_merkle_root", "_transactions")
+
+    data: str
+    _merkle_root: HexStr
+    _transactions: Optional[List[Transaction]]
+
+    def __init__(
+        self,
+        index: int,
+        prev_hash: str,
+        timestamp: int,
+        data: str,
+        nonce: int,
+        target: str,
+        hash: str,
+        merkle_root: str = "",
+    ) -> None:
+        super().__init__(index, prev_hash, timestamp, nonce, target, hash)
+        setattr_ = object.__setattr__
+        setattr_(self, "data", data)
+        setattr_(self, "_merkle_root", compact(merkle_root))
+        setattr_(self, "_transactions", None)
+
+    def __reduce__(self):
+        return Block, self.fields
+
+    def __repr__(self) -> str:
+        merkle_root = f", merkle_root={self.merkle_root!r}" if self.merkle_root else ""
+        return (
+            f"Block(index={self.index!r}, prev_hash={self.prev_hash!r}, "
+            f"timestamp={self.timestamp!r}, data={self.data!r}, nonce={self.nonce!r}, "
+            f"target={self.target!r}, hash={self.hash!r}{merkle_root})"
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Block):
+            return NotImplemented
+        return self._hash == other._hash and self._raw_fields == other._raw_fields
+
+    __hash__ = _Linked.__hash__
+
+    @property
+    def merkle_root(self) -> str:
+        return expand(self._merkle_root)
+
+    @property
+    def commitment(self) -> str:
+        # what the block hash covers in place of the data
+        return self.merkle_root or self.data
+
+    @property
+    def header(self) -> "BlockHeader":
+        return BlockHeader(
+            self.index,
+            self.prev_hash,
+            self.timestamp,
+            self.commitment,
+            self.nonce,
+            self.target,
+            self.hash,
+        )
+
+    @property
+    def _raw_fields(self) -> tuple:
+        return (
+            self.index,
+            self._prev_hash,
+            self.timestamp,
+            self.data,
+            self.nonce,
+            self._target,
+            self._merkle_root,
+        )
+
+    @property
+    def fields(self) -> tuple:
+        return (
+            self.index,
+            self.prev_hash,
+            self.timestamp,
+            self.data,
+            self.nonce,
+            self.target,
+            self.hash,
+            self.merkle_root,
+        )
 
     @staticmethod
     def calculate_hash(
@@ -26,12 +181,49 @@ class Block:
     def validate_difficulty(hash: str, target: str) -> bool:
         return int(hash, 16) <= int(target, 16)
 
+    @staticmethod
+    def target_bytes(target: str) -> bytes:
+        # big-endian digests compare bytewise in the same order as integers
+        return min(int(target, 16), 2**256 - 1).to_bytes(32, "big")
+
+    @staticmethod
+    def search_nonce(
+        index: int,
+        prev_hash: str,
+        timestamp: int,
+        data: str,
+        target: str,
+        start: int = 0,
+        step: int = 1,
+        stopped: Optional[Callable[[], bool]] = None,
+        check_every: int = 4096,
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Search nonces `start, start + step, ...` until a hash meets `target`.
+        Returns None if `stopped()` becomes true, polled every `check_every` nonces.
+        """
+        # the header up to the nonce is constant, hash it once and copy the state
+        midstate = Hash(f"{index}{prev_hash}{timestamp}{data}".encode())
+        suffix = target.encode()
+        bound = Block.target_bytes(target)
+        copy = midstate.copy
+        nonce = start
+        while True:
+            for _ in range(check_every):
+                h = copy()
+                h.update(b"%d%s" % (nonce, suffix))
+                if h.digest() <= bound:
+                    return nonce, h.hexdigest()
+                nonce += step
+            if stopped is not None and stopped():
+                return None
+
     @classmethod
     def deserialize(cls, other: dict):
         return cls(**other)
 
     def serialize(self) -> dict:
-        return dict(
+        serialized = dict(
             index=self.index,
             prev_hash=self.prev_hash,
             timestamp=self.timestamp,
@@ -40,22 +232,187 @@ class Block:
             target=self.target,
             hash=self.hash,
         )
+        if self.merkle_root:
+            serialized["merkle_root"] = self.merkle_root
+        return serialized
+
+    @property
+    def transactions(self) -> List[Transaction]:
+        if self._transactions is None:
+            object.__setattr__(self, "_transactions", decode_transactions(self.data))
+        return self._transactions  # type: ignore
+
+    @staticmethod
+    def merkle_leaves(
+        data: str, transactions: Optional[List[Transaction]] = None
+    ) -> List[bytes]:
+        # transaction hashes, or the data itself if it holds no transactions
+        if transactions is None:
+            transactions = decode_transactions(data)
+        if not transactions:
+            return [data.encode()]
+        return [bytes.fromhex(tx.hash) for tx in transactions]
+
+    @staticmethod
+    def calculate_merkle_root(
+        data: str, transactions: Optional[List[Transaction]] = None
+    ) -> str:
+        return merkle_root(Block.merkle_leaves(data, transactions)).hex()
+
+    def prove(self, tx_hash: str) -> Optional[List[Tuple[str, bool]]]:
+        """
+        Inclusion proof of a transaction, None if it is not in this block
+        """
+        leaves = [bytes.fromhex(tx.hash) for tx in self.transactions]
+        try:
+            index = leaves.index(bytes.fromhex(tx_hash))
+        except ValueError:
+            return None
+        return [(h.hex(), is_left) for h, is_left in merkle_proof(leaves, index)]
+
+    @staticmethod
+    def verify_inclusion(
+        tx_hash: str, proof: List[Tuple[str, bool]], merkle_root: str
+    ) -> bool:
+        """
+        Checks a proof against a header's merkle root, without the block data
+        """
+        raw_proof: Proof = [(bytes.fromhex(h), is_left) for h, is_left in proof]
+        return verify_proof(
+            bytes.fromhex(tx_hash), raw_proof, bytes.fromhex(merkle_root)
+        )
+
+    def is_valid(self) -> bool:
+        if not self.is_valid_hash():
+            return False
+        return self.is_valid_difficulty() and self.is_valid_merkle_root()
+
+    def is_valid_merkle_root(self) -> bool:
+        if not self.merkle_root:
+            # legacy block, the hash covers the data itself
+            return self.index == 0 and not _is_root(self.data)
+        root = self.calculate_merkle_root(self.data, self.transactions)
+        return root == self.merkle_root
+
+    def is_valid_hash(self) -> bool:
+        return self.recalculate_hash() == self.hash
+
+    def is_valid_difficulty(self) -> bool:
+        return _meets_target(self._hash, self._target)
+
+    def recalculate_hash(self) -> str:
+        return self.calculate_hash(
+            self.index,
+            self.prev_hash,
+            self.timestamp,
+            self.commitment,
+            self.nonce,
+            self.target,
+        )
+
+
+class BlockHeader(_Linked):
+    """
+    Block without its data. `commitment` is what the block hash covers, see
+    `Block.commitment`, so the proof of work is checked without the body.
+    """
+
+    __slots__ = ("_commitment",)
+
+    _commitment: HexStr
+
+    def __init__(
+        self,
+        index: int,
+        prev_hash: str,
+        timestamp: int,
+        commitment: str,
+        nonce: int,
+        target: str,
+        hash: str,
+    ) -> None:
+        super().__init__(index, prev_hash, timestamp, nonce, target, hash)
+        object.__setattr__(self, "_commitment", compact(commitment))
+
+    def __reduce__(self):
+        return BlockHeader, self.fields
+
+    def __repr__(self) -> str:
+        return (
+            f"BlockHeader(index={self.index!r}, prev_hash={self.prev_hash!r}, "
+            f"timestamp={self.timestamp!r}, commitment={self.commitment!r}, "
+            f"nonce={self.nonce!r}, target={self.target!r}, hash={self.hash!r})"
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BlockHeader):
+            return NotImplemented
+        return self.fields == other.fields
+
+    __hash__ = _Linked.__hash__
+
+    @property
+    def commitment(self) -> str:
+        return expand(self._commitment)
+
+    @property
+    def has_merkle_root(self) -> bool:
+        # see `Block.is_valid_merkle_root`, legacy data is never shaped like a root
+        return _is_root(self.commitment)
+
+    @property
+    def fields(self) -> tuple:
+        return (
+            self.index,
+            self.prev_hash,
+            self.timestamp,
+            self.commitment,
+            self.nonce,
+            self.target,
+            self.hash,
+        )
+
+    @classmethod
+    def deserialize(cls, other: dict):
+        return cls(**other)
+
+    def serialize(self) -> dict:
+        return dict(
+            index=self.index,
+            prev_hash=self.prev_hash,
+            timestamp=self.timestamp,
+            commitment=self.commitment,
+            nonce=self.nonce,
+            target=self.target,
+            hash=self.hash,
+        )
 
     def is_valid(self) -> bool:
+        # only genesis may be a legacy block
+        if self.index != 0 and not self.has_merkle_root:
+            return False
         return self.is_valid_hash() and self.is_valid_difficulty()
 
     def is_valid_hash(self) -> bool:
         return self.recalculate_hash() == self.hash
 
     def is_valid_difficulty(self) -> bool:
-        return self.validate_difficulty(self.hash, self.target)
+        return _meets_target(self._hash, self._target)
 
     def recalculate_hash(self) -> str:
-        return self.calculate_hash(
+        return Block.calculate_hash(
             self.index,
             self.prev_hash,
             self.timestamp,
-            self.data,
+            self.commitment,
             self.nonce,
             self.target,
         )
+
+    def matches(self, block: Block) -> bool:
+        """
+        Whether `block` is the body of this header, of the same kind
+        """
+        if bool(block.merkle_root) != self.has_merkle_root:
+            return False
+        return block.header == self and block.is_valid_merkle_root()
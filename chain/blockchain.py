@@ -1,15 +1,76 @@
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import Executor
+from functools import wraps
+from threading import RLock
+from typing import Callable, Dict, List, Optional, Sequence, Union
+import os
 import time
 
 from chain.utils.log import logger
-from chain.block import Block
+from chain import codec
+from chain.block import Block, BlockHeader
+from chain.index import BlockIndex
+from chain.miner import Miner
+from chain.storage import BlockStore
+from chain.transaction import TX_COINBASE, verify_inputs
+from chain.utxo import UTXOSet
+
+
+def _locked(method: Callable) -> Callable:
+    # see `BlockChain.lock`
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _writing(method: Callable) -> Callable:
+    # see `BlockChain.write_lock`
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class BlockChain:
     _interval = 5  # 5s per block
+    _retarget_blocks = 10  # blocks per retarget window
+    _ratio_limit = 4  # most the target changes by in one retarget
+    # suppose this target's difficulty = 1
+    _genesis_target = "00000ffff0000000000000000000000000000000000000000000000000000000"
+    _validated_cache_size = 1024
+    # UTXO set and per height cache, saved next to the block store on close
+    state_file = "chainstate.dat"
 
     def __init__(self, blocks: List[Block] = []):
         self.blocks = [BlockChain.genesis()] if not blocks else blocks
+        # block hash -> block whose hash and difficulty are already checked
+        self._validated: "OrderedDict[str, Block]" = OrderedDict()
+        self._utxos: Optional[UTXOSet] = None
+        # target, cumulative work and timestamp at each height, built on first use
+        self._targets: Optional[List[int]] = None
+        self._chainwork: List[int] = []
+        self._timestamps: List[int] = []
+        # block hash -> height, may hold blocks since unwound, see `get_block`
+        self._heights: Dict[str, int] = {}
+        # branches competing with ours
+        self.side = BlockIndex()
+        # verifies transaction signatures in parallel if set, e.g. a process pool
+        self.executor: Optional[Executor] = None
+        # blocks from `backfilled` to `checkpoint` have no body yet, see `from_headers`
+        self.checkpoint = -1
+        self.backfilled = 0
+        # held by a writer while it validates and changes the chain, so nothing
+        # else changes it in between
+        self.write_lock = RLock()
+        # held only while the chain and its UTXO set move to a new tip, blocks
+        # are connected on another thread than the one serving them,
+        # see `ValidationPipeline`
+        self.lock = RLock()
 
     def __len__(self) -> int:
         return self.length
@@ -17,6 +78,7 @@ class BlockChain:
     def __repr__(self) -> str:
         return f"BlockChain({repr(self.blocks)})"
 
+    @_locked
     def __getitem__(self, key):
         if isinstance(key, int):
             return self.blocks[key]
@@ -35,37 +97,255 @@ class BlockChain:
         return hash(sum([hash(b) for b in self.blocks]))
 
     @staticmethod
-    def are_blocks_adjacent(block: Block, prev_block: Block) -> bool:
-        is_valid_block = block.is_valid()
-        is_valid_next = (
+    def are_blocks_linked(block: Block, prev_block: Block) -> bool:
+        return (
             block.index == prev_block.index + 1 and block.prev_hash == prev_block.hash
         )
-        return is_valid_block and is_valid_next
 
     @staticmethod
-    def genesis() -> Block:
-        args = (0, "0", int(time.time()), "Genesis Block")
-        nonce = 0
-        # suppose this target's difficulty = 1
-        target = "00000ffff0000000000000000000000000000000000000000000000000000000"
-        while True:
-            hash = Block.calculate_hash(*args, nonce=nonce, target=target)
-            if Block.validate_difficulty(hash, target):
-                break
-            else:
-                nonce += 1
-        return Block(*args, nonce=nonce, target=target, hash=hash)
+    def are_blocks_adjacent(block: Block, prev_block: Block) -> bool:
+        return block.is_valid() and BlockChain.are_blocks_linked(block, prev_block)
+
+    @classmethod
+    def could_follow(
+        cls, block: Union[Block, BlockHeader], tip: Union[Block, BlockHeader]
+    ) -> bool:
+        """
+        Whether `block` meets the easiest target our chain could retarget to
+        by its height, so its height can be trusted before it connects
+        """
+        retargets = (
+            block.index // cls._retarget_blocks - tip.index // cls._retarget_blocks
+        )
+        # past 256 retargets any target is reachable
+        retargets = min(max(retargets, 0), 256)
+        easiest = int(tip.target, 16) * cls._ratio_limit**retargets
+        return int(block.target, 16) <= min(easiest, 2**256 - 1)
+
+    @staticmethod
+    def work(target: str) -> int:
+        # expected number of hashes to meet `target`
+        return 2**256 // (int(target, 16) + 1)
+
+    @classmethod
+    def next_target(cls, target: int, timespan: int) -> int:
+        """
+        Scales `target` by how long the last window took, in exact integers
+        """
+        expected = cls._retarget_blocks * cls._interval
+        ratio = cls._ratio_limit
+        if timespan * ratio < expected:
+            new_target = target // ratio
+        elif timespan > expected * ratio:
+            new_target = target * ratio
+        else:
+            new_target = target * timespan // expected
+        return min(new_target, 2**256 - 1)
+
+    @classmethod
+    def target_after(
+        cls, height: int, prev_target: int, timestamp_at: Callable[[int], int]
+    ) -> int:
+        """
+        Target of the block at `height`, given the target of the block before
+        it and the timestamps of the blocks before it by height
+        """
+        if height % cls._retarget_blocks:
+            return prev_target
+        timespan = timestamp_at(height - 1) - timestamp_at(
+            height - cls._retarget_blocks
+        )
+        return cls.next_target(prev_target, timespan)
+
+    @staticmethod
+    def format_target(target: int) -> str:
+        return f"{target:064x}"
+
+    @staticmethod
+    def proof_of_work(
+        index: int,
+        prev_hash: str,
+        data: str,
+        target: str,
+        miner: Optional[Miner] = None,
+    ) -> Optional[Block]:
+        """
+        Mines a block committing to `data` by its merkle root.
+        Returns None if cancelled by `miner`.
+        """
+        timestamp = int(time.time())
+        merkle_root = Block.calculate_merkle_root(data)
+        args = (index, prev_hash, timestamp, merkle_root)
+        if miner is None:
+            found = Block.search_nonce(*args, target=target)
+        else:
+            found = miner.search(*args, target=target)
+        if found is None:
+            return None
+        nonce, hash = found
+        return Block(
+            index, prev_hash, timestamp, data, nonce, target, hash, merkle_root
+        )
+
+    @staticmethod
+    def genesis(miner: Optional[Miner] = None) -> Block:
+        target = BlockChain._genesis_target
+        block = BlockChain.proof_of_work(0, "0", "Genesis Block", target, miner)
+        assert block is not None, "Genesis mining cancelled"
+        return block
+
+    @classmethod
+    def load(cls, path: str) -> "BlockChain":
+        """
+        Blocks are read lazily from the store at `path`, which is created if missing.
+        The state saved by `close` is read back, only blocks stored since are replayed.
+        """
+        store = BlockStore(path)
+        if not len(store):
+            store.append(BlockChain.genesis())
+        blockchain = cls(blocks=store)  # type: ignore
+        blockchain.restore_state(os.path.join(path, cls.state_file))
+        return blockchain
+
+    def restore_state(self, path: str) -> bool:
+        """
+        Reads the UTXO set and per height cache from `path`, then catches up
+        with the blocks after the height they were saved at.
+        Returns False if they are missing, corrupt or not of our chain, then
+        both are rebuilt from every block on first use.
+        """
+        try:
+            with open(path, "rb") as f:
+                hashes, targets, timestamps, utxos = codec.load_chainstate(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"No chain state to restore: {e!r}")
+            return False
+        height = len(hashes) - 1
+        if not self.has_block(height, hashes[-1] if hashes else ""):
+            # e.g. the store was reorganized since
+            return False
+
+        self._targets, self._timestamps = targets, timestamps
+        work = 0
+        for target in targets:
+            work += 2**256 // (target + 1)
+            self._chainwork.append(work)
+        self._heights = {hash: i for i, hash in enumerate(hashes)}
+        for block in self.blocks[height + 1 :]:
+            connected = utxos.connect(block.hash, block.transactions)
+            assert connected, f"Invalid transactions in block {block.hash}"
+            self._cache_block(block)
+        self._utxos = utxos
+        return True
+
+    def save_state(self, path: str) -> None:
+        # written aside first, a crash leaves the previous state
+        assert isinstance(self.blocks, BlockStore)
+        with self.write_lock:
+            self._build_cache()
+            assert self._targets is not None
+            with open(path + ".tmp", "wb") as f:
+                codec.dump_chainstate(
+                    self.blocks.hashes(),
+                    self._targets,
+                    self._timestamps,
+                    self.utxos,
+                    f,
+                )
+            os.replace(path + ".tmp", path)
 
     @classmethod
     def deserialize(cls, other: dict):
         blocks = [Block(**b) for b in other["blocks"]]
         return cls(blocks=blocks)
 
+    @classmethod
+    def from_headers(cls, headers: List[BlockHeader], utxos: UTXOSet) -> "BlockChain":
+        """
+        Chain starting at a checkpoint, e.g. from a `Snapshot`. Blocks up to the
+        last header have no body until backfilled with `fill_body`.
+        """
+        blocks = [
+            Block(
+                h.index,
+                h.prev_hash,
+                h.timestamp,
+                "",
+                h.nonce,
+                h.target,
+                h.hash,
+                h.commitment,
+            )
+            for h in headers
+        ]
+        blockchain = cls(blocks=blocks)
+        blockchain._utxos = utxos
+        blockchain.checkpoint = headers[-1].index
+        return blockchain
+
     @property
     def interval(self) -> int:
         return self._interval
 
     @property
+    def utxos(self) -> UTXOSet:
+        # built on first use by replaying the chain
+        if self._utxos is None:
+            with self.lock:
+                if self._utxos is None:
+                    utxos = UTXOSet()
+                    for block in self.blocks:
+                        connected = utxos.connect(block.hash, block.transactions)
+                        assert connected, f"Invalid transactions in block {block.hash}"
+                    self._utxos = utxos
+        return self._utxos
+
+    @property
+    def chainwork(self) -> int:
+        return self.chainwork_at(self.length - 1)
+
+    def chainwork_at(self, height: int) -> int:
+        if height < 0:
+            return 0
+        self._build_cache()
+        return self._chainwork[height]
+
+    def expected_target(self, height: int) -> str:
+        """
+        Target the block at `height` must meet, O(1) once the cache is built
+        """
+        if height == 0:
+            return self._genesis_target
+        self._build_cache()
+        target = self.target_after(
+            height, self._targets[height - 1], self._timestamps.__getitem__
+        )
+        return self.format_target(target)
+
+    def _build_cache(self) -> None:
+        if self._targets is None:
+            self._targets = []
+            for block in self.blocks:
+                self._cache_block(block)
+
+    def _cache_block(self, block: Block) -> None:
+        if self._targets is None:
+            return
+        target = int(block.target, 16)
+        chainwork = self._chainwork[-1] if self._chainwork else 0
+        self._targets.append(target)
+        self._chainwork.append(chainwork + 2**256 // (target + 1))
+        self._timestamps.append(block.timestamp)
+        self._heights[block.hash] = block.index
+
+    def _uncache_from(self, height: int) -> None:
+        if self._targets is not None:
+            del self._targets[height:]
+            del self._chainwork[height:]
+            del self._timestamps[height:]
+
+    @property
+    @_locked
     def latest_block(self) -> Block:
         return self.blocks[-1]
 
@@ -76,75 +356,348 @@ class BlockChain:
     def serialize(self) -> dict:
         return dict(blocks=[b.serialize() for b in self.blocks])
 
+    def is_valid_block(self, block: Block) -> bool:
+        cached = self._validated.get(block.hash)
+        # compare the whole block, a forged body must not reuse a cached hash
+        if cached is block or cached == block:
+            self._validated.move_to_end(block.hash)
+            return True
+
+        if not block.is_valid():
+            return False
+
+        self.mark_valid(block)
+        return True
+
+    def mark_valid(self, block: Block) -> None:
+        # for blocks already checked elsewhere, e.g. in a worker process
+        self._validated[block.hash] = block
+        if len(self._validated) > self._validated_cache_size:
+            self._validated.popitem(last=False)
+
+    def fork_point(self, other: "BlockChain") -> int:
+        """
+        Index of the last block shared with `other`, -1 if even genesis differs
+        """
+        return self.last_shared(self.blocks, other.blocks)
+
+    @staticmethod
+    def last_shared(
+        ours: Sequence[Union[Block, BlockHeader]],
+        theirs: Sequence[Union[Block, BlockHeader]],
+    ) -> int:
+        # blocks are hash linked, so shared blocks form a prefix and can be bisected
+        lo, hi = -1, min(len(ours), len(theirs)) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if ours[mid].hash == theirs[mid].hash:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def validate_fork(self, other: "BlockChain", fork: int) -> bool:
+        # only blocks after the fork point are new to us
+        prev_block = self.blocks[fork] if fork >= 0 else None
+        for block in other.blocks[fork + 1 :]:
+            if not self.is_valid_block(block):
+                return False
+            if block.target != other.expected_target(block.index):
+                return False
+            if prev_block and not BlockChain.are_blocks_linked(block, prev_block):
+                return False
+            prev_block = block
+        return True
+
+    @_writing
     def replace(self, other: "BlockChain") -> bool:
-        if not other.is_valid_chain() or self == other:
+        """
+        Switches to `other` if it has more work, otherwise keeps its blocks
+        after the fork point as a side branch
+        """
+        fork = self.fork_point(other)
+        if fork == other.length - 1:
+            return False
+        if not self.validate_fork(other, fork):
+            return False
+
+        branch = other.blocks[fork + 1 :]
+        work = self.chainwork_at(fork)
+        with self.lock:
+            for block in branch:
+                work += self.work(block.target)
+                self.side.add(block, work)
+        if work <= self.chainwork:
+            return False
+
+        # keep sharing the block list if nothing of ours is left
+        return self.reorganize(fork, other.blocks if fork < 0 else branch)
+
+    @_writing
+    def accept_block(self, block: Block) -> bool:
+        """
+        Adds a block extending our tip or any known branch, switching to the
+        branch with the most work. Returns False if the block is invalid or
+        its parent is unknown, or already on our chain.
+        """
+        if self.has_block(block.index, block.hash):
+            return False
+        if block.prev_hash == self.latest_block.hash:
+            # checked to be linked in `is_next_block`
+            return self.add_block(block)
+        if block.hash in self.side or not self.is_valid_block(block):
+            return False
+
+        parent = self.get_block(block.prev_hash)
+        if parent is None or not self.are_blocks_linked(block, parent):
+            return False
+        if parent.hash in self.side:
+            parent_work = self.side.chainwork[parent.hash]
+        else:
+            parent_work = self.chainwork_at(parent.index)
+        if block.target != self.branch_target(block):
+            return False
+
+        work = parent_work + self.work(block.target)
+        with self.lock:
+            self.side.add(block, work)
+        if work <= self.chainwork:
+            return True
+
+        branch = self.side.branch(block.hash)
+        fork = branch[0].index - 1
+        if not self.has_block(fork, branch[0].prev_hash):
+            # the base of the branch was pruned
             return False
+        return self.reorganize(fork, branch)
+
+    def branch_target(self, block: Block) -> str:
+        """
+        Expected target of a block whose parent is on a side branch or our chain
+        """
+        ancestors = self.side.branch(block.prev_hash)
+        if not ancestors:
+            return self.expected_target(block.index)
+
+        fork = ancestors[0].index - 1
+        self._build_cache()
+
+        def timestamp_at(height: int) -> int:
+            if height > fork:
+                return ancestors[height - fork - 1].timestamp
+            return self._timestamps[height]
+
+        prev_target = int(ancestors[-1].target, 16)
+        return self.format_target(
+            self.target_after(block.index, prev_target, timestamp_at)
+        )
 
-        if self.length >= other.length:
-            # only replace with longer chain
+    @_locked
+    def get_block(self, hash: str) -> Optional[Block]:
+        """
+        Block with `hash` on our chain or a side branch
+        """
+        block = self.side.get(hash)
+        if block is not None:
+            return block
+        self._build_cache()
+        height = self._heights.get(hash)
+        if height is not None and self.has_block(height, hash):
+            return self.blocks[height]
+        return None
+
+    @_locked
+    def blocks_since(self, hash: str) -> List[Block]:
+        """
+        Blocks of our chain after the block with `hash`,
+        or after the fork point if that block is on a side branch
+        """
+        branch = self.side.branch(hash)
+        block = branch[0] if branch else self.get_block(hash)
+        if block is None:
+            return []
+        height = block.index - 1 if branch else block.index
+        return self.blocks[height + 1 :]
+
+    def has_block(self, height: int, hash: str) -> bool:
+        return 0 <= height < self.length and self.blocks[height].hash == hash
+
+    @_locked
+    def has_bodies(self, start: int, end: int) -> bool:
+        # whether the blocks from `start` to `end` can be served to peers
+        missing_from, missing_to = self.backfilled, self.checkpoint
+        return missing_from > missing_to or end < missing_from or start > missing_to
+
+    def is_next_body(self, block: Block) -> bool:
+        height = block.index
+        if height != self.backfilled or height > self.checkpoint:
             return False
+        return self.blocks[height].header.matches(block)
 
-        self.blocks = other.blocks
+    @_writing
+    @_locked
+    def fill_body(self, block: Block) -> bool:
+        """
+        Puts a downloaded block below the checkpoint in place of its header,
+        in height order
+        """
+        if not self.is_next_body(block):
+            return False
+        self.blocks[block.index] = block
+        self.backfilled += 1
         return True
 
+    @_writing
+    @_locked
+    def rewind(self, height: int, utxos: UTXOSet) -> None:
+        """
+        Drops the blocks after `height`, taking `utxos` as the outputs there.
+        All blocks left must have their bodies.
+        """
+        if isinstance(self.blocks, BlockStore):
+            self.blocks.truncate(height + 1)
+        else:
+            del self.blocks[height + 1 :]
+        self._uncache_from(height + 1)
+        self._utxos = utxos
+        self._validated.clear()
+        self.side = BlockIndex()
+        self.checkpoint = -1
+        self.backfilled = height + 1
+
+    @_writing
+    def reorganize(self, fork: int, branch: List[Block]) -> bool:
+        """
+        Switches our blocks after `fork` for `branch`, unwinding and applying
+        only those. Our blocks are kept as a side branch.
+        Returns False if `branch` is not a chain of blocks on top of `fork`.
+        """
+        if branch[0].index != fork + 1:
+            return False
+        if fork >= 0 and branch[0].prev_hash != self.blocks[fork].hash:
+            return False
+        if not all(
+            self.are_blocks_linked(block, prev)
+            for prev, block in zip(branch, branch[1:])
+        ):
+            return False
+
+        # signatures are the most expensive check and need no UTXOs, check
+        # them before locking so readers only wait for the switch itself
+        inputs = [
+            txin
+            for block in branch
+            for tx in block.transactions
+            if tx.type != TX_COINBASE
+            for txin in tx.inputs
+        ]
+        valid = verify_inputs(inputs, self.executor)
+        with self.lock:
+            ours = self.blocks[fork + 1 :]
+            if not valid or not self.reorganize_utxos(ours, branch):
+                self.side.remove(branch)
+                return False
+
+            work = self.chainwork_at(fork)
+            for block in ours:
+                work += self.work(block.target)
+                self.side.add(block, work)
+            self.side.remove(branch)
+
+            if isinstance(self.blocks, BlockStore):
+                self.blocks.truncate(fork + 1)
+                self.blocks.extend(branch)
+            elif fork < 0:
+                self.blocks = branch
+            else:
+                # keep our own copy of the shared prefix, it is already validated
+                self.blocks = self.blocks[: fork + 1] + branch
+            self._uncache_from(fork + 1)
+            for block in branch:
+                self._cache_block(block)
+        return True
+
+    def reorganize_utxos(self, ours: List[Block], theirs: List[Block]) -> bool:
+        """
+        Unwinds `ours` and applies `theirs`,
+        leaving the UTXO set untouched if any of them is invalid
+        """
+        utxos = self.utxos
+        if not all(utxos.can_disconnect(b.hash) for b in ours):
+            return False
+
+        def switch(disconnecting: List[Block], connecting: List[Block]) -> bool:
+            for block in reversed(disconnecting):
+                utxos.disconnect(block.hash, block.transactions)
+            for i, block in enumerate(connecting):
+                if not utxos.connect(block.hash, block.transactions, self.executor):
+                    switch(connecting[:i], disconnecting)
+                    return False
+            return True
+
+        return switch(ours, theirs)
+
+    def close(self) -> None:
+        if isinstance(self.blocks, BlockStore):
+            self.save_state(os.path.join(self.blocks.path, self.state_file))
+            self.blocks.close()
+
     def retarget(self) -> str:
+        target = self.expected_target(self.length)
         lb = self.latest_block
-        block_count = 10
-        target_timespan = block_count * self.interval
-        if len(self.blocks) % block_count != 0:
-            return lb.target
-        else:
-            ratio_limit = 4
-            actual_timespan = lb.timestamp - self.blocks[-block_count].timestamp
-            adjusted_timespan = min(
-                max(actual_timespan, target_timespan / ratio_limit),
-                target_timespan * ratio_limit,
-            )
-            assert 1 / ratio_limit <= adjusted_timespan / target_timespan <= ratio_limit
+        if target != lb.target:
             logger.info(
-                f"Retargeting at {self.length}, difficulty change: {target_timespan/adjusted_timespan:.2%}"
+                f"Retargeting at {self.length}, difficulty change: {int(lb.target, 16) / int(target, 16):.2%}"
             )
-            new_target = int(lb.target, 16) * adjusted_timespan / target_timespan
-            return f"{int(new_target):x}".rjust(64, "0")
+        return target
 
     def validate_blocks(self, left: int, right: int):
         assert 0 <= left < right < self.length
         mini_blocks = self.blocks[left : right + 1]
-        are_all_valid = all([b.is_valid() for b in mini_blocks])
-        are_all_adjacent = all(
-            [
-                BlockChain.are_blocks_adjacent(cur_block, prev_block)
-                for prev_block, cur_block in zip(mini_blocks[:-1], mini_blocks[1:])
-            ]
+        are_all_valid = all(
+            self.is_valid_block(b) and b.target == self.expected_target(b.index)
+            for b in mini_blocks
         )
-        return are_all_valid and are_all_adjacent
+        are_all_linked = all(
+            BlockChain.are_blocks_linked(cur_block, prev_block)
+            for prev_block, cur_block in zip(mini_blocks[:-1], mini_blocks[1:])
+        )
+        return are_all_valid and are_all_linked
 
     def is_valid_chain(self):
         return self.validate_blocks(0, self.length - 1)
 
-    def generate_next(self, data: str) -> Block:
-        lb = self.latest_block
-        args = (lb.index + 1, lb.hash, int(time.time()), data)
-        nonce = 0
-        target = self.retarget()
-        while True:
-            hash = Block.calculate_hash(*args, nonce=nonce, target=target)
-            if Block.validate_difficulty(hash, target):
-                break
-            else:
-                nonce += 1
-        return Block(*args, nonce=nonce, target=target, hash=hash)
+    def generate_next(
+        self, data: str, miner: Optional[Miner] = None
+    ) -> Optional[Block]:
+        with self.lock:
+            lb = self.latest_block
+            target = self.retarget()
+        return BlockChain.proof_of_work(lb.index + 1, lb.hash, data, target, miner)
 
     def is_next_block(self, block: Block) -> bool:
-        return BlockChain.are_blocks_adjacent(block, self.latest_block)
+        if not BlockChain.are_blocks_linked(block, self.latest_block):
+            return False
+        if block.target != self.expected_target(block.index):
+            return False
+        return self.is_valid_block(block)
 
+    @_writing
     def add_block(self, block: Block) -> bool:
-        if block.is_valid() and self.is_next_block(block):
-            self.blocks.append(block)
-            return True
-        else:
+        # checked before locking, no other writer can change the tip meanwhile
+        if not self.is_next_block(block):
+            return False
+        if not self.utxos.validate_block(block.transactions, self.executor):
             return False
+        with self.lock:
+            self.utxos.apply(block.hash, block.transactions)
+            self.blocks.append(block)
+            self._cache_block(block)
+            self.side.prune(block.index - UTXOSet.max_undo)
+        return True
 
-    def mine(self, data: str) -> bool:
-        next_block = self.generate_next(data)
+    def mine(self, data: str, miner: Optional[Miner] = None) -> bool:
+        next_block = self.generate_next(data, miner)
+        if next_block is None:
+            return False
         return self.add_block(next_block)
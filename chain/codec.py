@@ -0,0 +1,493 @@
+"""
+Compact binary encoding of blocks and transactions, used on the wire and on disk.
+
+Every top-level value starts with a version byte. Integers are fixed width and
+big-endian. Hex strings are stored as raw bytes, so a 64-char hash takes 33
+bytes. Decimal amounts are stored as an integer coefficient and exponent.
+
+Snapshots and chain states are streamed to and from files, and end with the
+hash of what comes before.
+"""
+
+import struct
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from chain import Hash
+from chain.block import Block, BlockHeader
+from chain.transaction import TX_COINBASE, TX_REGULAR, Transaction, TxIn, TxOut
+from chain.utils.hexstr import is_hex
+from chain.utxo import Outpoint, UTXOSet
+
+__all__ = [
+    "VERSION",
+    "pack_block",
+    "unpack_block",
+    "pack_blocks",
+    "unpack_blocks",
+    "pack_headers",
+    "unpack_headers",
+    "pack_transaction",
+    "unpack_transaction",
+    "pack_transactions",
+    "unpack_transactions",
+    "dump_snapshot",
+    "load_snapshot",
+    "dump_chainstate",
+    "load_chainstate",
+]
+
+VERSION = 2
+# versions that can still be read, 1 has no merkle root
+_READABLE = (1, 2)
+
+_u8 = struct.Struct(">B")
+_u32 = struct.Struct(">I")
+_u64 = struct.Struct(">Q")
+_str_header = struct.Struct(">BI")
+_decimal_header = struct.Struct(">BbB")  # sign, exponent, coefficient length
+
+# string modes
+_UTF8 = 0
+_HEX = 1
+_HEX_0X = 2
+_HASH = 3  # exactly 64 lowercase hex chars, no length needed
+
+_CHUNK_SIZE = 1 << 16  # bytes buffered when streaming
+_HASH_SIZE = 32
+
+_TX_TYPES = [TX_REGULAR, TX_COINBASE]
+
+
+@contextmanager
+def _packing() -> Iterator[None]:
+    # e.g. a negative integer, which has no fixed width unsigned encoding
+    try:
+        yield
+    except struct.error as e:
+        raise ValueError(f"Value out of range: {e}") from e
+
+
+def _pack_str(s: str, out: bytearray) -> None:
+    if len(s) == 64 and is_hex(s):
+        out += _u8.pack(_HASH)
+        out += bytes.fromhex(s)
+        return
+
+    mode, digits = _UTF8, s
+    if s[:2] == "0x" and is_hex(s[2:]):
+        mode, digits = _HEX_0X, s[2:]
+    elif is_hex(s):
+        mode = _HEX
+
+    if mode == _UTF8:
+        raw = s.encode()
+        out += _str_header.pack(mode, len(raw))
+        out += raw
+    else:
+        # odd length hex is left padded, the header keeps the digit count
+        out += _str_header.pack(mode, len(digits))
+        out += bytes.fromhex(digits.rjust(len(digits) + len(digits) % 2, "0"))
+
+
+def _pack_decimal(d: Decimal, out: bytearray) -> None:
+    sign, digits, exponent = d.as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError(f"Cannot pack {d}")
+    if not -128 <= exponent <= 127:
+        raise ValueError(f"Exponent of {d} out of range")
+    coefficient = int("".join(map(str, digits)))
+    raw = coefficient.to_bytes((coefficient.bit_length() + 7) // 8, "big")
+    if len(raw) > 255:
+        raise ValueError(f"Coefficient of {d} too long")
+    out += _decimal_header.pack(sign, exponent, len(raw))
+    out += raw
+
+
+class _Reader:
+    def __init__(self, data: bytes) -> None:
+        self.data = memoryview(data)
+        self.offset = 0
+        self.v = VERSION
+
+    def unpack(self, s: struct.Struct) -> tuple:
+        try:
+            values = s.unpack_from(self.data, self.offset)
+        except struct.error as e:
+            raise ValueError("Truncated data") from e
+        self.offset += s.size
+        return values
+
+    def read(self, n: int) -> bytes:
+        if self.offset + n > len(self.data):
+            raise ValueError("Truncated data")
+        raw = bytes(self.data[self.offset : self.offset + n])
+        self.offset += n
+        return raw
+
+    def u8(self) -> int:
+        return self.unpack(_u8)[0]
+
+    def u32(self) -> int:
+        return self.unpack(_u32)[0]
+
+    def u64(self) -> int:
+        return self.unpack(_u64)[0]
+
+    def str(self) -> str:
+        mode = self.u8()
+        if mode == _HASH:
+            return self.read(32).hex()
+
+        (length,) = self.unpack(_u32)
+        if mode == _UTF8:
+            return self.read(length).decode()
+        digits = self.read((length + 1) // 2).hex()
+        if length % 2:
+            digits = digits[1:]
+        return "0x" + digits if mode == _HEX_0X else digits
+
+    def decimal(self) -> Decimal:
+        sign, exponent, length = self.unpack(_decimal_header)
+        coefficient = int.from_bytes(self.read(length), "big")
+        return Decimal((sign, tuple(map(int, str(coefficient))), exponent))
+
+    def version(self) -> None:
+        version = self.u8()
+        if version not in _READABLE:
+            raise ValueError(f"Unsupported encoding version {version}")
+        self.v = version
+
+    def done(self) -> None:
+        if self.offset != len(self.data):
+            raise ValueError("Trailing data")
+
+
+class _StreamWriter:
+    """
+    Writes to a file in chunks, hashing every byte written
+    """
+
+    def __init__(self, fileobj: Optional[BinaryIO]) -> None:
+        self.fileobj = fileobj
+        self.hash = Hash()
+        self.out = bytearray(_u8.pack(VERSION))
+
+    def flush(self, force: bool = False) -> None:
+        if not force and len(self.out) < _CHUNK_SIZE:
+            return
+        self.hash.update(self.out)
+        if self.fileobj is not None:
+            self.fileobj.write(self.out)
+        self.out.clear()
+
+    def digest(self) -> bytes:
+        # written last, it is not part of what it hashes
+        self.flush(force=True)
+        digest = self.hash.digest()
+        if self.fileobj is not None:
+            self.fileobj.write(digest)
+        return digest
+
+
+class _StreamReader(_Reader):
+    """
+    Reads a file in chunks, hashing every byte read
+    """
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        super().__init__(b"")
+        self.fileobj = fileobj
+        self.hash = Hash()
+
+    def _fill(self, n: int) -> None:
+        # buffer at least `n` unread bytes
+        if self.offset + n <= len(self.data):
+            return
+        rest = bytes(self.data[self.offset :])
+        while len(rest) < n:
+            chunk = self.fileobj.read(max(_CHUNK_SIZE, n - len(rest)))
+            if not chunk:
+                raise ValueError("Truncated data")
+            rest += chunk
+        self.data = memoryview(rest)
+        self.offset = 0
+
+    def unpack(self, s: struct.Struct) -> tuple:
+        self._fill(s.size)
+        start = self.offset
+        values = super().unpack(s)
+        self.hash.update(self.data[start : self.offset])
+        return values
+
+    def read(self, n: int) -> bytes:
+        self._fill(n)
+        raw = super().read(n)
+        self.hash.update(raw)
+        return raw
+
+    def digest(self) -> bytes:
+        # the trailing hash, which is not part of what it hashes
+        expected = self.hash.digest()
+        self._fill(_HASH_SIZE)
+        digest = bytes(self.data[self.offset : self.offset + _HASH_SIZE])
+        self.offset += _HASH_SIZE
+        if digest != expected:
+            raise ValueError("Hash mismatch")
+        return digest
+
+    def done(self) -> None:
+        super().done()
+        if self.fileobj.read(1):
+            raise ValueError("Trailing data")
+
+
+def _write_block(block: Block, out: bytearray) -> None:
+    out += _u64.pack(block.index)
+    _pack_str(block.prev_hash, out)
+    out += _u64.pack(block.timestamp)
+    raw = block.data.encode()
+    out += _u32.pack(len(raw))
+    out += raw
+    out += _u64.pack(block.nonce)
+    _pack_str(block.target, out)
+    _pack_str(block.hash, out)
+    _pack_str(block.merkle_root, out)
+
+
+def _read_block(r: _Reader) -> Block:
+    index = r.u64()
+    prev_hash = r.str()
+    timestamp = r.u64()
+    data = r.read(r.u32()).decode()
+    nonce = r.u64()
+    target = r.str()
+    hash = r.str()
+    merkle_root = r.str() if r.v >= 2 else ""
+    return Block(index, prev_hash, timestamp, data, nonce, target, hash, merkle_root)
+
+
+def _write_header(header: BlockHeader, out: bytearray) -> None:
+    out += _u64.pack(header.index)
+    _pack_str(header.prev_hash, out)
+    out += _u64.pack(header.timestamp)
+    _pack_str(header.commitment, out)
+    out += _u64.pack(header.nonce)
+    _pack_str(header.target, out)
+    _pack_str(header.hash, out)
+
+
+def _read_header(r: _Reader) -> BlockHeader:
+    index = r.u64()
+    prev_hash = r.str()
+    timestamp = r.u64()
+    commitment = r.str()
+    nonce = r.u64()
+    return BlockHeader(index, prev_hash, timestamp, commitment, nonce, r.str(), r.str())
+
+
+def _write_transaction(tx: Transaction, out: bytearray) -> None:
+    out += _u8.pack(_TX_TYPES.index(tx.type))
+    out += _u32.pack(len(tx.inputs))
+    for txin in tx.inputs:
+        out += _u64.pack(txin.tx_index)
+        _pack_str(txin.tx_hash, out)
+        _pack_decimal(txin.amount, out)
+        _pack_str(txin.pubkey, out)
+        _pack_str(txin.signature, out)
+    out += _u32.pack(len(tx.outputs))
+    for txout in tx.outputs:
+        _pack_decimal(txout.amount, out)
+        _pack_str(txout.address, out)
+
+
+def _read_transaction(r: _Reader) -> Transaction:
+    type_index = r.u8()
+    if type_index >= len(_TX_TYPES):
+        raise ValueError(f"Unknown transaction type {type_index}")
+    type = _TX_TYPES[type_index]
+    inputs = []
+    for _ in range(r.u32()):
+        tx_index, tx_hash, amount = r.u64(), r.str(), r.decimal()
+        inputs.append(TxIn(tx_index, tx_hash, amount, r.str(), r.str()))
+    outputs = [TxOut(r.decimal(), r.str()) for _ in range(r.u32())]
+    return Transaction(type, inputs, outputs)
+
+
+def _write_output(outpoint: Outpoint, txout: TxOut, out: bytearray) -> None:
+    _pack_str(outpoint[0], out)
+    out += _u64.pack(outpoint[1])
+    _pack_decimal(txout.amount, out)
+    _pack_str(txout.address, out)
+
+
+def _read_output(r: _Reader) -> Tuple[Outpoint, TxOut]:
+    outpoint = (r.str(), r.u64())
+    return outpoint, TxOut(r.decimal(), r.str())
+
+
+def _pack(write: Callable, value) -> bytes:
+    out = bytearray(_u8.pack(VERSION))
+    with _packing():
+        write(value, out)
+    return bytes(out)
+
+
+def _pack_many(write: Callable, values: list) -> bytes:
+    out = bytearray(_u8.pack(VERSION))
+    out += _u32.pack(len(values))
+    with _packing():
+        for value in values:
+            write(value, out)
+    return bytes(out)
+
+
+def _unpack(read: Callable, data: bytes):
+    r = _Reader(data)
+    r.version()
+    value = read(r)
+    r.done()
+    return value
+
+
+def _unpack_many(read: Callable, data: bytes) -> list:
+    r = _Reader(data)
+    r.version()
+    values = [read(r) for _ in range(r.u32())]
+    r.done()
+    return values
+
+
+def pack_block(block: Block) -> bytes:
+    return _pack(_write_block, block)
+
+
+def unpack_block(data: bytes) -> Block:
+    return _unpack(_read_block, data)
+
+
+def pack_blocks(blocks: List[Block]) -> bytes:
+    return _pack_many(_write_block, blocks)
+
+
+def unpack_blocks(data: bytes) -> List[Block]:
+    return _unpack_many(_read_block, data)
+
+
+def pack_headers(headers: List[BlockHeader]) -> bytes:
+    return _pack_many(_write_header, headers)
+
+
+def unpack_headers(data: bytes) -> List[BlockHeader]:
+    return _unpack_many(_read_header, data)
+
+
+def pack_transaction(tx: Transaction) -> bytes:
+    return _pack(_write_transaction, tx)
+
+
+def unpack_transaction(data: bytes) -> Transaction:
+    return _unpack(_read_transaction, data)
+
+
+def pack_transactions(txs: List[Transaction]) -> bytes:
+    return _pack_many(_write_transaction, txs)
+
+
+def unpack_transactions(data: bytes) -> List[Transaction]:
+    return _unpack_many(_read_transaction, data)
+
+
+@_packing()
+def dump_snapshot(
+    headers: List[BlockHeader],
+    outputs: Dict[Outpoint, TxOut],
+    fileobj: Optional[BinaryIO] = None,
+) -> str:
+    """
+    Writes headers and unspent outputs to `fileobj`, then the hash of both.
+    Outputs are sorted, so the same state always has the same hash.
+    Returns the hash, which is all that is computed without `fileobj`.
+    """
+    w = _StreamWriter(fileobj)
+    w.out += _u64.pack(len(headers))
+    for header in headers:
+        _write_header(header, w.out)
+        w.flush()
+    w.out += _u64.pack(len(outputs))
+    for outpoint in sorted(outputs):
+        _write_output(outpoint, outputs[outpoint], w.out)
+        w.flush()
+    return w.digest().hex()
+
+
+def load_snapshot(
+    fileobj: BinaryIO,
+) -> Tuple[List[BlockHeader], Dict[Outpoint, TxOut], str]:
+    """
+    Reads what `dump_snapshot` wrote, in chunks, checking the hash at the end
+    """
+    r = _StreamReader(fileobj)
+    r.version()
+    headers = [_read_header(r) for _ in range(r.u64())]
+    outputs = dict(_read_output(r) for _ in range(r.u64()))
+    digest = r.digest()
+    r.done()
+    return headers, outputs, digest.hex()
+
+
+@_packing()
+def dump_chainstate(
+    hashes: List[str],
+    targets: List[int],
+    timestamps: List[int],
+    utxos: UTXOSet,
+    fileobj: BinaryIO,
+) -> None:
+    """
+    Writes the hash, target and timestamp of every block of a chain, then its
+    unspent outputs and their undo data, then the hash of all of it
+    """
+    w = _StreamWriter(fileobj)
+    w.out += _u64.pack(len(hashes))
+    for hash, target, timestamp in zip(hashes, targets, timestamps):
+        _pack_str(hash, w.out)
+        w.out += target.to_bytes(_HASH_SIZE, "big")
+        w.out += _u64.pack(timestamp)
+        w.flush()
+    w.out += _u64.pack(len(utxos.outputs))
+    for outpoint, txout in utxos.outputs.items():
+        _write_output(outpoint, txout, w.out)
+        w.flush()
+    w.out += _u64.pack(len(utxos.undo))
+    for block_hash, spent in utxos.undo.items():
+        _pack_str(block_hash, w.out)
+        w.out += _u64.pack(len(spent))
+        for outpoint, txout in spent:
+            _write_output(outpoint, txout, w.out)
+        w.flush()
+    w.digest()
+
+
+def load_chainstate(
+    fileobj: BinaryIO,
+) -> Tuple[List[str], List[int], List[int], UTXOSet]:
+    """
+    Reads what `dump_chainstate` wrote, in chunks, checking the hash at the end
+    """
+    r = _StreamReader(fileobj)
+    r.version()
+    hashes, targets, timestamps = [], [], []
+    for _ in range(r.u64()):
+        hashes.append(r.str())
+        targets.append(int.from_bytes(r.read(_HASH_SIZE), "big"))
+        timestamps.append(r.u64())
+    utxos = UTXOSet()
+    utxos.outputs = dict(_read_output(r) for _ in range(r.u64()))
+    for _ in range(r.u64()):
+        block_hash = r.str()
+        utxos.undo[block_hash] = [_read_output(r) for _ in range(r.u64())]
+    r.digest()
+    r.done()
+    return hashes, targets, timestamps, utxos
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+
+from chain.utils.log import logger
+
+if TYPE_CHECKING:
+    from chain.peers import PeerManager
+
+__all__ = ["ConnectionPool"]
+
+Address = Tuple[str, int]
+
+
+class ConnectionPool:
+    """
+    Long-lived TCP connections to peers, reused by every message sent to them.
+    Peers that fail to connect are retried with exponential backoff, and
+    connect times are reported to `peers` as latency.
+    """
+
+    connect_timeout = 5
+    idle_timeout = 300
+    base_backoff = 1
+    max_backoff = 60
+
+    def __init__(
+        self,
+        protocol_factory: Callable[[], asyncio.Protocol],
+        peers: Optional["PeerManager"] = None,
+    ) -> None:
+        self.protocol_factory = protocol_factory
+        self.peers = peers
+        self.connections: Dict[Address, asyncio.Protocol] = {}
+        self.last_used: Dict[Address, float] = {}
+        self.failures: Dict[Address, int] = {}
+        self.retry_at: Dict[Address, float] = {}
+        self._connecting: Dict[Address, asyncio.Future] = {}
+
+    def __repr__(self) -> str:
+        return f"ConnectionPool({list(self.connections)})"
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    @staticmethod
+    def is_healthy(protocol: asyncio.Protocol) -> bool:
+        transport = getattr(protocol, "transport", None)
+        return transport is not None and not transport.is_closing()
+
+    def in_backoff(self, address: Address) -> bool:
+        return time.time() < self.retry_at.get(address, 0)
+
+    async def _connect(self, address: Address) -> Optional[asyncio.Protocol]:
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        try:
+            _, protocol = await asyncio.wait_for(
+                loop.create_connection(self.protocol_factory, *address),
+                self.connect_timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            failures = self.failures.get(address, 0) + 1
+            backoff = min(self.base_backoff * 2 ** (failures - 1), self.max_backoff)
+            self.failures[address] = failures
+            self.retry_at[address] = time.time() + backoff
+            if self.peers is not None:
+                self.peers.record_failure(address)
+            logger.debug(f"Cannot connect {address}: {e!r}. Retry in {backoff}s")
+            return None
+
+        if self.peers is not None:
+            self.peers.record_latency(address, time.time() - start)
+        self.failures.pop(address, None)
+        self.retry_at.pop(address, None)
+        self.connections[address] = protocol
+        self.last_used[address] = time.time()
+        return protocol
+
+    async def get(self, address: Address) -> Optional[asyncio.Protocol]:
+        if self.peers is not None and self.peers.is_banned(address[0]):
+            self.discard(address)
+            return None
+
+        protocol = self.connections.get(address)
+        if protocol is not None:
+            if self.is_healthy(protocol):
+                return protocol
+            self.discard(address)
+
+        if self.in_backoff(address):
+            return None
+
+        # share a single connection attempt between concurrent senders
+        if address not in self._connecting:
+            self._connecting[address] = asyncio.ensure_future(self._connect(address))
+        try:
+            return await asyncio.shield(self._connecting[address])
+        finally:
+            self._connecting.pop(address, None)
+
+    async def send(self, address: Address, data: bytes) -> bool:
+        protocol = await self.get(address)
+        if protocol is None:
+            return False
+        protocol.transport.write(data)  # type: ignore
+        self.last_used[address] = time.time()
+        return True
+
+    async def send_all(self, addresses: Iterable[Address], data: bytes) -> List[bool]:
+        # concurrent fan-out, bounded by the slowest peer
+        return await asyncio.gather(*[self.send(a, data) for a in addresses])
+
+    def discard(self, address: Address) -> None:
+        protocol = self.connections.pop(address, None)
+        self.last_used.pop(address, None)
+        if protocol is not None and self.is_healthy(protocol):
+            protocol.transport.close()  # type: ignore
+
+    def health_check(self) -> None:
+        now = time.time()
+        for address, protocol in list(self.connections.items()):
+            idle = now - self.last_used.get(address, now)
+            if not self.is_healthy(protocol) or idle > self.idle_timeout:
+                logger.debug(f"Dropping connection {address}")
+                self.discard(address)
+
+    def close(self) -> None:
+        for address in list(self.connections):
+            self.discard(address)
@@ -0,0 +1,175 @@
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from chain.connection import Address
+
+__all__ = ["SeenSet", "Inventory", "Trickle", "RateLimiter"]
+
+
+class SeenSet:
+    """
+    Set that forgets the least recently added items past `maxsize`
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.items: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"SeenSet({len(self)}/{self.maxsize})"
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.items
+
+    def add(self, item: Hashable) -> None:
+        self.items[item] = None
+        self.items.move_to_end(item)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+class Inventory:
+    """
+    Hashes known to us and to each peer. Objects are announced by hash only to
+    peers not known to have them, and fetched only if we do not know them.
+    """
+
+    max_known = 50000
+    max_peer_known = 5000
+    max_peers = 256
+    max_hashes = 1000  # most hashes in one message, see `Trickle.max_batch`
+    max_requested = 50000
+    request_timeout = 10  # seconds before an unanswered hash is fetched again
+
+    def __init__(self) -> None:
+        self.known = SeenSet(self.max_known)
+        self.peers: "OrderedDict[Address, SeenSet]" = OrderedDict()
+        # hash -> request time, oldest first
+        self.requested: "OrderedDict[str, float]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"Inventory({len(self.known)} known, {len(self.peers)} peers)"
+
+    def __contains__(self, hash: str) -> bool:
+        return hash in self.known
+
+    def peer(self, address: Address) -> SeenSet:
+        seen = self.peers.get(address)
+        if seen is None:
+            seen = self.peers[address] = SeenSet(self.max_peer_known)
+            if len(self.peers) > self.max_peers:
+                self.peers.popitem(last=False)
+        else:
+            self.peers.move_to_end(address)
+        return seen
+
+    def add(self, hash: str) -> None:
+        self.known.add(hash)
+        self.requested.pop(hash, None)
+
+    def announce_to(self, hash: str, peers: Iterable[Address]) -> List[Address]:
+        """
+        Peers to announce `hash` to, which are then taken to know it
+        """
+        targets = []
+        for address in peers:
+            seen = self.peer(address)
+            if hash not in seen:
+                seen.add(hash)
+                targets.append(address)
+        return targets
+
+    def wants(self, hashes: Iterable[str], peer: Address) -> List[str]:
+        """
+        Hashes announced by `peer` that we should fetch from it
+        """
+        now = time.time()
+        self.expire(now)
+        seen = self.peer(peer)
+        wanted = []
+        for hash in hashes:
+            seen.add(hash)
+            if hash in self.known or hash in self.requested:
+                continue
+            self.requested[hash] = now
+            if len(self.requested) > self.max_requested:
+                self.requested.popitem(last=False)
+            wanted.append(hash)
+        return wanted
+
+    def expire(self, now: float) -> None:
+        # unanswered requests are forgotten, so the hash is fetched again
+        requested = self.requested
+        while requested:
+            hash, requested_at = next(iter(requested.items()))
+            if now - requested_at < self.request_timeout:
+                break
+            del requested[hash]
+
+
+class Trickle:
+    """
+    Hashes waiting to be announced to each peer. They are sent in one batch
+    per peer every `interval` seconds or so, coalescing bursts.
+    """
+
+    interval = 0.5
+    max_batch = 1000  # most hashes announced to a peer at once
+
+    def __init__(self) -> None:
+        self.queues: Dict[Address, List[str]] = {}
+
+    def __repr__(self) -> str:
+        return f"Trickle({sum(map(len, self.queues.values()))} queued)"
+
+    def push(self, hash: str, peers: Iterable[Address]) -> None:
+        for address in peers:
+            self.queues.setdefault(address, []).append(hash)
+
+    def pop_batches(self) -> Dict[Address, List[str]]:
+        batches = {}
+        for address, queue in list(self.queues.items()):
+            batches[address] = queue[: self.max_batch]
+            if len(queue) > self.max_batch:
+                self.queues[address] = queue[self.max_batch :]
+            else:
+                del self.queues[address]
+        return batches
+
+    def next_delay(self) -> float:
+        # jittered, so peers do not flush in lockstep
+        return random.uniform(0.5, 1.5) * self.interval
+
+
+class RateLimiter:
+    """
+    Token bucket per key, allowing `rate` items per second in bursts of `burst`
+    """
+
+    max_keys = 1024
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        # key -> (tokens, last update)
+        self.buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"RateLimiter(rate={self.rate}, burst={self.burst})"
+
+    def allow(self, key: Hashable, n: int = 1, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= n
+        if allowed:
+            tokens -= n
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return allowed
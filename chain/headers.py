@@ -0,0 +1,105 @@
+from typing import List, Optional
+
+from chain.block import Block, BlockHeader
+from chain.blockchain import BlockChain
+
+__all__ = ["HeaderChain"]
+
+
+class HeaderChain:
+    """
+    Chain of block headers only, for nodes that follow the tip and check the
+    proof of work without keeping block data. Bodies are fetched on demand and
+    checked against their header with `verify_body`.
+    """
+
+    def __init__(self, headers: List[BlockHeader] = []) -> None:
+        self.headers = [BlockChain.genesis().header] if not headers else headers
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __repr__(self) -> str:
+        return f"HeaderChain({self.headers!r})"
+
+    def __getitem__(self, key):
+        return self.headers[key]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, HeaderChain):
+            return False
+        return self.headers == other.headers
+
+    @classmethod
+    def deserialize(cls, other: dict):
+        return cls([BlockHeader(**h) for h in other["headers"]])
+
+    def serialize(self) -> dict:
+        return dict(headers=[h.serialize() for h in self.headers])
+
+    @property
+    def latest_header(self) -> BlockHeader:
+        return self.headers[-1]
+
+    @property
+    def length(self) -> int:
+        return len(self.headers)
+
+    def get(self, index: int) -> Optional[BlockHeader]:
+        return self.headers[index] if 0 <= index < self.length else None
+
+    @staticmethod
+    def target_at(headers: List[BlockHeader], height: int) -> str:
+        """
+        Target the header at `height` must meet, see `BlockChain.expected_target`
+        """
+        if height == 0:
+            return BlockChain._genesis_target
+        target = BlockChain.target_after(
+            height, int(headers[height - 1].target, 16), lambda h: headers[h].timestamp
+        )
+        return BlockChain.format_target(target)
+
+    def expected_target(self, height: int) -> str:
+        return self.target_at(self.headers, height)
+
+    def add_header(self, header: BlockHeader) -> bool:
+        if not BlockChain.are_blocks_linked(header, self.latest_header):
+            return False
+        if header.target != self.expected_target(header.index):
+            return False
+        if not header.is_valid():
+            return False
+        self.headers.append(header)
+        return True
+
+    def fork_point(self, headers: List[BlockHeader]) -> int:
+        # see `BlockChain.fork_point`
+        return BlockChain.last_shared(self.headers, headers)
+
+    def replace(self, headers: List[BlockHeader]) -> bool:
+        """
+        Switches to `headers` if they form a valid chain with more work
+        """
+        fork = self.fork_point(headers)
+        theirs = sum(BlockChain.work(h.target) for h in headers[fork + 1 :])
+        ours = sum(BlockChain.work(h.target) for h in self.headers[fork + 1 :])
+        if theirs <= ours:
+            return False
+
+        prev = self.headers[fork] if fork >= 0 else None
+        for header in headers[fork + 1 :]:
+            if not header.is_valid():
+                return False
+            if header.target != self.target_at(headers, header.index):
+                return False
+            if prev and not BlockChain.are_blocks_linked(header, prev):
+                return False
+            prev = header
+
+        self.headers = self.headers[: fork + 1] + headers[fork + 1 :]
+        return True
+
+    def verify_body(self, block: Block) -> bool:
+        header = self.get(block.index)
+        return header is not None and header.matches(block)
@@ -0,0 +1,59 @@
+from typing import Dict, Iterable, List, Optional
+
+from chain.block import Block
+
+__all__ = ["BlockIndex"]
+
+
+class BlockIndex:
+    """
+    Blocks off the main chain keyed by hash, with the cumulative work of the
+    branch up to each of them. Competing branches are kept here, so switching
+    to one only needs the blocks that are not on the main chain yet.
+    """
+
+    def __init__(self) -> None:
+        self.blocks: Dict[str, Block] = {}
+        self.chainwork: Dict[str, int] = {}
+
+    def __repr__(self) -> str:
+        return f"BlockIndex({len(self)} blocks)"
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __contains__(self, hash: str) -> bool:
+        return hash in self.blocks
+
+    def get(self, hash: str) -> Optional[Block]:
+        return self.blocks.get(hash)
+
+    def add(self, block: Block, chainwork: int) -> None:
+        self.blocks[block.hash] = block
+        self.chainwork[block.hash] = chainwork
+
+    def remove(self, blocks: Iterable[Block]) -> None:
+        for block in blocks:
+            self.blocks.pop(block.hash, None)
+            self.chainwork.pop(block.hash, None)
+
+    def branch(self, hash: str) -> List[Block]:
+        """
+        Blocks from where the branch leaves the main chain up to `hash`
+        """
+        blocks = []
+        block = self.blocks.get(hash)
+        while block is not None:
+            blocks.append(block)
+            block = self.blocks.get(block.prev_hash)
+        return blocks[::-1]
+
+    def tips(self) -> List[Block]:
+        parents = {b.prev_hash for b in self.blocks.values()}
+        return [b for b in self.blocks.values() if b.hash not in parents]
+
+    def prune(self, height: int) -> None:
+        """
+        Drop blocks below `height`, branches forking that deep can no longer win
+        """
+        self.remove([b for b in self.blocks.values() if b.index < height])
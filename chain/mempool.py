@@ -1,13 +1,45 @@
-from typing import Set
+import heapq
+import itertools
+import time
+from operator import itemgetter
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from chain.transaction import Transaction
+from chain.transaction import TX_REGULAR, Transaction
+from chain.utxo import Outpoint, UTXOSet
 
 __all__ = ["get_mempool", "Mempool"]
 
 
 class Mempool:
-    def __init__(self, transactions: Set[Transaction] = set()) -> None:
-        self.transactions = transactions
+    """
+    Pending transactions ordered by fee rate (fee per serialized byte).
+    When `max_size` bytes are exceeded the lowest fee rates are evicted,
+    and transactions older than `expiry` seconds are dropped.
+    """
+
+    def __init__(
+        self,
+        transactions: Set[Transaction] = set(),
+        max_size: int = 32 * 1024 * 1024,
+        expiry: int = 3 * 60 * 60,
+    ) -> None:
+        self.max_size = max_size
+        self.expiry = expiry
+        self.size = 0
+        self.txs: Dict[str, Transaction] = {}
+        # spent outpoint -> pooled transaction spending it
+        self.spends: Dict[Outpoint, Transaction] = {}
+        # min-heap of (fee rate, sequence, tx hash), removed entries are skipped lazily
+        self._heap: List[Tuple[Decimal, int, str]] = []
+        # the same negated, highest fee rate first
+        self._top_heap: List[Tuple[Decimal, int, str]] = []
+        self._entries: Dict[str, Tuple[Decimal, int]] = {}
+        self._added_at: "OrderedDict[str, float]" = OrderedDict()
+        self._sequence = itertools.count()
+        for tx in transactions:
+            self.add(tx)
 
     def __repr__(self) -> str:
         return f"Mempool({repr(self.transactions)})"
@@ -17,25 +49,187 @@ class Mempool:
             return False
         return self.transactions == other.transactions
 
-    def trim_txs(self, block_txs: Set[Transaction]) -> None:
-        self.transactions.difference_update(block_txs)
+    def __len__(self) -> int:
+        return len(self.txs)
+
+    def __contains__(self, transaction: Transaction) -> bool:
+        return transaction.hash in self.txs
+
+    @property
+    def transactions(self) -> Set[Transaction]:
+        return set(self.txs.values())
+
+    @staticmethod
+    def fee_rate(transaction: Transaction) -> Decimal:
+        return transaction.fee / transaction.size
+
+    def trim_txs(self, block_txs: Iterable[Transaction]) -> None:
+        # confirmed transactions leave, and so do pooled ones spending the same outputs
+        for block_tx in block_txs:
+            for tx in self.conflicts(block_tx):
+                self.remove(tx)
+            self.remove(block_tx)
+
+    def conflicts(self, transaction: Transaction) -> Set[Transaction]:
+        spends = self.spends
+        return {
+            spends[txin.outpoint]
+            for txin in transaction.inputs
+            if txin.outpoint in spends
+        }
 
     def is_double_spent(self, transaction: Transaction) -> bool:
-        for tx in self.transactions:
-            if tx.has_same_inputs(transaction):
-                return True
-        return False
+        spends = self.spends
+        return any(txin.outpoint in spends for txin in transaction.inputs)
+
+    def add(
+        self,
+        transaction: Transaction,
+        now: Optional[float] = None,
+        utxos: Optional[UTXOSet] = None,
+    ) -> bool:
+        """
+        Pools a valid transaction. With `utxos`, its inputs must also spend
+        their outputs there or those of pooled transactions.
+        """
+        if not self.can_add(transaction, utxos):
+            return False
 
-    def add(self, transaction: Transaction) -> bool:
-        if self.is_double_spent(transaction):
+        # signatures verified here are cached for when the block arrives
+        if not transaction.valid:
             return False
 
-        self.transactions.add(transaction)
+        now = time.time() if now is None else now
+        self.expire(now)
+
+        fee_rate = self.fee_rate(transaction)
+        sequence = next(self._sequence)
+        self.txs[transaction.hash] = transaction
+        for txin in transaction.inputs:
+            self.spends[txin.outpoint] = transaction
+        heapq.heappush(self._heap, (fee_rate, sequence, transaction.hash))
+        heapq.heappush(self._top_heap, (-fee_rate, -sequence, transaction.hash))
+        self._entries[transaction.hash] = (fee_rate, sequence)
+        self._added_at[transaction.hash] = now
+        self.size += transaction.size
+
+        while self.size > self.max_size:
+            self.remove(self.lowest())
+
+        # the new transaction may itself pay the lowest fee rate
+        return transaction in self
+
+    def can_add(
+        self,
+        transaction: Transaction,
+        utxos: Optional[UTXOSet] = None,
+        pending: Dict[str, Transaction] = {},
+    ) -> bool:
+        # every check of `add` but the signatures, which are the expensive one
+        if transaction in self:
+            return False
+
+        if transaction.type != TX_REGULAR or not transaction.has_enough_balance:
+            return False
+
+        if self.is_double_spent(transaction):
+            return False
 
+        return utxos is None or self.has_inputs(transaction, utxos, pending)
+
+    def screen(
+        self, transactions: Iterable[Transaction], utxos: UTXOSet
+    ) -> List[Transaction]:
+        """
+        Those of `transactions` `add` would take one after another, unless
+        their signatures are invalid
+        """
+        pending: Dict[str, Transaction] = {}
+        spent: Set[Outpoint] = set()
+        passed = []
+        for tx in transactions:
+            outpoints = {txin.outpoint for txin in tx.inputs}
+            if tx.hash in pending or not spent.isdisjoint(outpoints):
+                continue
+            if self.can_add(tx, utxos, pending):
+                pending[tx.hash] = tx
+                spent |= outpoints
+                passed.append(tx)
+        return passed
+
+    def has_inputs(
+        self,
+        transaction: Transaction,
+        utxos: UTXOSet,
+        pending: Dict[str, Transaction] = {},
+    ) -> bool:
+        # `pending` transactions are not pooled yet, but their outputs count
+        for txin in transaction.inputs:
+            txout = utxos.get(txin.outpoint)
+            if txout is None:
+                parent = self.txs.get(txin.tx_hash) or pending.get(txin.tx_hash)
+                if parent is None or not 0 <= txin.tx_index < len(parent.outputs):
+                    return False
+                txout = parent.outputs[txin.tx_index]
+            if txout.amount != txin.amount:
+                return False
         return True
 
     def remove(self, transaction: Transaction) -> None:
-        self.transactions.discard(transaction)
+        if transaction not in self:
+            return
+
+        tx = self.txs.pop(transaction.hash)
+        del self._entries[tx.hash]
+        del self._added_at[tx.hash]
+        self.size -= tx.size
+        for txin in tx.inputs:
+            if self.spends.get(txin.outpoint) == tx:
+                del self.spends[txin.outpoint]
+
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # drop stale entries once they dominate the heap
+            self._heap = [(*e, h) for h, e in self._entries.items()]
+            heapq.heapify(self._heap)
+            self._top_heap = [(-r, -s, h) for h, (r, s) in self._entries.items()]
+            heapq.heapify(self._top_heap)
+
+    def lowest(self) -> Transaction:
+        # O(log n) amortized, stale heap entries are popped along the way
+        while True:
+            fee_rate, sequence, tx_hash = self._heap[0]
+            if self._entries.get(tx_hash) == (fee_rate, sequence):
+                return self.txs[tx_hash]
+            heapq.heappop(self._heap)
+
+    def top(self, n: Optional[int] = None) -> List[Transaction]:
+        """
+        Transactions with the highest fee rate first
+        """
+        if n is None:
+            best = sorted(self._entries.items(), key=itemgetter(1), reverse=True)
+            return [self.txs[tx_hash] for tx_hash, _ in best]
+
+        # O(n log size), popping the best entries and pushing them back,
+        # stale entries met on the way are dropped for good
+        heap = self._top_heap
+        popped = []
+        while heap and len(popped) < n:
+            entry = heapq.heappop(heap)
+            fee_rate, sequence, tx_hash = entry
+            if self._entries.get(tx_hash) == (-fee_rate, -sequence):
+                popped.append(entry)
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return [self.txs[tx_hash] for _, _, tx_hash in popped]
+
+    def expire(self, now: Optional[float] = None) -> None:
+        deadline = (time.time() if now is None else now) - self.expiry
+        while self._added_at:
+            tx_hash, added_at = next(iter(self._added_at.items()))
+            if added_at > deadline:
+                break
+            self.remove(self.txs[tx_hash])
 
     def serialize(self) -> dict:
         return dict(transactions=list(self.transactions))
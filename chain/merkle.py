@@ -0,0 +1,78 @@
+from typing import List, Tuple
+
+from chain import Hash
+
+__all__ = ["merkle_root", "merkle_proof", "verify_proof"]
+
+# (sibling hash, whether the sibling is on the left)
+Proof = List[Tuple[bytes, bool]]
+
+# leaves and inner nodes are hashed apart, so neither can pose as the other
+_LEAF = b"\x00"
+_NODE = b"\x01"
+
+
+def _hash_leaf(leaf: bytes) -> bytes:
+    return Hash(_LEAF + leaf).digest()
+
+
+def _hash_node(left: bytes, right: bytes) -> bytes:
+    return Hash(_NODE + left + right).digest()
+
+
+def _next_level(level: List[bytes]) -> List[bytes]:
+    # an odd node out is carried up as is rather than paired with itself
+    pairs = [_hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        pairs.append(level[-1])
+    return pairs
+
+
+def merkle_root(leaves: List[bytes]) -> bytes:
+    """
+    >>> merkle_root([b"a", b"b", b"c"]).hex()[:16]
+    '17321db51c1ef3ec'
+    """
+    if not leaves:
+        return Hash(b"").digest()
+
+    level = [_hash_leaf(leaf) for leaf in leaves]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves: List[bytes], index: int) -> Proof:
+    """
+    Sibling hashes from the leaf at `index` up to the root, O(log n) of them
+
+    >>> leaves = [b"a", b"b", b"c"]
+    >>> all(verify_proof(l, merkle_proof(leaves, i), merkle_root(leaves))
+    ...     for i, l in enumerate(leaves))
+    True
+    """
+    if not 0 <= index < len(leaves):
+        raise IndexError("leaf index out of range")
+
+    proof = []
+    level = [_hash_leaf(leaf) for leaf in leaves]
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling], sibling < index))
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf: bytes, proof: Proof, root: bytes) -> bool:
+    h = _hash_leaf(leaf)
+    for sibling, is_left in proof:
+        h = _hash_node(sibling, h) if is_left else _hash_node(h, sibling)
+    return h == root
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
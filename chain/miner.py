@@ -0,0 +1,123 @@
+import os
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Optional, Tuple
+
+from chain.block import Block
+
+__all__ = ["Miner"]
+
+_stop_event = None
+
+
+def _init_worker(stop_event) -> None:
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _search(
+    index: int,
+    prev_hash: str,
+    timestamp: int,
+    data: str,
+    target: str,
+    start: int,
+    step: int,
+) -> Optional[Tuple[int, str]]:
+    result = Block.search_nonce(
+        index,
+        prev_hash,
+        timestamp,
+        data,
+        target,
+        start=start,
+        step=step,
+        stopped=_stop_event.is_set,
+    )
+    if result is not None:
+        # tell other workers to stop
+        _stop_event.set()
+    return result
+
+
+class Miner:
+    """
+    Proof of work search spread across a process pool.
+    Worker `i` of `n` tries nonces `i, i + n, i + 2n, ...`
+
+    Each search is a job. `cancel` stops the current one, including a job
+    taken with `prepare` whose search has not started yet.
+    """
+
+    def __init__(self, workers: Optional[int] = None) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self._stop_event = multiprocessing.Event()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._job = 0
+        self._cancelled = 0  # last job cancelled
+        self._prepared = False
+
+    def __repr__(self) -> str:
+        return f"Miner(workers={self.workers})"
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self._stop_event,),
+            )
+        return self._executor
+
+    def search(
+        self, index: int, prev_hash: str, timestamp: int, data: str, target: str
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Blocks until a nonce is found or `cancel` is called, in which case returns None
+        """
+        with self._lock:
+            if self._prepared:
+                self._prepared = False
+            else:
+                self._job += 1
+            if self._cancelled == self._job:
+                return None
+            self._stop_event.clear()
+        futures = {
+            self.executor.submit(
+                _search, index, prev_hash, timestamp, data, target, i, self.workers
+            )
+            for i in range(self.workers)
+        }
+        result = None
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if result is None:
+                    result = future.result()
+            if result is not None:
+                self._stop_event.set()
+        return result
+
+    def prepare(self) -> None:
+        """
+        Starts the job of the next `search`, e.g. when its block template is
+        taken, so a tip arriving before the search begins still cancels it
+        """
+        with self._lock:
+            self._job += 1
+            self._prepared = True
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled = self._job
+            self._stop_event.set()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -1,7 +1,9 @@
+import os
 import random
 import asyncio
 import time
-from typing import List, Callable, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Callable, Dict, Optional, Tuple
 from enum import Enum, auto
 
 import umsgpack as msgpack
@@ -10,8 +12,33 @@ from kademlia.network import Server
 from kademlia.protocol import KademliaProtocol
 from kademlia.node import Node
 
-from chain import Block, BlockChain
-from chain.transaction import Transaction
+from chain import Block, BlockChain, codec
+from chain.block import BlockHeader
+from chain.connection import Address, ConnectionPool
+from chain.gossip import Inventory, RateLimiter, Trickle
+from chain.headers import HeaderChain
+from chain.mempool import Mempool, get_mempool
+from chain.miner import Miner
+from chain.peers import PeerManager
+from chain.pipeline import ValidationPipeline
+from chain.snapshot import Snapshot
+from chain.sync import (
+    Backfill,
+    BlockSync,
+    ForkSearch,
+    HeaderForkSearch,
+    HeaderSync,
+    TipSync,
+)
+from chain.template import BlockTemplate
+from chain.transaction import Transaction, signed_messages
+from chain.utils.elliptic import (
+    generate_keypair,
+    get_signature_cache,
+    public_key,
+    verify_many,
+)
+from chain.utils.framing import FrameDecoder, FrameTooLarge, encode_frame
 from chain.utils.log import logger
 
 
@@ -24,6 +51,10 @@ class Message(Enum):
     RECEIVE_BLOCKS = auto()
     REQUEST_TRANSACTIONS = auto()
     RECEIVE_TRANSACTIONS = auto()
+    REQUEST_HEADERS = auto()
+    RECEIVE_HEADERS = auto()
+    INVENTORY = auto()
+    GET_DATA = auto()
 
     @classmethod
     def get_latest_block(cls) -> dict:
@@ -31,21 +62,68 @@ class Message(Enum):
 
     @classmethod
     def send_latest_block(cls, block: Block) -> dict:
-        return dict(type=cls.RECEIVE_LATEST_BLOCK.value, block=block.serialize())
+        return dict(type=cls.RECEIVE_LATEST_BLOCK.value, block=codec.pack_block(block))
 
     @classmethod
-    def get_blocks(cls, start_index: int, end_index: int):
+    def get_blocks(cls, start_index: int, end_index: int) -> dict:
         return dict(
-            type=cls.REQUEST_BLOCKS, start_index=start_index, end_index=end_index
+            type=cls.REQUEST_BLOCKS.value,
+            start_index=start_index,
+            end_index=end_index,
+        )
+
+    @classmethod
+    def send_blocks(cls, start_index: int, end_index: int, blocks: List[Block]) -> dict:
+        return dict(
+            type=cls.RECEIVE_BLOCKS.value,
+            start_index=start_index,
+            end_index=end_index,
+            blocks=codec.pack_blocks(blocks),
         )
 
     @classmethod
-    def send_blocks(cls, start_index: int, end_index: int, blocks: List[Block]):
+    def get_headers(cls, start_index: int, end_index: int) -> dict:
         return dict(
-            type=cls.RECEIVE_BLOCKS,
+            type=cls.REQUEST_HEADERS.value,
             start_index=start_index,
             end_index=end_index,
-            blocks=[b.serialize() for b in blocks],
+        )
+
+    @classmethod
+    def send_headers(
+        cls, start_index: int, end_index: int, headers: List[BlockHeader]
+    ) -> dict:
+        return dict(
+            type=cls.RECEIVE_HEADERS.value,
+            start_index=start_index,
+            end_index=end_index,
+            headers=codec.pack_headers(headers),
+        )
+
+    @classmethod
+    def send_inventory(
+        cls,
+        port: int,
+        blocks: List[str] = [],
+        transactions: List[str] = [],
+        height: Optional[int] = None,
+    ) -> dict:
+        # `port` is where the sender listens, so it is known as a peer,
+        # `height` is the sender's tip
+        return dict(
+            type=cls.INVENTORY.value,
+            port=port,
+            blocks=[bytes.fromhex(h) for h in blocks],
+            transactions=[bytes.fromhex(h) for h in transactions],
+            height=height,
+        )
+
+    @classmethod
+    def get_data(cls, blocks: List[str], transactions: List[str] = []) -> dict:
+        return dict(
+            type=cls.GET_DATA.value,
+            blocks=[bytes.fromhex(h) for h in blocks],
+            transactions=[bytes.fromhex(h) for h in transactions],
         )
 
     @classmethod
@@ -55,7 +133,8 @@ class Message(Enum):
     @classmethod
     def send_blockchain(cls, blockchain: BlockChain) -> dict:
         return dict(
-            type=cls.RECEIVE_BLOCKCHAIN.value, blockchain=blockchain.serialize()
+            type=cls.RECEIVE_BLOCKCHAIN.value,
+            blockchain=codec.pack_blocks(blockchain.blocks),
         )
 
     @classmethod
@@ -65,11 +144,15 @@ class Message(Enum):
     @classmethod
     def send_transactions(cls, transactions: List[Transaction]) -> dict:
         return dict(
-            type=cls.RECEIVE_TRANSACTIONS,
-            transactions=[t.serialize() for t in transactions],
+            type=cls.RECEIVE_TRANSACTIONS.value,
+            transactions=codec.pack_transactions(transactions),
         )
 
 
+def pack_message(message: dict) -> bytes:
+    return encode_frame(msgpack.dumps(message))
+
+
 class UDPProtocal(KademliaProtocol):
     def get_refresh_ids(self) -> List[bytes]:
         """
@@ -87,104 +170,439 @@ class UDPProtocal(KademliaProtocol):
 
 
 class TCPProtocol(asyncio.Protocol):
+    # where the other side listens, known only for connections we opened
+    peer: Optional[Address] = None
+
     def __init__(self, server: "P2PServer") -> None:
         self.server = server
         self.blockchain = self.server.blockchain
+        self.decoder = FrameDecoder()
+        self.fork: Optional[ForkSearch] = None
 
     def reply(self, data: dict) -> None:
-        self.transport.write(msgpack.dumps(data))
+        self.transport.write(pack_message(data))
 
     def handle_request_latest_block(self) -> None:
-        self.reply(Message.send_latest_block(self.blockchain.latest_block))
+        latest_block = self.blockchain.latest_block
+        if not self.blockchain.has_bodies(latest_block.index, latest_block.index):
+            # started from a snapshot, and no block on top yet
+            return
+        self.reply(Message.send_latest_block(latest_block))
         # waiting for answer, so don't close transport here
 
-    def handle_receive_latest_block(self, block: dict) -> None:
-        peer_block = Block.deserialize(block)
+    def validate(
+        self, payload: bytes, many: bool, connect: Callable, done: Callable
+    ) -> None:
+        # decoded and checked off the event loop, see `ValidationPipeline`
+        assert self.server.pipeline is not None
+        self.server.pipeline.submit(
+            payload, many, connect, done, self.transport, self.invalid_blocks
+        )
+
+    def invalid_blocks(self) -> None:
+        self.misbehaved(PeerManager.ban_score)
+
+    def misbehaved(self, score: int) -> None:
+        if self.server.peers.misbehaved(self.peer_ip, score):
+            self.transport.close()
+
+    def handle_receive_latest_block(self, block: bytes) -> None:
+        self.validate(block, False, self.connect_latest_block, self.after_latest_block)
+
+    def connect_latest_block(self, blocks: List[Block]) -> Tuple[Block, Block, bool]:
+        peer_block = blocks[0]
         latest_block = self.blockchain.latest_block
-        is_added = self.blockchain.add_block(peer_block)
+        return peer_block, latest_block, self.blockchain.accept_block(peer_block)
+
+    def after_latest_block(self, result: Tuple[Block, Block, bool]) -> None:
+        peer_block, latest_block, is_added = result
+        if not is_added and not BlockChain.could_follow(peer_block, latest_block):
+            logger.debug(f"Target too easy for height {peer_block.index}, ignoring")
+            return
+        if self.peer is not None:
+            self.server.tips.update(self.peer, peer_block.index)
+            # so the block is not announced straight back
+            self.server.inventory.peer(self.peer).add(peer_block.hash)
         if is_added:
-            self.server.broadcast_message(Message.send_latest_block(peer_block))
+            self.server.inventory.add(peer_block.hash)
+            if latest_block != self.blockchain.latest_block:
+                self.server.on_new_tip()
+                self.server.announce_block(peer_block)
         elif latest_block.index < peer_block.index:
-            # peer is longer, ask for blockchain
-            logger.debug("Having no latest block. Asking for blockchain")
-            self.server.broadcast_message(Message.get_blockchain())
+            # peer is longer, ask for the missing blocks only
+            logger.debug(f"Having no latest block. Syncing to {peer_block.index}")
+            self.server.sync_blocks(peer_block.index)
         else:
             # I'm on the edge!
             pass
 
-        self.transport.close()
+    def handle_request_blocks(self, start_index: int, end_index: int) -> None:
+        end_index = min(
+            end_index,
+            start_index + BlockSync.batch_size - 1,
+            self.blockchain.length - 1,
+        )
+        # right past our tip, an empty page tells a fork search we are done
+        if not 0 <= start_index <= self.blockchain.length:
+            return
+        if not self.blockchain.has_bodies(start_index, end_index):
+            return
+        blocks = self.blockchain[start_index : end_index + 1]
+        self.reply(Message.send_blocks(start_index, end_index, blocks))
+
+    def handle_receive_blocks(
+        self, start_index: int, end_index: int, blocks: bytes
+    ) -> None:
+        if self.peer is not None:
+            self.server.peers.end_request(self.peer, start_index, len(blocks))
+        backfill = self.server.backfill
+        if backfill and not backfill.synced and start_index <= backfill.checkpoint:
+            self.validate(
+                blocks,
+                True,
+                lambda peer_blocks: backfill.receive(start_index, peer_blocks),
+                self.after_backfill,
+            )
+            return
 
-    def handle_request_blockchain(self):
-        self.reply(Message.send_blockchain(self.blockchain))
+        fork = self.fork
+        if fork is not None and start_index == fork.start:
+            # a page of the peer's chain, asked for when it is on another fork
+            def step(peer_blocks: List[Block]) -> Tuple[Block, Optional[bool]]:
+                latest_block = self.blockchain.latest_block
+                return latest_block, fork.receive(peer_blocks)
 
-    def handle_receive_blockchain(self, blockchain: dict):
-        other_blockchain = BlockChain.deserialize(blockchain)
+            self.validate(blocks, True, step, self.after_fork)
+            return
 
-        if other_blockchain.length > self.blockchain.length:
-            self.blockchain.replace(other_blockchain)
+        def connect(peer_blocks: List[Block]) -> Tuple[int, Block, bool]:
+            latest_block = self.blockchain.latest_block
+            return (
+                start_index,
+                latest_block,
+                self.server.block_sync.receive(start_index, peer_blocks),
+            )
 
-        self.transport.close()
+        self.validate(blocks, True, connect, self.after_blocks)
+
+    def after_blocks(self, result: Tuple[int, Block, bool]) -> None:
+        start_index, latest_block, connected = result
+        block_sync = self.server.block_sync
+        if not connected:
+            logger.debug("Blocks not connecting. Looking for the fork point")
+            self.fork = ForkSearch(self.blockchain, start_index)
+            self.reply(Message.get_blocks(*self.fork.request()))
+        elif latest_block != self.blockchain.latest_block:
+            self.server.on_new_tip()
+            if block_sync.synced:
+                self.server.announce_block(self.blockchain.latest_block)
+            else:
+                self.server.sync_blocks(block_sync.target_height)
+
+    def after_fork(self, result: Tuple[Block, Optional[bool]]) -> None:
+        latest_block, taken = result
+        if taken is not None:
+            self.fork = None
+        elif self.fork is not None:
+            self.reply(Message.get_blocks(*self.fork.request()))
+        if latest_block != self.blockchain.latest_block:
+            # reorganized onto the peer's branch
+            self.server.block_sync.reset()
+            self.server.on_new_tip()
+            self.server.announce_block(self.blockchain.latest_block)
+
+    def after_backfill(self, connected: bool) -> None:
+        if not connected:
+            logger.debug("Backfilled blocks do not match our headers")
+        if self.server.backfill.verified is False:
+            # rewound to the checkpoint, catch up with peers again
+            self.server.block_sync.reset()
+            self.server.on_new_tip()
+            self.server.sync_blocks(self.server.tips.best_height())
+        self.server.backfill_blocks()
+
+    def handle_request_headers(self, start_index: int, end_index: int) -> None:
+        end_index = min(
+            end_index,
+            start_index + HeaderSync.max_headers - 1,
+            self.blockchain.length - 1,
+        )
+        # right past our tip, an empty page tells a fork search we are done
+        if not 0 <= start_index <= self.blockchain.length:
+            return
+        headers = [b.header for b in self.blockchain[start_index : end_index + 1]]
+        self.reply(Message.send_headers(start_index, end_index, headers))
+
+    @property
+    def peer_ip(self) -> str:
+        return self.transport.get_extra_info("peername")[0]
+
+    def handle_inventory(
+        self,
+        port: int,
+        blocks: List[bytes],
+        transactions: List[bytes] = [],
+        height: Optional[int] = None,
+    ) -> None:
+        inventory = self.server.inventory
+        if len(blocks) + len(transactions) > inventory.max_hashes:
+            self.misbehaved(10)
+            return
+        peer = (self.peer_ip, port)
+        if height is not None:
+            self.server.tips.update(peer, height)
+        block_hashes = [h.hex() for h in blocks]
+        tx_hashes = [h.hex() for h in transactions]
+        for hash in block_hashes + tx_hashes:
+            if hash not in inventory and self.server.knows(hash):
+                inventory.add(hash)
+        wanted_blocks = inventory.wants(block_hashes, peer)
+        relays = self.server.mempool is not None
+        wanted_txs = inventory.wants(tx_hashes, peer) if relays else []
+        if wanted_blocks or wanted_txs:
+            self.reply(Message.get_data(wanted_blocks, wanted_txs))
+
+    def handle_get_data(
+        self, blocks: List[bytes], transactions: List[bytes] = []
+    ) -> None:
+        if len(blocks) + len(transactions) > Inventory.max_hashes:
+            self.misbehaved(10)
+            return
+        for hash in blocks:
+            block = self.blockchain.get_block(hash.hex())
+            if block is not None and self.blockchain.has_bodies(
+                block.index, block.index
+            ):
+                self.reply(Message.send_latest_block(block))
+
+        txs = self.server.mempool.txs
+        found = [txs[h.hex()] for h in transactions if h.hex() in txs]
+        if found:
+            self.reply(Message.send_transactions(found))
+
+    def handle_request_transactions(self) -> None:
+        mempool = self.server.mempool
+        self.reply(Message.send_transactions(mempool.top(self.server.max_relay)))
+
+    def handle_receive_transactions(self, transactions: bytes) -> None:
+        txs = codec.unpack_transactions(transactions)
+        if not self.server.tx_limiter.allow(self.peer_ip, len(txs)):
+            logger.debug(f"Too many transactions from {self.peer_ip}, dropping")
+            self.misbehaved(1)
+            return
+        asyncio.ensure_future(self.server.submit_transactions(txs))
+
+    def handle_request_blockchain(self):
+        with self.blockchain.lock:
+            if not self.blockchain.has_bodies(0, self.blockchain.length - 1):
+                return
+            message = Message.send_blockchain(self.blockchain)
+        self.reply(message)
+
+    def handle_receive_blockchain(self, blockchain: bytes):
+        def connect(blocks: List[Block]) -> bool:
+            return bool(blocks) and self.blockchain.replace(BlockChain(blocks=blocks))
+
+        def done(replaced: bool) -> None:
+            if replaced:
+                self.server.on_new_tip()
+
+        self.validate(blockchain, True, connect, done)
+
+    def handlers(self) -> Dict[Message, Callable]:
+        return {
+            Message.REQUEST_LATEST_BLOCK: self.handle_request_latest_block,
+            Message.RECEIVE_LATEST_BLOCK: self.handle_receive_latest_block,
+            Message.REQUEST_BLOCKCHAIN: self.handle_request_blockchain,
+            Message.RECEIVE_BLOCKCHAIN: self.handle_receive_blockchain,
+            Message.REQUEST_BLOCKS: self.handle_request_blocks,
+            Message.RECEIVE_BLOCKS: self.handle_receive_blocks,
+            Message.REQUEST_HEADERS: self.handle_request_headers,
+            Message.INVENTORY: self.handle_inventory,
+            Message.GET_DATA: self.handle_get_data,
+            Message.REQUEST_TRANSACTIONS: self.handle_request_transactions,
+            Message.RECEIVE_TRANSACTIONS: self.handle_receive_transactions,
+        }
 
     def handle_message(self, msg: bytes):
         try:
             message = msgpack.loads(msg)
             msg_type = Message(message.pop("type"))
             logger.info(f"Handling: {msg_type}")
-            func_mapping: Dict[Message, Callable] = {
-                Message.REQUEST_LATEST_BLOCK: self.handle_request_latest_block,
-                Message.RECEIVE_LATEST_BLOCK: self.handle_receive_latest_block,
-                Message.REQUEST_BLOCKCHAIN: self.handle_request_blockchain,
-                Message.RECEIVE_BLOCKCHAIN: self.handle_receive_blockchain,
-            }
+            func_mapping = self.handlers()
+            if msg_type not in func_mapping:
+                logger.debug(f"Ignoring {msg_type}")
+                return
             func_mapping[msg_type](**message)
         except (UnpackException, KeyError, ValueError) as e:
             logger.error("Unknown message received")
             logger.error(f"{e}")
+            self.misbehaved(10)
+
+    def receive_frames(self, data: bytes):
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            # the frames before the oversized one were sent in good order
+            for frame in e.frames:
+                self.handle_message(frame)
+            logger.error(f"{e}")
+            self.misbehaved(PeerManager.ban_score)
+            self.transport.close()
+            return
+
+        for frame in frames:
+            self.handle_message(frame)
 
     def connection_made(self, transport):
         peername = transport.get_extra_info("peername")
         logger.debug(f"Connecting client {peername}")
         self.transport = transport
+        if self.server.peers.is_banned(peername[0]):
+            transport.close()
 
     def data_received(self, data: bytes):
         logger.debug(f"Data receive from client: {data[:20]!r}")
-        self.handle_message(data)
+        self.receive_frames(data)
 
     def connection_lost(self, exc):
         logger.debug("The client closed the connection")
 
 
 class TCPClientProtocol(TCPProtocol):
-    def __init__(self, server: "P2PServer", data: bytes) -> None:
-        super().__init__(server)
-        self.data = data
-
     def connection_made(self, transport):
         peername = transport.get_extra_info("peername")
         logger.debug(f"Connecting server {peername}")
         self.transport = transport
-        self.transport.write(self.data)
+        self.peer = (peername[0], peername[1])
 
     def data_received(self, data: bytes):
         logger.debug(f"Data receive from server: {data[:20]!r}")
-        self.handle_message(data)
+        self.receive_frames(data)
 
     def connection_lost(self, exc):
         logger.debug("The server closed the connection")
 
 
+class LightProtocol(TCPClientProtocol):
+    """
+    Protocol of a `LightServer`, which has no blocks to serve
+    """
+
+    def __init__(self, server: "LightServer") -> None:
+        self.server = server  # type: ignore
+        self.headers = server.headers
+        self.decoder = FrameDecoder()
+        self.fork: Optional[HeaderForkSearch] = None
+
+    def handlers(self) -> Dict[Message, Callable]:
+        return {
+            Message.RECEIVE_LATEST_BLOCK: self.handle_receive_latest_block,
+            Message.RECEIVE_HEADERS: self.handle_receive_headers,
+            Message.RECEIVE_BLOCKS: self.handle_receive_blocks,
+            Message.INVENTORY: self.handle_inventory,
+        }
+
+    def handle_receive_latest_block(self, block: bytes) -> None:
+        header = codec.unpack_block(block).header
+        latest_header = self.headers.latest_header
+        if not header.is_valid() or not BlockChain.could_follow(header, latest_header):
+            return
+        if self.peer is not None:
+            self.server.tips.update(self.peer, header.index)
+        if self.headers.add_header(header):
+            self.server.inventory.add(header.hash)
+            return
+        if header.index > self.headers.latest_header.index:
+            logger.debug(f"Syncing headers to {header.index}")
+            self.server.sync_headers(header.index)
+
+    def handle_receive_headers(
+        self, start_index: int, end_index: int, headers: bytes
+    ) -> None:
+        if self.peer is not None:
+            self.server.peers.end_request(self.peer, start_index, len(headers))
+        peer_headers = codec.unpack_headers(headers)
+        if self.fork is not None and start_index == self.fork.start:
+            # a page of the peer's chain, asked for when it is on another fork
+            switched = self.fork.receive(peer_headers)
+            if switched is None:
+                self.reply(Message.get_headers(*self.fork.request()))
+                return
+            self.fork = None
+            if switched:
+                self.server.header_sync.reset()
+        elif not self.server.header_sync.receive(start_index, peer_headers):
+            logger.debug("Headers not connecting. Looking for the fork point")
+            self.fork = HeaderForkSearch(self.headers, start_index)
+            self.reply(Message.get_headers(*self.fork.request()))
+        elif not self.server.header_sync.synced:
+            self.server.sync_headers(self.server.header_sync.target_height)
+
+    def handle_receive_blocks(
+        self, start_index: int, end_index: int, blocks: bytes
+    ) -> None:
+        for block in codec.unpack_blocks(blocks):
+            self.server.receive_body(block)
+
+
 class P2PServer(Server):
     protocol_class = UDPProtocal
-
-    def __init__(self, ksize=20, alpha=3, node_id=None, storage=None, mining=True):
+    server_protocol = TCPProtocol
+    client_protocol = TCPClientProtocol
+    max_relay = 1000  # most transactions sent for REQUEST_TRANSACTIONS
+    tx_rate = 100  # transactions accepted per second from one peer
+    tx_burst = 1000
+    download_peers = 4  # fastest peers blocks are downloaded from
+
+    def __init__(
+        self,
+        ksize=20,
+        alpha=3,
+        node_id=None,
+        storage=None,
+        mining=True,
+        workers=None,
+        datadir=None,
+        address=None,
+        snapshot: Optional[Snapshot] = None,
+    ):
         super().__init__(ksize, alpha, node_id, storage)
-        self.mining = mining
-        self.read_blockchain()
+        self.tips = TipSync()
+        self.inventory = Inventory()
+        self.peers = PeerManager()
+        self.pool = ConnectionPool(lambda: self.client_protocol(self), self.peers)
+        self.port: Optional[int] = None
         self.tcp_server = None
         self.sync_loop = None
+        self.trickle_loop = None
+        self.backfill_loop = None
+        self._init_chain(mining, workers, datadir, address, snapshot)
+
+    def _init_chain(self, mining, workers, datadir, address, snapshot) -> None:
+        self.mining = mining
+        self.datadir = datadir
+        self.miner = Miner(workers) if mining else None
+        self.read_blockchain(snapshot)
+        if mining and address is None:
+            address = self.wallet_address() if datadir else self.throwaway_address()
+        self.address = address
+        # block signatures are checked across processes
+        self.verifier = ProcessPoolExecutor(workers)
+        self.blockchain.executor = self.verifier
+        self.block_sync = BlockSync(self.blockchain)
+        self.backfill = Backfill(self.blockchain, snapshot) if snapshot else None
+        self.pipeline: Optional[ValidationPipeline] = ValidationPipeline(
+            self.blockchain, self.verifier
+        )
+        self.mempool: Optional[Mempool] = get_mempool()
+        self.template = BlockTemplate(self.blockchain, self.mempool, address or "")
+        self.trickle = Trickle()
+        self.tx_limiter = RateLimiter(self.tx_rate, self.tx_burst)
 
     def listen(self, port: int, interface: str = "0.0.0.0") -> None:
         logger.info(f"Node {self.node.long_id} listening on {interface}:{port}")
+        self.port = port
 
         loop = asyncio.get_event_loop()
         listen_udp = loop.create_datagram_endpoint(
@@ -192,16 +610,22 @@ class P2PServer(Server):
         )
         self.transport, self.protocol = loop.run_until_complete(listen_udp)
 
-        listen_tcp = loop.create_server(lambda: TCPProtocol(self), interface, port)
+        listen_tcp = loop.create_server(
+            lambda: self.server_protocol(self), interface, port
+        )
         self.tcp_server = loop.run_until_complete(listen_tcp)
 
+        if self.pipeline is not None:
+            self.pipeline.start()
         self.refresh_table()
         self.sync_blockchain()
+        self.trickle_transactions()
+        self.backfill_blocks()
 
     def stop(self):
         super().stop()
 
-        for task in asyncio.Task.all_tasks():
+        for task in asyncio.all_tasks(asyncio.get_event_loop()):
             logger.debug(f"Canceling task: {task}")
             task.cancel()
 
@@ -211,68 +635,325 @@ class P2PServer(Server):
         if self.sync_loop:
             self.sync_loop.cancel()
 
+        if self.trickle_loop:
+            self.trickle_loop.cancel()
+
+        if self.backfill_loop:
+            self.backfill_loop.cancel()
+
+        self.pool.close()
+        self._close_chain()
+
+    def _close_chain(self) -> None:
+        if self.miner:
+            self.miner.shutdown()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.blockchain.close()
+        self.verifier.shutdown(wait=False)
+
     def refresh_table(self) -> None:
         logger.debug("Refreshing routing table")
         asyncio.ensure_future(self._refresh_table())
+        self.pool.health_check()
         loop = asyncio.get_event_loop()
         self.refresh_loop = loop.call_later(10, self.refresh_table)
 
     def get_mempool(self) -> str:
-        return ""
-
-    def read_blockchain(self) -> None:
-        # read from local or init
-        self.blockchain = BlockChain()
+        # block data to mine
+        return self.template.data()
+
+    def read_blockchain(self, snapshot: Optional[Snapshot] = None) -> None:
+        # read from local, a snapshot or init
+        if snapshot is not None:
+            logger.info(f"Starting from snapshot {snapshot.hash} at {snapshot.height}")
+            self.blockchain = snapshot.to_blockchain()
+        elif self.datadir:
+            self.blockchain = BlockChain.load(self.datadir)
+        else:
+            self.blockchain = BlockChain()
+
+    @staticmethod
+    def throwaway_address() -> str:
+        # nowhere to keep the key, rewards cannot be spent once we exit
+        _, address = generate_keypair()
+        logger.warning(
+            f"Mining to throwaway address {address}, "
+            "pass an address or a datadir to keep the rewards"
+        )
+        return address
 
-    async def _mine(self, data: str):
-        # convert sync to async
+    def wallet_address(self) -> str:
+        """
+        Address of the key kept in `datadir`, created on first use.
+        The key is only ever written to that file, readable by its owner.
+        """
+        assert self.datadir is not None
+        os.makedirs(self.datadir, exist_ok=True)
+        path = os.path.join(self.datadir, "wallet.key")
+        if os.path.exists(path):
+            with open(path) as f:
+                return public_key(f.read().strip())
+        key, address = generate_keypair()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(key)
+        logger.info(f"Mining to new address {address}, key saved to {path}")
+        return address
+
+    async def _mine(self, data: str) -> bool:
+        # search off the event loop, and add the block on the pipeline's writer
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.blockchain.mine, data)
+        block = await loop.run_in_executor(
+            None, self.blockchain.generate_next, data, self.miner
+        )
+        if block is None:
+            return False
+        assert self.pipeline is not None
+        return await self.pipeline.run(self.blockchain.add_block, block)
+
+    def on_new_tip(self) -> None:
+        # the current search is stale, restart it on a fresh template
+        if self.miner:
+            self.miner.cancel()
+        self.template.update()
 
     async def mine_blockchain(self) -> None:
         if not self.mining:
             return
+        assert self.miner is not None
 
-        data = self.get_mempool()
         while True:
             start = time.time()
+            self.miner.prepare()
+            self.template.update()
+            tip = self.blockchain.latest_block
+            data = self.get_mempool()
             logger.debug("Start mining...")
             mined = await self._mine(data)
             if mined:
                 logger.debug(
                     f"Mined block after {time.time() - start:.2f}s, broadcasting..."
                 )
-                self.broadcast_message(
-                    Message.send_latest_block(self.blockchain.latest_block)
-                )
+                self.announce_block(self.blockchain.latest_block)
+            elif tip != self.blockchain.latest_block:
+                logger.debug("Received new tip, restarting mining")
             else:
-                logger.debug("Mining block failed, awaiting longest chain")
-                self.broadcast_message(Message.get_blockchain())
+                logger.debug("Mining block failed, polling peers for their tips")
+                self.broadcast_message(Message.get_latest_block())
                 await asyncio.sleep(3)
 
+    @property
+    def tip(self) -> str:
+        return self.blockchain.latest_block.hash
+
     def sync_blockchain(self) -> None:
-        # request latest block
-        self.broadcast_message(Message.get_latest_block())
+        # tips are pushed with INVENTORY, polling only catches what was missed
+        self.tips.tick(self.tip)
+        peers = self.tips.stale(self.peer_addresses())
+        if peers:
+            messages = [Message.get_latest_block()]
+            if self.mempool is not None and not self.mempool:
+                messages.append(Message.get_transactions())
+            data = b"".join(map(pack_message, messages))
+            asyncio.ensure_future(self.pool.send_all(peers, data))
         loop = asyncio.get_event_loop()
-        self.sync_loop = loop.call_later(self.blockchain.interval, self.sync_blockchain)
+        self.sync_loop = loop.call_later(self.tips.next_delay(), self.sync_blockchain)
+
+    def backfill_blocks(self) -> None:
+        """
+        Requests the blocks below the snapshot checkpoint, until all arrived
+        """
+        if self.backfill_loop:
+            self.backfill_loop.cancel()
+        if self.backfill is None or self.backfill.synced:
+            return
+        self.request_ranges(self.backfill.plan(), Message.get_blocks)
+        loop = asyncio.get_event_loop()
+        self.backfill_loop = loop.call_later(
+            Backfill.request_timeout, self.backfill_blocks
+        )
+
+    def sync_blocks(self, peer_height: int) -> None:
+        self.request_ranges(self.block_sync.plan(peer_height), Message.get_blocks)
+
+    def request_ranges(self, ranges: List[Tuple[int, int]], request: Callable) -> None:
+        peers = list(self.peer_addresses())
+        if not peers or not ranges:
+            return
+        # prefer the fastest peers known to have the whole range
+        peers = self.tips.at_least(ranges[-1][1], peers) or peers
+        peers = peers[: self.download_peers]
+
+        # spread the ranges over peers to download in parallel
+        for i, (start, end) in enumerate(ranges):
+            ip, port = peers[i % len(peers)]
+            self.peers.start_request((ip, port), start)
+            data = pack_message(request(start, end))
+            asyncio.ensure_future(self.connect_peer(ip, port, data))
 
     def broadcast_message(self, message: dict) -> None:
-        asyncio.ensure_future(self.broadcast(msgpack.dumps(message)))
+        asyncio.ensure_future(self.broadcast(pack_message(message)))
 
     def get_peers(self) -> List[Node]:
         protocol: KademliaProtocol = self.protocol
-        return protocol.router.find_neighbors(self.node, self.alpha)
+        return protocol.router.find_neighbors(self.node, self.ksize)
 
-    async def connect_peer(self, ip: str, port: int, data: bytes) -> None:
+    def peer_addresses(self) -> List[Address]:
+        """
+        Active set of the best scored peers in the routing table, best first
+        """
+        return self.peers.active({(p.ip, p.port) for p in self.get_peers()})
+
+    def knows(self, hash: str) -> bool:
+        if hash in self.inventory or hash in self.mempool.txs:
+            return True
+        return self.blockchain.get_block(hash) is not None
+
+    async def submit_transactions(self, txs: List[Transaction]) -> None:
+        """
+        `submit_transaction` for each of `txs`, with their signatures checked
+        on the verifier pool first. Those spending unknown or already spent
+        outputs are dropped before that.
+        """
         loop = asyncio.get_event_loop()
-        try:
-            await loop.create_connection(
-                lambda: TCPClientProtocol(self, data), ip, port
+        cache = get_signature_cache()
+        txs = [tx for tx in txs if not self.knows(tx.hash)]
+        with self.blockchain.lock:
+            txs = self.mempool.screen(txs, self.blockchain.utxos)
+        unverified = [
+            [item for item in signed_messages(tx.inputs) if item not in cache]
+            for tx in txs
+        ]
+
+        async def verify(items: list) -> bool:
+            if not items:
+                return True
+            return await loop.run_in_executor(self.verifier, verify_many, items)
+
+        verified = await asyncio.gather(*map(verify, unverified))
+        for tx, items, valid in zip(txs, unverified, verified):
+            if not valid:
+                logger.debug(f"Invalid signature in transaction {tx.hash}")
+                continue
+            for item in items:
+                cache.add(item)
+            self.submit_transaction(tx)
+
+    def submit_transaction(self, tx: Transaction) -> bool:
+        """
+        Adds a transaction to the mempool, relaying it to peers if accepted
+        """
+        with self.blockchain.lock:
+            if not self.mempool.add(tx, utxos=self.blockchain.utxos):
+                return False
+        self.inventory.add(tx.hash)
+        self.template.add(tx)
+        self.trickle.push(
+            tx.hash, self.inventory.announce_to(tx.hash, self.peer_addresses())
+        )
+        return True
+
+    def trickle_transactions(self) -> None:
+        for address, hashes in self.trickle.pop_batches().items():
+            data = pack_message(Message.send_inventory(self.port, transactions=hashes))
+            asyncio.ensure_future(self.connect_peer(*address, data))
+        loop = asyncio.get_event_loop()
+        self.trickle_loop = loop.call_later(
+            self.trickle.next_delay(), self.trickle_transactions
+        )
+
+    def announce_block(self, block: Block) -> None:
+        """
+        Sends the block hash to peers not known to have it, they ask for the
+        block with GET_DATA if they need it
+        """
+        self.inventory.add(block.hash)
+        peers = self.inventory.announce_to(block.hash, self.peer_addresses())
+        if peers:
+            message = Message.send_inventory(
+                self.port, [block.hash], height=block.index
             )
-        except ConnectionRefusedError:
-            logger.debug("Connection refused. Peer may be offline.")
+            data = pack_message(message)
+            asyncio.ensure_future(self.pool.send_all(peers, data))
+
+    async def connect_peer(self, ip: str, port: int, data: bytes) -> None:
+        if not await self.pool.send((ip, port), data):
+            logger.debug("Cannot reach peer. Peer may be offline.")
 
     async def broadcast(self, data: bytes) -> None:
-        peers = {(p.ip, p.port) for p in self.get_peers()}
-        for ip, port in peers:
-            await self.connect_peer(ip, port, data)
+        await self.pool.send_all(self.peer_addresses(), data)
+
+
+class LightServer(P2PServer):
+    """
+    Follows the chain by headers only, so memory does not grow with block data.
+    Block bodies are downloaded on demand with `get_block`.
+    """
+
+    server_protocol = LightProtocol  # type: ignore
+    client_protocol = LightProtocol  # type: ignore
+
+    def __init__(self, ksize=20, alpha=3, node_id=None, storage=None):
+        super().__init__(ksize, alpha, node_id, storage, mining=False)
+
+    def _init_chain(self, mining, workers, datadir, address, snapshot) -> None:
+        self.mining = False
+        self.miner = None
+        self.headers = HeaderChain()
+        self.header_sync = HeaderSync(self.headers)
+        self.backfill = None
+        # block index -> body being downloaded
+        self.bodies: Dict[int, asyncio.Future] = {}
+        self.mempool = None
+        # headers are cheap to check in place
+        self.pipeline = None
+
+    def trickle_transactions(self) -> None:
+        # light nodes do not relay transactions
+        pass
+
+    def _close_chain(self) -> None:
+        pass
+
+    @property
+    def tip(self) -> str:
+        return self.headers.latest_header.hash
+
+    def knows(self, hash: str) -> bool:
+        return hash in self.inventory
+
+    def sync_headers(self, peer_height: int) -> None:
+        self.request_ranges(self.header_sync.plan(peer_height), Message.get_headers)
+
+    async def get_block(self, index: int) -> Optional[Block]:
+        """
+        Downloads the block at `index` and checks it against our header
+        """
+        if self.headers.get(index) is None:
+            return None
+
+        future = self.bodies.get(index)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self.bodies[index] = future
+            self.broadcast_message(Message.get_blocks(index, index))
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), BlockSync.request_timeout
+            )
+        except asyncio.TimeoutError:
+            # no peer answered, the next call asks again
+            if self.bodies.get(index) is future:
+                del self.bodies[index]
+            return None
+
+    def receive_body(self, block: Block) -> None:
+        future = self.bodies.get(block.index)
+        if future is None or future.done():
+            return
+        if self.headers.verify_body(block):
+            del self.bodies[block.index]
+            future.set_result(block)
+        else:
+            logger.debug(f"Block {block.index} does not match our header")
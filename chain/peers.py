@@ -0,0 +1,183 @@
+import time
+from collections import OrderedDict
+from statistics import median
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from chain.connection import Address
+from chain.utils.log import logger
+
+__all__ = ["PeerStats", "PeerManager"]
+
+
+class PeerStats:
+    """
+    How a peer has served us, as moving averages
+    """
+
+    __slots__ = ("latency", "bandwidth", "failures")
+
+    def __init__(self) -> None:
+        self.latency: Optional[float] = None  # seconds
+        self.bandwidth: Optional[float] = None  # bytes per second
+        self.failures = 0  # in a row
+
+    def __repr__(self) -> str:
+        return (
+            f"PeerStats(latency={self.latency}, bandwidth={self.bandwidth}, "
+            f"failures={self.failures})"
+        )
+
+
+def _average(old: Optional[float], new: float, weight: float) -> float:
+    return new if old is None else (1 - weight) * old + weight * new
+
+
+class PeerManager:
+    """
+    Scores peers by latency, bandwidth and failures, so blocks go to an active
+    set of the best `max_active` and are downloaded from the fastest.
+    Peers that misbehave are banned by IP for `ban_time` seconds.
+    """
+
+    max_active = 8
+    max_peers = 1024
+    weight = 0.3  # of a new sample in the moving averages
+    probe_size = 100_000  # bytes, the download a peer is ranked by
+    failure_cost = 10.0
+    max_failure_penalty = 64
+    ban_score = 100
+    ban_time = 3600
+
+    def __init__(self) -> None:
+        self.stats: "OrderedDict[Address, PeerStats]" = OrderedDict()
+        # ip -> misbehavior score
+        self.scores: Dict[str, int] = {}
+        # ip -> ban expiry
+        self.banned: Dict[str, float] = {}
+        # (address, request key) -> request time
+        self.requests: "OrderedDict[Tuple[Address, Hashable], float]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"PeerManager({len(self.stats)} peers, {len(self.banned)} banned)"
+
+    def get(self, address: Address) -> PeerStats:
+        stats = self.stats.get(address)
+        if stats is None:
+            stats = self.stats[address] = PeerStats()
+            if len(self.stats) > self.max_peers:
+                self._evict()
+        else:
+            self.stats.move_to_end(address)
+        return stats
+
+    def _evict(self) -> None:
+        # forget the least recently seen peer in good standing, so a failing
+        # peer cannot come back as new by being pushed out
+        for address, stats in self.stats.items():
+            if not stats.failures:
+                del self.stats[address]
+                return
+        self.stats.popitem(last=False)
+
+    def record_latency(self, address: Address, seconds: float) -> None:
+        stats = self.get(address)
+        stats.latency = _average(stats.latency, seconds, self.weight)
+        stats.failures = 0
+
+    def record_transfer(self, address: Address, size: int, seconds: float) -> None:
+        stats = self.get(address)
+        rate = size / max(seconds, 1e-3)
+        stats.bandwidth = _average(stats.bandwidth, rate, self.weight)
+        stats.failures = 0
+
+    def record_failure(self, address: Address) -> None:
+        self.get(address).failures += 1
+
+    def start_request(
+        self, address: Address, key: Hashable, now: Optional[float] = None
+    ) -> None:
+        self.requests[(address, key)] = time.time() if now is None else now
+        if len(self.requests) > self.max_peers:
+            self.requests.popitem(last=False)
+
+    def end_request(
+        self, address: Address, key: Hashable, size: int, now: Optional[float] = None
+    ) -> None:
+        """
+        Records the round trip and bandwidth of a request sent with `start_request`
+        """
+        started = self.requests.pop((address, key), None)
+        if started is None:
+            return
+        now = time.time() if now is None else now
+        self.record_transfer(address, size, now - started)
+
+    def priors(self) -> Tuple[float, Optional[float]]:
+        """
+        Median latency and bandwidth of measured peers, assumed for peers
+        not measured yet
+        """
+        latencies = [s.latency for s in self.stats.values() if s.latency is not None]
+        bandwidths = [s.bandwidth for s in self.stats.values() if s.bandwidth]
+        return (
+            median(latencies) if latencies else 0.0,
+            median(bandwidths) if bandwidths else None,
+        )
+
+    def cost(
+        self,
+        address: Address,
+        priors: Optional[Tuple[float, Optional[float]]] = None,
+    ) -> float:
+        """
+        Expected seconds to download `probe_size` bytes from the peer, lower
+        is better. What is not measured yet is taken from `priors`, so new
+        peers rank with a typical one.
+        """
+        latency, bandwidth = self.priors() if priors is None else priors
+        stats = self.stats.get(address) or PeerStats()
+        if stats.latency is not None:
+            latency = stats.latency
+        if stats.bandwidth:
+            bandwidth = stats.bandwidth
+        cost = latency
+        if bandwidth:
+            cost += self.probe_size / bandwidth
+        if stats.failures:
+            # peers we failed to reach cost at least `failure_cost`
+            cost = max(cost, self.failure_cost)
+            cost *= min(2 ** (stats.failures - 1), self.max_failure_penalty)
+        return cost
+
+    def rank(self, peers: Iterable[Address]) -> List[Address]:
+        # best first, without banned peers
+        priors = self.priors()
+        return sorted(
+            (p for p in peers if not self.is_banned(p[0])),
+            key=lambda p: self.cost(p, priors),
+        )
+
+    def active(self, peers: Iterable[Address]) -> List[Address]:
+        return self.rank(peers)[: self.max_active]
+
+    def misbehaved(self, ip: str, score: int, now: Optional[float] = None) -> bool:
+        """
+        Adds to the misbehavior score of `ip`, returns True if it is banned
+        """
+        self.scores[ip] = self.scores.get(ip, 0) + score
+        if self.scores[ip] < self.ban_score:
+            return False
+        del self.scores[ip]
+        now = time.time() if now is None else now
+        self.banned[ip] = now + self.ban_time
+        logger.info(f"Banning {ip} for {self.ban_time}s")
+        return True
+
+    def is_banned(self, ip: str, now: Optional[float] = None) -> bool:
+        expiry = self.banned.get(ip)
+        if expiry is None:
+            return False
+        if (time.time() if now is None else now) < expiry:
+            return True
+        del self.banned[ip]
+        return False
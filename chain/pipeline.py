@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from chain import codec
+from chain.block import Block
+from chain.blockchain import BlockChain
+from chain.utils.log import logger
+
+__all__ = ["ValidationPipeline", "decode_blocks"]
+
+
+def decode_blocks(payload: bytes, many: bool) -> Tuple[List[Block], bool]:
+    """
+    Decodes blocks and checks their proof of work, run in a worker process
+    """
+    blocks = codec.unpack_blocks(payload) if many else [codec.unpack_block(payload)]
+    return blocks, all(block.is_valid() for block in blocks)
+
+
+class ValidationPipeline:
+    """
+    Validates incoming blocks without blocking the event loop, in stages:
+
+    1. decoding and proof of work, in parallel on `executor`
+    2. contextual checks and connecting, one message at a time and in arrival
+       order on a single writer thread, which owns every change to the chain.
+       The chain is still read from the event loop, see `BlockChain.lock`.
+
+    Peers stop being read while `high_water` messages are waiting, messages
+    still arriving past `max_waiting` are dropped.
+    """
+
+    high_water = 32
+    low_water = 8
+    max_waiting = 128
+
+    def __init__(
+        self, blockchain: BlockChain, executor: Optional[Executor] = None
+    ) -> None:
+        self.blockchain = blockchain
+        self.executor = executor
+        self.writer = ThreadPoolExecutor(1)
+        self.queue: Optional[asyncio.Queue] = None
+        self.paused: Set[asyncio.BaseTransport] = set()
+        self.task: Optional[asyncio.Future] = None
+
+    def __repr__(self) -> str:
+        waiting = self.queue.qsize() if self.queue else 0
+        return f"ValidationPipeline({waiting} waiting, {len(self.paused)} paused)"
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue(self.max_waiting)
+        self.task = asyncio.ensure_future(self._connect_loop())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+        self.writer.shutdown(wait=False)
+
+    def submit(
+        self,
+        payload: bytes,
+        many: bool,
+        connect: Callable[[List[Block]], Any],
+        done: Optional[Callable[[Any], None]] = None,
+        transport: Optional[asyncio.BaseTransport] = None,
+        reject: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Queues encoded blocks. `connect` runs on the writer thread with the
+        decoded blocks if their proof of work is valid, then `done` runs on
+        the event loop with its result. Otherwise `reject` runs.
+        """
+        assert self.queue is not None, "Pipeline not started"
+        if self.queue.full():
+            # sent before the peer was paused, missing blocks are requested again
+            logger.warning("Too many blocks waiting, dropping")
+            return
+        loop = asyncio.get_event_loop()
+        decoded = loop.run_in_executor(self.executor, decode_blocks, payload, many)
+        self.queue.put_nowait((decoded, connect, done, reject))
+        if transport is not None and self.queue.qsize() >= self.high_water:
+            # backpressure, the peer's writes queue up in its socket
+            transport.pause_reading()  # type: ignore
+            self.paused.add(transport)
+
+    def run(self, func: Callable, *args) -> asyncio.Future:
+        """
+        Runs `func` on the writer thread, after everything queued before
+        """
+        return asyncio.get_event_loop().run_in_executor(self.writer, func, *args)
+
+    def _connect(self, connect: Callable, blocks: List[Block]) -> Any:
+        # proof of work is already checked, do not hash the blocks again
+        for block in blocks:
+            self.blockchain.mark_valid(block)
+        return connect(blocks)
+
+    def _resume(self) -> None:
+        for transport in self.paused:
+            if not transport.is_closing():
+                transport.resume_reading()  # type: ignore
+        self.paused.clear()
+
+    async def _connect_loop(self) -> None:
+        assert self.queue is not None
+        while True:
+            decoded, connect, done, reject = await self.queue.get()
+            if self.paused and self.queue.qsize() <= self.low_water:
+                self._resume()
+            try:
+                blocks, valid = await decoded
+                if not valid:
+                    logger.debug("Dropping blocks with invalid proof of work")
+                    if reject is not None:
+                        reject()
+                    continue
+                result = await self.run(self._connect, connect, blocks)
+                if done is not None:
+                    done(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Validating blocks failed: {e!r}")
@@ -0,0 +1,86 @@
+from typing import Dict, List, Optional
+
+from chain import codec
+from chain.block import BlockHeader
+from chain.blockchain import BlockChain
+from chain.headers import HeaderChain
+from chain.transaction import TxOut
+from chain.utxo import Outpoint, UTXOSet
+
+__all__ = ["Snapshot"]
+
+
+class Snapshot:
+    """
+    Headers up to a checkpoint and the unspent outputs there, enough to
+    validate blocks on top without replaying the chain.
+
+    The hash covers both, so it can be compared with one obtained from a
+    trusted source. The outputs themselves are only proven once the blocks
+    below the checkpoint are backfilled and replayed, see `Backfill`.
+    """
+
+    def __init__(
+        self, headers: List[BlockHeader], outputs: Dict[Outpoint, TxOut]
+    ) -> None:
+        self.headers = headers
+        self.outputs = outputs
+        self._hash: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"Snapshot(height={self.height}, {len(self.outputs)} outputs)"
+
+    @classmethod
+    def from_blockchain(cls, blockchain: BlockChain) -> "Snapshot":
+        headers = [block.header for block in blockchain.blocks]
+        return cls(headers, dict(blockchain.utxos.outputs))
+
+    @property
+    def height(self) -> int:
+        return self.headers[-1].index
+
+    @property
+    def hash(self) -> str:
+        if self._hash is None:
+            self._hash = codec.dump_snapshot(self.headers, self.outputs)
+        return self._hash
+
+    def save(self, path: str) -> str:
+        with open(path, "wb") as f:
+            self._hash = codec.dump_snapshot(self.headers, self.outputs, f)
+        return self._hash
+
+    @classmethod
+    def load(cls, path: str, trusted_hash: Optional[str] = None) -> "Snapshot":
+        """
+        Raises ValueError if the file is corrupt, its hash is not `trusted_hash`
+        or its headers do not form a valid chain
+        """
+        with open(path, "rb") as f:
+            headers, outputs, hash = codec.load_snapshot(f)
+        if trusted_hash is not None and hash != trusted_hash:
+            raise ValueError(f"Snapshot hash {hash} is not {trusted_hash}")
+        snapshot = cls(headers, outputs)
+        snapshot._hash = hash
+        if not snapshot.is_valid_headers():
+            raise ValueError("Invalid snapshot headers")
+        return snapshot
+
+    def is_valid_headers(self) -> bool:
+        if not self.headers:
+            return False
+        genesis = self.headers[0]
+        if genesis.index != 0 or genesis.target != BlockChain._genesis_target:
+            return False
+        if not genesis.is_valid():
+            return False
+        chain = HeaderChain(self.headers[:1])
+        return all(chain.add_header(header) for header in self.headers[1:])
+
+    def utxos(self) -> UTXOSet:
+        utxos = UTXOSet()
+        utxos.outputs = dict(self.outputs)
+        return utxos
+
+    def to_blockchain(self) -> BlockChain:
+        return BlockChain.from_headers(self.headers, self.utxos())
@@ -0,0 +1,167 @@
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from chain import codec
+from chain.block import Block
+
+__all__ = ["BlockStore"]
+
+# block hash, offset and length of the serialized block in the data file
+_record = struct.Struct(">32sQI")
+
+
+class BlockStore:
+    """
+    Append-only block file with a fixed width index, so the block at any height
+    is found with one index read. Both files are read through `mmap`.
+
+    Behaves like the list of blocks `BlockChain` keeps in memory.
+    """
+
+    data_file = "blocks.dat"
+    index_file = "index.dat"
+    sync_every = 16  # fsync after this many appended blocks
+    cache_size = 256
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._data = open(os.path.join(path, self.data_file), "a+b")
+        self._index = open(os.path.join(path, self.index_file), "a+b")
+        self._data_map: Optional[mmap.mmap] = None
+        self._index_map: Optional[mmap.mmap] = None
+        self._length = os.fstat(self._index.fileno()).st_size // _record.size
+        self._data_size = 0
+        if self._length:
+            _, offset, length = self._record(self._length - 1)
+            self._data_size = offset + length
+        # drop anything a crash left behind the last indexed block
+        self._unmap()
+        self._data.truncate(self._data_size)
+        self._index.truncate(self._length * _record.size)
+        self._unsynced = 0
+        self._heights: Optional[Dict[str, int]] = None
+        self._cache: "OrderedDict[int, Block]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"BlockStore({self.path!r})"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Block]:
+        for height in range(self._length):
+            yield self[height]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self._length))]
+
+        height = key + self._length if key < 0 else key
+        if not 0 <= height < self._length:
+            raise IndexError("block height out of range")
+
+        block = self._cache.get(height)
+        if block is None:
+            _, offset, length = self._record(height)
+            data_map = self._map_data(offset + length)
+            block = codec.unpack_block(data_map[offset : offset + length])
+            self._cache_block(height, block)
+        return block
+
+    @staticmethod
+    def _remap(fileobj, current: Optional[mmap.mmap], size: int) -> mmap.mmap:
+        if current is not None and len(current) >= size:
+            return current
+        if current is not None:
+            current.close()
+        fileobj.flush()
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _map_data(self, size: int) -> mmap.mmap:
+        self._data_map = self._remap(self._data, self._data_map, size)
+        return self._data_map
+
+    def _record(self, height: int) -> tuple:
+        start = height * _record.size
+        self._index_map = self._remap(
+            self._index, self._index_map, start + _record.size
+        )
+        return _record.unpack_from(self._index_map, start)
+
+    def _cache_block(self, height: int, block: Block) -> None:
+        self._cache[height] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _unmap(self) -> None:
+        for m in (self._data_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._data_map = self._index_map = None
+
+    def height_of(self, hash: str) -> Optional[int]:
+        """
+        The hash index is only built on the first lookup
+        """
+        if self._heights is None:
+            self._heights = {self._record(h)[0].hex(): h for h in range(self._length)}
+        return self._heights.get(hash)
+
+    def hashes(self) -> List[str]:
+        # read from the index alone
+        return [self._record(h)[0].hex() for h in range(self._length)]
+
+    def append(self, block: Block) -> None:
+        payload = codec.pack_block(block)
+        self._data.write(payload)
+        self._index.write(
+            _record.pack(bytes.fromhex(block.hash), self._data_size, len(payload))
+        )
+        if self._heights is not None:
+            self._heights[block.hash] = self._length
+        self._cache_block(self._length, block)
+        self._data_size += len(payload)
+        self._length += 1
+
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.flush()
+
+    def extend(self, blocks: Iterable[Block]) -> None:
+        for block in blocks:
+            self.append(block)
+
+    def truncate(self, length: int) -> None:
+        """
+        Drop every block from height `length` on, as in `del blocks[length:]`
+        """
+        if length >= self._length:
+            return
+
+        data_size = self._record(length)[1]
+        self._unmap()
+        self.flush()
+        self._data.truncate(data_size)
+        self._index.truncate(length * _record.size)
+        if self._heights is not None:
+            self._heights = {k: v for k, v in self._heights.items() if v < length}
+        for h in [h for h in self._cache if h >= length]:
+            del self._cache[h]
+        self._data_size = data_size
+        self._length = length
+
+    def flush(self) -> None:
+        for f in (self._data, self._index):
+            f.flush()
+            os.fsync(f.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        self.flush()
+        self._unmap()
+        self._data.close()
+        self._index.close()
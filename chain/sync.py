@@ -0,0 +1,350 @@
+import random
+import time
+from collections import OrderedDict
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from chain import Block, BlockChain
+from chain.block import BlockHeader
+from chain.connection import Address
+from chain.headers import HeaderChain
+from chain.snapshot import Snapshot
+from chain.utils.log import logger
+from chain.utxo import UTXOSet
+
+__all__ = [
+    "BlockSync",
+    "HeaderSync",
+    "ForkSearch",
+    "HeaderForkSearch",
+    "TipSync",
+    "Backfill",
+]
+
+
+class BlockSync:
+    """
+    Downloads the blocks between our tip and a peer's height in bounded ranges,
+    buffering out of order ranges until they can be appended to the chain
+    """
+
+    batch_size = 50
+    max_ranges = 16  # most ranges requested or buffered ahead of our tip
+    request_timeout = 10  # seconds before an unanswered range is requested again
+
+    def __init__(self, blockchain: BlockChain) -> None:
+        self.blockchain = blockchain
+        # ranges are received on the pipeline's writer thread
+        self.lock = RLock()
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"BlockSync(tip={self.tip}, target_height={self.target_height})"
+
+    @property
+    def tip(self) -> int:
+        return self.blockchain.latest_block.index
+
+    @property
+    def synced(self) -> bool:
+        return self.tip >= self.target_height
+
+    def plan(self, peer_height: int) -> List[Tuple[int, int]]:
+        """
+        Inclusive index ranges to request, up to `max_ranges` ahead of our tip
+        and skipping ranges already in flight. The rest are planned as these
+        arrive.
+        """
+        with self.lock:
+            self.target_height = max(self.target_height, peer_height)
+            now = time.time()
+            # forget ranges that arrived or timed out
+            self.in_flight = {
+                start: requested_at
+                for start, requested_at in self.in_flight.items()
+                if start > self.tip and now - requested_at < self.request_timeout
+            }
+            last = min(self.target_height, self.horizon)
+            ranges = []
+            for start in range(self.tip + 1, last + 1, self.batch_size):
+                if start in self.in_flight or start in self.pending:
+                    continue
+                end = min(start + self.batch_size - 1, last)
+                self.in_flight[start] = now
+                ranges.append((start, end))
+            return ranges
+
+    def receive(self, start_index: int, blocks: List[Block]) -> bool:
+        """
+        Appends every block that now connects to our tip.
+        Returns False if the range does not connect, which means the peer is on a fork.
+        """
+        with self.lock:
+            self.in_flight.pop(start_index, None)
+            for block in blocks:
+                if self.tip < block.index <= self.horizon:
+                    self.pending[block.index] = block
+
+            while self.tip + 1 in self.pending:
+                block = self.pending.pop(self.tip + 1)
+                if not self.connect(block):
+                    self.reset()
+                    return False
+            return True
+
+    @property
+    def horizon(self) -> int:
+        # highest block requested or buffered
+        return self.tip + self.max_ranges * self.batch_size
+
+    def connect(self, block: Block) -> bool:
+        return self.blockchain.add_block(block)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.target_height = -1
+            self.pending: Dict[int, Union[Block, BlockHeader]] = {}
+            # start index -> request time
+            self.in_flight: Dict[int, float] = {}
+
+
+class HeaderSync(BlockSync):
+    """
+    Same as `BlockSync` for a header chain, headers are small so ranges are larger
+    """
+
+    batch_size = 500
+    max_headers = 2000  # most headers served in one reply
+
+    def __init__(self, headers: HeaderChain) -> None:
+        self.headers = headers
+        self.lock = RLock()
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"HeaderSync(tip={self.tip}, target_height={self.target_height})"
+
+    @property
+    def tip(self) -> int:
+        return self.headers.latest_header.index
+
+    def connect(self, header: BlockHeader) -> bool:
+        return self.headers.add_header(header)
+
+
+class ForkSearch:
+    """
+    Finds where a peer's chain forks from ours, stepping back twice as far
+    each time a page of its blocks does not link to ours, then takes its
+    branch page by page through `BlockChain.accept_block`, or as a whole if
+    it starts from another genesis
+    """
+
+    first_depth = 1
+    page_size = BlockSync.batch_size
+
+    def __init__(self, chain: Union[BlockChain, HeaderChain], start_index: int) -> None:
+        self.chain = chain
+        self.depth = self.first_depth
+        self.start = max(min(start_index, chain.length) - self.depth, 0)
+        self.last: Optional[BlockHeader] = None
+        self.branch: list = []
+
+    def __repr__(self) -> str:
+        located = self.last is not None
+        return f"{type(self).__name__}(start={self.start}, located={located})"
+
+    def request(self) -> Tuple[int, int]:
+        return self.start, self.start + self.page_size - 1
+
+    def receive(self, items: list) -> Optional[bool]:
+        """
+        Returns None while more of the peer's chain is needed, then whether
+        its branch was taken
+        """
+        if not items:
+            return self.finish() if self.last is not None else False
+        if items[0].index != self.start:
+            return False
+        if self.last is not None:
+            if not BlockChain.are_blocks_linked(items[0], self.last):
+                return False
+        elif self.start > 0 and not BlockChain.are_blocks_linked(
+            items[0], self.chain[self.start - 1]
+        ):
+            # forked further back
+            self.depth *= 2
+            self.start = max(self.chain.length - self.depth, 0)
+            return None
+        if not self.extend(items):
+            return False
+        self.last = items[-1]
+        if len(items) == self.page_size:
+            self.start = items[-1].index + 1
+            return None
+        return self.finish()
+
+    def extend(self, blocks: List[Block]) -> bool:
+        if self.branch or blocks[0].index == 0 and blocks[0].hash != self.chain[0].hash:
+            # nothing to hang the blocks off until we have all of them
+            self.branch += blocks
+            return True
+        for block in blocks:
+            if self.chain.has_block(block.index, block.hash):
+                continue
+            if block.hash not in self.chain.side and not self.chain.accept_block(block):
+                return False
+        return True
+
+    def finish(self) -> bool:
+        if not self.branch:
+            return True
+        return self.chain.replace(BlockChain(blocks=self.branch))
+
+
+class HeaderForkSearch(ForkSearch):
+    """
+    `ForkSearch` over headers, switching to the peer's branch at the end if
+    it has more work
+    """
+
+    first_depth = HeaderSync.batch_size
+    page_size = HeaderSync.max_headers
+
+    def extend(self, headers: List[BlockHeader]) -> bool:
+        self.branch += headers
+        return True
+
+    def finish(self) -> bool:
+        start = self.branch[0].index
+        return self.chain.replace(self.chain.headers[:start] + self.branch)
+
+
+class Backfill(BlockSync):
+    """
+    Downloads the blocks below the checkpoint of a chain started from a
+    snapshot, oldest first, and replays them to check the snapshot's outputs
+    once the checkpoint is reached
+    """
+
+    def __init__(self, blockchain: BlockChain, snapshot: Snapshot) -> None:
+        super().__init__(blockchain)
+        self.snapshot = snapshot
+        self.utxos = UTXOSet()
+        # whether the replayed outputs match the snapshot, once known
+        self.verified: Optional[bool] = None
+
+    def __repr__(self) -> str:
+        return f"Backfill(tip={self.tip}, checkpoint={self.checkpoint})"
+
+    @property
+    def tip(self) -> int:
+        return self.blockchain.backfilled - 1
+
+    @property
+    def checkpoint(self) -> int:
+        return self.snapshot.height
+
+    @property
+    def synced(self) -> bool:
+        return self.tip >= self.checkpoint
+
+    def plan(self, peer_height: Optional[int] = None) -> List[Tuple[int, int]]:
+        return super().plan(self.checkpoint)
+
+    def connect(self, block: Block) -> bool:
+        # the body is only put in place once its transactions replay
+        if not self.blockchain.is_next_body(block):
+            return False
+        if not self.utxos.connect(block.hash, block.transactions):
+            logger.error(f"Invalid transactions in backfilled block {block.hash}")
+            return False
+        self.blockchain.fill_body(block)
+        if block.index == self.checkpoint:
+            self.verify()
+        return True
+
+    def verify(self) -> None:
+        replayed = Snapshot(self.snapshot.headers, self.utxos.outputs)
+        self.verified = replayed.hash == self.snapshot.hash
+        if self.verified:
+            logger.info(f"Snapshot at {self.checkpoint} verified by replay")
+            return
+        # blocks on top were checked against outputs that were not there,
+        # so drop them and sync again from the replayed, proven outputs
+        logger.error(
+            f"Snapshot at {self.checkpoint} does not match replay, "
+            "dropping the blocks after it"
+        )
+        self.blockchain.rewind(self.checkpoint, self.utxos)
+
+
+class TipSync:
+    """
+    Tip heights of peers and when we last heard them. Tips are pushed with
+    INVENTORY, so peers are only polled after being silent for `interval`
+    seconds, which doubles up to `max_interval` while nothing changes.
+    """
+
+    min_interval = BlockChain._interval
+    max_interval = 12 * BlockChain._interval
+    max_peers = 256
+
+    def __init__(self) -> None:
+        # address -> (height, last heard)
+        self.peers: "OrderedDict[Address, Tuple[int, float]]" = OrderedDict()
+        self.interval = self.min_interval
+        self.tip: Optional[str] = None
+        self.changed = False
+
+    def __repr__(self) -> str:
+        return f"TipSync({len(self.peers)} peers, interval={self.interval})"
+
+    def height(self, peer: Address) -> Optional[int]:
+        known = self.peers.get(peer)
+        return known[0] if known else None
+
+    def update(self, peer: Address, height: int, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        known, _ = self.peers.pop(peer, (-1, now))
+        if height > known:
+            self.changed = True
+        self.peers[peer] = (max(height, known), now)
+        if len(self.peers) > self.max_peers:
+            self.peers.popitem(last=False)
+
+    def tick(self, tip: str) -> None:
+        """
+        Polls back off while neither our tip nor any peer's height changes
+        """
+        if self.changed or tip != self.tip:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(2 * self.interval, self.max_interval)
+        self.tip = tip
+        self.changed = False
+
+    def stale(
+        self, peers: Iterable[Address], now: Optional[float] = None
+    ) -> List[Address]:
+        """
+        Peers not heard from within `interval`, to be polled
+        """
+        now = time.time() if now is None else now
+        stale = []
+        for peer in peers:
+            known = self.peers.get(peer)
+            if known is None or now - known[1] >= self.interval:
+                stale.append(peer)
+        return stale
+
+    def best_height(self) -> int:
+        return max((height for height, _ in self.peers.values()), default=-1)
+
+    def at_least(self, height: int, peers: Iterable[Address]) -> List[Address]:
+        # peers known to have a block at `height`
+        return [p for p in peers if self.peers.get(p, (-1, 0))[0] >= height]
+
+    def next_delay(self) -> float:
+        # jittered, so nodes do not poll in lockstep
+        return random.uniform(0.5, 1.0) * self.interval
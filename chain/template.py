@@ -0,0 +1,133 @@
+from decimal import Decimal
+from typing import Dict, List, Optional, Set
+
+from chain.blockchain import BlockChain
+from chain.mempool import Mempool
+from chain.transaction import Transaction, TxOut, encode_transactions
+from chain.utxo import Outpoint
+
+__all__ = ["BlockTemplate"]
+
+
+class BlockTemplate:
+    """
+    Transactions of the next block to mine: a coinbase paying the reward plus
+    fees, then the mempool transactions with the highest fee rates that fit in
+    `max_size` bytes, parents before the children spending them.
+
+    Kept up to date as transactions arrive with `add`, and as blocks connect
+    with `update`.
+    """
+
+    max_size = 1024 * 1024  # bytes of transactions in a block
+
+    def __init__(self, blockchain: BlockChain, mempool: Mempool, address: str) -> None:
+        self.blockchain = blockchain
+        self.mempool = mempool
+        self.address = address
+        self.tip = blockchain.latest_block.hash
+        self.clear()
+        self.fill()
+
+    def __repr__(self) -> str:
+        return f"BlockTemplate({len(self.transactions)} txs, fees={self.fees})"
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def __contains__(self, transaction: Transaction) -> bool:
+        return transaction.hash in self.selected
+
+    @property
+    def height(self) -> int:
+        return self.blockchain.latest_block.index + 1
+
+    def clear(self) -> None:
+        self.transactions: List[Transaction] = []
+        self.selected: Set[str] = set()
+        # outputs created and spent by the selected transactions
+        self.created: Dict[Outpoint, TxOut] = {}
+        self.spent: Set[Outpoint] = set()
+        self.size = 0
+        self.fees = Decimal(0)
+
+    def coinbase(self) -> Transaction:
+        amount = Decimal(Transaction._reward) + self.fees
+        return Transaction.coinbase(self.height, self.address, amount)
+
+    def data(self) -> str:
+        return encode_transactions([self.coinbase()] + self.transactions)
+
+    def add(self, transaction: Transaction) -> bool:
+        """
+        Appends a newly pooled transaction if it fits and its inputs are available
+        """
+        with self.blockchain.lock:
+            return self._select(transaction, None)
+
+    def fill(self) -> None:
+        # a child seen before its parent waits for it
+        waiting: Dict[str, List[Transaction]] = {}
+        with self.blockchain.lock:
+            for tx in self.mempool.top():
+                if self.size >= self.max_size:
+                    break
+                self._select(tx, waiting)
+
+    def update(self) -> None:
+        """
+        Follows a new tip. Transactions of blocks unwound by a reorg are
+        pooled again, confirmed and conflicting ones leave the mempool, the
+        rest of the template is kept and topped up.
+        """
+        with self.blockchain.lock:
+            tip = self.blockchain.latest_block.hash
+            if tip == self.tip:
+                return
+
+            for block in self.blockchain.side.branch(self.tip):
+                for tx in block.transactions:
+                    self.mempool.add(tx)
+            for block in self.blockchain.blocks_since(self.tip):
+                self.mempool.trim_txs(block.transactions)
+            self.tip = tip
+
+            kept = [tx for tx in self.transactions if tx in self.mempool]
+            self.clear()
+            for tx in kept:
+                self._select(tx, None)
+            self.fill()
+
+    def _select(
+        self,
+        tx: Transaction,
+        waiting: Optional[Dict[str, List[Transaction]]],
+    ) -> bool:
+        if tx.hash in self.selected or self.size + tx.size > self.max_size:
+            return False
+
+        utxos = self.blockchain.utxos
+        for txin in tx.inputs:
+            outpoint = txin.outpoint
+            if outpoint in self.spent:
+                return False
+            txout = self.created.get(outpoint) or utxos.get(outpoint)
+            if txout is None:
+                if waiting is not None and txin.tx_hash in self.mempool.txs:
+                    waiting.setdefault(txin.tx_hash, []).append(tx)
+                return False
+            if txout.amount != txin.amount:
+                return False
+
+        self.transactions.append(tx)
+        self.selected.add(tx.hash)
+        self.spent.update(txin.outpoint for txin in tx.inputs)
+        for i, txout in enumerate(tx.outputs):
+            self.created[(tx.hash, i)] = txout
+        self.size += tx.size
+        self.fees += tx.fee
+
+        if waiting is not None:
+            for child in waiting.pop(tx.hash, []):
+                self._select(child, waiting)
+        return True
@@ -1,13 +1,35 @@
+import json
+from concurrent.futures import Executor
 from decimal import Decimal
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 
 from chain import Hash
 from chain.utils import elliptic
+from chain.utils.hexstr import HexStr, compact, expand
 
-__all__ = ["TxIn", "TxOut", "Transaction", "TX_REGULAR", "TX_COINBASE"]
+__all__ = [
+    "TxIn",
+    "TxOut",
+    "Transaction",
+    "TX_REGULAR",
+    "TX_COINBASE",
+    "encode_transactions",
+    "decode_transactions",
+    "verify_inputs",
+    "signed_messages",
+]
 
 
 class TxIn:
+    __slots__ = (
+        "tx_index",
+        "_tx_hash",
+        "amount",
+        "pubkey",
+        "_signature",
+        "_hash",
+    )
+
     def __init__(
         self,
         tx_index: int,
@@ -17,16 +39,16 @@ class TxIn:
         signature: str = "",
     ) -> None:
         self.tx_index = tx_index
-        self.tx_hash = tx_hash
+        self._tx_hash: HexStr = compact(tx_hash)
         self.amount = amount
         self.pubkey = pubkey
         self._signature = signature
-        self._hash = self.calculate_hash()
+        self._hash = Hash(self._hash_preimage()).digest()
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, TxIn):
             return False
-        return self.hash == other.hash
+        return self._hash == other._hash
 
     def __repr__(self) -> str:
         return "TxIn({}, {}, {}, {}, {})".format(
@@ -38,7 +60,11 @@ class TxIn:
         )
 
     def __hash__(self) -> int:
-        return int(self.hash, 16)
+        return int.from_bytes(self._hash, "big")
+
+    @property
+    def tx_hash(self) -> str:
+        return expand(self._tx_hash)
 
     @property
     def signature(self) -> str:
@@ -46,7 +72,12 @@ class TxIn:
 
     @property
     def hash(self) -> str:
-        return self._hash
+        return self._hash.hex()
+
+    @property
+    def outpoint(self) -> Tuple[str, int]:
+        # the output this input spends
+        return self.tx_hash, self.tx_index
 
     @property
     def valid(self) -> bool:
@@ -61,9 +92,11 @@ class TxIn:
             signature=self.signature,
         )
 
+    def _hash_preimage(self) -> bytes:
+        return f"{self.tx_index}{self.tx_hash}{self.amount}{self.pubkey}".encode()
+
     def calculate_hash(self) -> str:
-        s: bytes = f"{self.tx_index}{self.tx_hash}{self.amount}{self.pubkey}".encode()
-        return Hash(s).hexdigest()
+        return Hash(self._hash_preimage()).hexdigest()
 
     def sign(self, key: str) -> str:
         self._signature = elliptic.sign(key, self.hash)
@@ -71,10 +104,16 @@ class TxIn:
 
     def verify(self, quiet=False) -> bool:
         computed_hash = self.calculate_hash()
+        signed = (self.pubkey, self.signature, computed_hash)
+        cache = elliptic.get_signature_cache()
+        if signed in cache:
+            return True
+
         try:
             verified = elliptic.verify(self.pubkey, self.signature, computed_hash)
             if not verified:
                 raise ValueError("Tx input cannot be verified")
+            cache.add(signed)
         except Exception as e:
             verified = False
             if not quiet:
@@ -89,6 +128,8 @@ class TxIn:
 
 
 class TxOut:
+    __slots__ = ("_amount", "_address")
+
     def __init__(self, amount: Decimal, address: str) -> None:
         self._amount = amount
         self._address = address
@@ -129,6 +170,8 @@ ALL_TX_TYPES = [TX_REGULAR, TX_COINBASE]
 
 class Transaction:
 
+    __slots__ = ("_type", "_inputs", "_outputs", "_hash", "_size")
+
     _reward = 128
 
     def __init__(
@@ -138,12 +181,13 @@ class Transaction:
         assert self._type in ALL_TX_TYPES
         self._inputs = inputs
         self._outputs = outputs
-        self._hash = self.calculate_hash()
+        self._hash = Hash(self._hash_preimage()).digest()
+        self._size: Optional[int] = None
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, Transaction):
             return False
-        return self.hash == other.hash
+        return self._hash == other._hash
 
     def __repr__(self) -> str:
         return (
@@ -151,7 +195,13 @@ class Transaction:
         )
 
     def __hash__(self) -> int:
-        return int(self.hash, 16)
+        return int.from_bytes(self._hash, "big")
+
+    @classmethod
+    def coinbase(cls, height: int, address: str, amount: Decimal) -> "Transaction":
+        # an input holding the block height keeps every coinbase hash unique
+        txin = TxIn(height, "0" * 64, Decimal(0), "")
+        return cls(TX_COINBASE, [txin], [TxOut(amount, address)])
 
     @property
     def reward(self):
@@ -170,8 +220,15 @@ class Transaction:
         return self._outputs
 
     @property
-    def hash(self):
-        return self._hash
+    def hash(self) -> str:
+        return self._hash.hex()
+
+    @property
+    def size(self) -> int:
+        # bytes taken in block data
+        if self._size is None:
+            self._size = len(encode_transactions([self])) - 2
+        return self._size
 
     @property
     def total_input(self) -> Decimal:
@@ -195,7 +252,7 @@ class Transaction:
         if not self.has_enough_balance:
             return False
 
-        return all([txin.valid for txin in self.inputs])
+        return verify_inputs(self.inputs)
 
     def has_same_inputs(self, other: "Transaction") -> bool:
         for our_in in self.inputs:
@@ -211,12 +268,45 @@ class Transaction:
             outputs=[txin.serialize() for txin in self.outputs],
         )
 
+    def _hash_preimage(self) -> bytes:
+        return f"{self.type}{self.inputs}{self.outputs}".encode()
+
     def calculate_hash(self) -> str:
-        s: bytes = f"{self.type}{self.inputs}{self.outputs}".encode()
-        return Hash(s).hexdigest()
+        return Hash(self._hash_preimage()).hexdigest()
 
     @staticmethod
     def deserialize(other: dict) -> "Transaction":
         inputs = [TxIn.deserialize(txin) for txin in other["inputs"]]
         outputs = [TxOut.deserialize(txout) for txout in other["outputs"]]
         return Transaction(other["type"], inputs, outputs)
+
+
+def verify_inputs(inputs: Iterable[TxIn], executor: Optional[Executor] = None) -> bool:
+    """
+    Verifies the signatures of many inputs at once, e.g. of a whole block.
+    Signatures verified before, e.g. on mempool admission, are not checked again.
+    """
+    items = signed_messages(inputs)
+    return elliptic.verify_batch(items, executor, cache=elliptic.get_signature_cache())
+
+
+def signed_messages(inputs: Iterable[TxIn]) -> List[elliptic.SignedMessage]:
+    # what the signature of each input must cover
+    return [(txin.pubkey, txin.signature, txin.calculate_hash()) for txin in inputs]
+
+
+def encode_transactions(transactions: List[Transaction]) -> str:
+    return json.dumps([tx.serialize() for tx in transactions], separators=(",", ":"))
+
+
+def decode_transactions(data: str) -> List[Transaction]:
+    """
+    Block data that is not a transaction list, e.g. the genesis block's, has none
+    """
+    try:
+        serialized = json.loads(data)
+        if not isinstance(serialized, list):
+            return []
+        return [Transaction.deserialize(tx) for tx in serialized]
+    except (ValueError, KeyError, TypeError, AssertionError):
+        return []
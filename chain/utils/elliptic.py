@@ -1,10 +1,24 @@
 import codecs
-from typing import Tuple
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from coincurve.utils import get_valid_secret
 from eth_keys import keys
 
-__all__ = ["generate_keypair", "sign", "verify"]
+__all__ = [
+    "generate_keypair",
+    "public_key",
+    "sign",
+    "verify",
+    "verify_many",
+    "verify_batch",
+    "SignatureCache",
+    "get_signature_cache",
+]
+
+# (public key, signature, message)
+SignedMessage = Tuple[str, str, str]
 
 
 def remove_0x(s: str) -> str:
@@ -22,6 +36,10 @@ def generate_keypair() -> Tuple[str, str]:
     return k.to_hex(), k.public_key.to_hex()
 
 
+def public_key(priv_key: str) -> str:
+    return keys.PrivateKey(decode_hex(priv_key)).public_key.to_hex()
+
+
 def sign(priv_key: str, msg: str) -> str:
     prv = keys.PrivateKey(decode_hex(priv_key))
     return prv.sign_msg(msg.encode()).to_hex()
@@ -39,6 +57,122 @@ def verify(pub_key: str, sig: str, msg: str) -> bool:
     return pub.verify_msg(msg.encode(), signature)
 
 
+def verify_many(items: Iterable[SignedMessage]) -> bool:
+    """
+    True if every signature is valid, stopping at the first invalid one.
+    Each distinct public key is decoded only once.
+
+    >>> pri, pub = generate_keypair()
+    >>> verify_many([(pub, sign(pri, m), m) for m in ("a", "b")])
+    True
+    >>> verify_many([(pub, sign(pri, "a"), "a"), (pub, sign(pri, "a"), "b")])
+    False
+    """
+    pubs: Dict[str, keys.PublicKey] = {}
+    try:
+        for pub_key, sig, msg in items:
+            pub = pubs.get(pub_key)
+            if pub is None:
+                pub = pubs[pub_key] = keys.PublicKey(decode_hex(pub_key))
+            if not pub.verify_msg(msg.encode(), keys.Signature(decode_hex(sig))):
+                return False
+    except Exception:
+        return False
+    return True
+
+
+class SignatureCache:
+    """
+    Bounded LRU set of signatures already verified as valid.
+    Messages should be short, like transaction hashes.
+
+    >>> cache = SignatureCache(maxsize=1)
+    >>> cache.add(("pub", "sig", "msg"))
+    >>> ("pub", "sig", "msg") in cache, ("pub", "sig", "other") in cache
+    (True, False)
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+
+    def __init__(self, maxsize: int = 100000) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[SignedMessage, None]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"SignatureCache(maxsize={self.maxsize})"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, item: SignedMessage) -> bool:
+        if item in self._entries:
+            self._entries.move_to_end(item)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, item: SignedMessage) -> None:
+        self._entries[item] = None
+        self._entries.move_to_end(item)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+
+_signature_cache = SignatureCache()
+
+
+def get_signature_cache() -> SignatureCache:
+    return _signature_cache
+
+
+def verify_batch(
+    items: List[SignedMessage],
+    executor: Optional[Executor] = None,
+    chunk_size: int = 64,
+    cache: Optional[SignatureCache] = None,
+) -> bool:
+    """
+    `verify_many` split into chunks across `executor`, e.g. a process pool.
+    Pending chunks are cancelled as soon as one of them fails.
+    Signatures found in `cache` are skipped, and valid ones are added to it.
+    """
+    if cache is not None:
+        items = [item for item in items if item not in cache]
+        verified = _verify_batch(items, executor, chunk_size)
+        if verified:
+            for item in items:
+                cache.add(item)
+        return verified
+
+    return _verify_batch(items, executor, chunk_size)
+
+
+def _verify_batch(
+    items: List[SignedMessage], executor: Optional[Executor], chunk_size: int
+) -> bool:
+    if executor is None or len(items) <= chunk_size:
+        return verify_many(items)
+
+    pending = {
+        executor.submit(verify_many, items[i : i + chunk_size])
+        for i in range(0, len(items), chunk_size)
+    }
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        if not all(f.result() for f in done):
+            for f in pending:
+                f.cancel()
+            return False
+    return True
+
+
 if __name__ == "__main__":
     import doctest
 
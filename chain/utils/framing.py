@@ -0,0 +1,76 @@
+import struct
+from typing import List
+
+__all__ = ["MAX_FRAME_SIZE", "FrameTooLarge", "FrameDecoder", "encode_frame"]
+
+MAX_FRAME_SIZE = 32 * 1024 * 1024  # 32 MB
+
+_header = struct.Struct(">I")
+
+
+class FrameTooLarge(ValueError):
+    """
+    Raised for a length prefix over the limit. The complete frames received
+    before it are in `frames`.
+    """
+
+    def __init__(self, message: str, frames: List[bytes] = []) -> None:
+        super().__init__(message)
+        self.frames = frames
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    >>> encode_frame(b"abc")
+    b'\\x00\\x00\\x00\\x03abc'
+    """
+    return _header.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Streaming decoder of length prefixed frames, keeping partial frames buffered
+
+    >>> decoder = FrameDecoder()
+    >>> decoder.feed(encode_frame(b"abc") + encode_frame(b"de")[:3])
+    [b'abc']
+    >>> decoder.feed(encode_frame(b"de")[3:])
+    [b'de']
+    >>> try:
+    ...     FrameDecoder(max_size=8).feed(encode_frame(b"abc") + encode_frame(b"c" * 9))
+    ... except FrameTooLarge as e:
+    ...     e.frames
+    [b'abc']
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE) -> None:
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= _header.size:
+            (size,) = _header.unpack_from(self.buffer, offset)
+            if size > self.max_size:
+                # refuse before buffering the body
+                self.buffer.clear()
+                raise FrameTooLarge(
+                    f"Frame of {size} bytes exceeds {self.max_size}", frames
+                )
+
+            end = offset + _header.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append(bytes(self.buffer[offset + _header.size : end]))
+            offset = end
+
+        del self.buffer[:offset]
+        return frames
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
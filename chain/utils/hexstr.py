@@ -0,0 +1,44 @@
+from typing import Union
+
+__all__ = ["HexStr", "is_hex", "compact", "expand"]
+
+# a hex string, stored as raw bytes when that round-trips exactly
+HexStr = Union[bytes, str]
+
+_HEX_CHARS = frozenset("0123456789abcdef")
+
+
+def is_hex(s: str) -> bool:
+    """
+    Lowercase hex digits only, of any length
+
+    >>> is_hex("00ff"), is_hex("0xff"), is_hex("FF"), is_hex("")
+    (True, False, False, True)
+    """
+    return _HEX_CHARS.issuperset(s)
+
+
+def compact(s: str) -> HexStr:
+    """
+    >>> compact("ab" * 32) == bytes([0xab] * 32)
+    True
+    >>> compact("0"), compact("0xab")
+    ('0', '0xab')
+    """
+    if len(s) % 2 == 0 and is_hex(s):
+        return bytes.fromhex(s)
+    return s
+
+
+def expand(v: HexStr) -> str:
+    """
+    >>> expand(compact("00ff")), expand("0")
+    ('00ff', '0')
+    """
+    return v if isinstance(v, str) else v.hex()
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from concurrent.futures import Executor
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from chain.transaction import TX_COINBASE, Transaction, TxIn, TxOut, verify_inputs
+
+__all__ = ["Outpoint", "UTXOSet"]
+
+# (tx_hash, tx_index) of a transaction output
+Outpoint = Tuple[str, int]
+
+
+class UTXOSet:
+    """
+    Unspent transaction outputs, updated as blocks connect and disconnect.
+    Spent outputs of recent blocks are kept as undo data for reorgs.
+    """
+
+    max_undo = 1000  # deepest reorg that can be unwound
+
+    def __init__(self) -> None:
+        self.outputs: Dict[Outpoint, TxOut] = {}
+        # block hash -> outputs spent by the block
+        self.undo: "OrderedDict[str, List[Tuple[Outpoint, TxOut]]]" = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"UTXOSet({len(self)} outputs)"
+
+    def __len__(self) -> int:
+        return len(self.outputs)
+
+    def __contains__(self, outpoint: Outpoint) -> bool:
+        return outpoint in self.outputs
+
+    def get(self, outpoint: Outpoint) -> Optional[TxOut]:
+        return self.outputs.get(outpoint)
+
+    def get_many(self, outpoints: Iterable[Outpoint]) -> List[Optional[TxOut]]:
+        get = self.outputs.get
+        return [get(o) for o in outpoints]
+
+    def validate_transaction(self, tx: Transaction) -> bool:
+        """
+        Inputs must be unspent and claim the amounts they actually hold
+        """
+        if tx.type == TX_COINBASE:
+            return True
+        outputs = self.get_many(txin.outpoint for txin in tx.inputs)
+        for txin, txout in zip(tx.inputs, outputs):
+            if txout is None or txout.amount != txin.amount:
+                return False
+        return tx.valid
+
+    def validate_block(
+        self, transactions: List[Transaction], executor: Optional[Executor] = None
+    ) -> bool:
+        coinbases = [tx for tx in transactions if tx.type == TX_COINBASE]
+        if len(coinbases) > 1 or (coinbases and transactions[0] is not coinbases[0]):
+            return False
+
+        # outputs created earlier in the same block can be spent by later txs
+        created: Dict[Outpoint, TxOut] = {}
+        spent = set()
+        inputs: List[TxIn] = []
+        fees = Decimal(0)
+        for tx in transactions:
+            if tx.type != TX_COINBASE:
+                for txin in tx.inputs:
+                    outpoint = txin.outpoint
+                    txout = created.get(outpoint) or self.outputs.get(outpoint)
+                    if outpoint in spent or txout is None:
+                        return False
+                    if txout.amount != txin.amount:
+                        return False
+                    spent.add(outpoint)
+                if not tx.has_enough_balance:
+                    return False
+                inputs.extend(tx.inputs)
+                fees += tx.fee
+            for i, txout in enumerate(tx.outputs):
+                created[(tx.hash, i)] = txout
+
+        if coinbases and coinbases[0].total_output > coinbases[0].reward + fees:
+            return False
+
+        # signatures last, they are the most expensive check
+        return verify_inputs(inputs, executor)
+
+    def connect(
+        self,
+        block_hash: str,
+        transactions: List[Transaction],
+        executor: Optional[Executor] = None,
+    ) -> bool:
+        if not self.validate_block(transactions, executor):
+            return False
+        self.apply(block_hash, transactions)
+        return True
+
+    def apply(self, block_hash: str, transactions: List[Transaction]) -> None:
+        """
+        Spends and adds the outputs of a block already checked by `validate_block`
+        """
+        undo = []
+        created = set()
+        for tx in transactions:
+            if tx.type != TX_COINBASE:
+                for txin in tx.inputs:
+                    outpoint = txin.outpoint
+                    txout = self.outputs.pop(outpoint)
+                    if outpoint not in created:
+                        undo.append((outpoint, txout))
+            for i, txout in enumerate(tx.outputs):
+                self.outputs[(tx.hash, i)] = txout
+                created.add((tx.hash, i))
+
+        self.undo[block_hash] = undo
+        if len(self.undo) > self.max_undo:
+            self.undo.popitem(last=False)
+
+    def can_disconnect(self, block_hash: str) -> bool:
+        return block_hash in self.undo
+
+    def disconnect(self, block_hash: str, transactions: List[Transaction]) -> None:
+        undo = self.undo.pop(block_hash)
+        for tx in transactions:
+            for i in range(len(tx.outputs)):
+                self.outputs.pop((tx.hash, i), None)
+        for outpoint, txout in undo:
+            self.outputs[outpoint] = txout
@@ -1,6 +1,25 @@
+import os
+from decimal import Decimal
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from chain import Block, BlockChain
+from chain import Block, BlockChain, codec
+from chain.block import BlockHeader
+from chain.headers import HeaderChain
+from chain.miner import Miner
+from chain.snapshot import Snapshot
+from chain.storage import BlockStore
+from chain.sync import (
+    Backfill,
+    BlockSync,
+    ForkSearch,
+    HeaderForkSearch,
+    HeaderSync,
+    TipSync,
+)
+from chain.transaction import Transaction, TxOut, encode_transactions
+from chain.utxo import UTXOSet
 
 from . import TestCase
 
@@ -13,10 +32,40 @@ class TestBlockChain(TestCase):
         hash = Block.calculate_hash(*args, nonce, target)
         b = Block(*args, nonce=nonce, target=target, hash=hash)
         self.assertSerializable(Block, b, globals())
+        self.assertEqual(codec.unpack_block(codec.pack_block(b)), b)
+        self.assertEqual(b.__hash__(), int(hash, 16))
+        with self.assertRaises(AttributeError):
+            b.nonce = 1
         self.assertTrue(b.is_valid())
+        # blocks encoded before the merkle root was added still decode
+        self.assertEqual(codec.unpack_block(b"\x01" + codec.pack_block(b)[1:-5]), b)
         b = Block(*args, nonce=nonce, target=target, hash="aaa")
         self.assertFalse(b.is_valid())
 
+        # with a merkle root the hash covers the root, and the root the data
+        root = Block.calculate_merkle_root("test")
+        hash = Block.calculate_hash(*args[:3], root, nonce, target)
+        b = Block(*args, nonce, target, hash, merkle_root=root)
+        self.assertTrue(b.is_valid())
+        self.assertSerializable(Block, b, globals())
+        self.assertEqual(codec.unpack_block(codec.pack_block(b)), b)
+        b = Block(*args[:3], "tampered", nonce, target, hash, merkle_root=root)
+        self.assertFalse(b.is_valid())
+        # nor can its root pose as the data of a legacy block
+        stripped = Block(*args[:3], root, nonce, target, hash)
+        self.assertEqual(stripped.hash, b.hash)
+        self.assertFalse(stripped.is_valid())
+        legacy = (1, *args[1:])
+        hash = Block.calculate_hash(*legacy, nonce, target)
+        self.assertFalse(Block(*legacy, nonce, target, hash).is_valid())
+
+        # the midstate search must agree with the plain header hash
+        target = "00ff" + "f" * 60
+        nonce, hash = Block.search_nonce(*args, target, start=1, step=3)
+        self.assertEqual(nonce % 3, 1)
+        self.assertEqual(hash, Block.calculate_hash(*args, nonce, target))
+        self.assertTrue(Block.validate_difficulty(hash, target))
+
     def test_blockchain(self):
         bc = BlockChain()
         blocks_to_mine = 5
@@ -24,6 +73,11 @@ class TestBlockChain(TestCase):
             bc.mine("data")
 
         self.assertSerializable(BlockChain, bc, globals())
+        packed = codec.pack_blocks(bc.blocks)
+        self.assertEqual(codec.unpack_blocks(packed), bc.blocks)
+        self.assertLess(len(packed), len(str(bc.serialize())) / 2)
+        with self.assertRaises(ValueError):
+            codec.unpack_blocks(packed[:-1])
 
         self.assertTrue(bc.validate_blocks(0, 1))
         self.assertTrue(bc.validate_blocks(1, 3))
@@ -50,3 +104,378 @@ class TestBlockChain(TestCase):
 
         self.assertIs(bc1.blocks, bc.blocks)
         self.assertEqual(bc, bc1)
+
+    def test_fork(self):
+        bc = BlockChain()
+        bc.mine("shared")
+        other = BlockChain(bc.blocks[:])
+        other.mine("theirs")
+        other.mine("theirs")
+        bc.mine("ours")
+        shared = bc[1]
+
+        self.assertEqual(bc.fork_point(other), 1)
+        self.assertEqual(bc.fork_point(BlockChain()), -1)
+        self.assertTrue(bc.validate_fork(other, 1))
+        self.assertTrue(bc.replace(other))
+        self.assertIs(bc[1], shared)
+        self.assertEqual(bc, other)
+        self.assertTrue(bc.is_valid_chain())
+
+        # a tampered block after the fork point is rejected
+        other.mine("theirs")
+        other.mine("theirs")
+        tampered = other[-2]
+        other.blocks[-2] = Block(**{**tampered.serialize(), "data": "forged"})
+        self.assertFalse(bc.replace(other))
+
+        # our unwound block is kept, and extending it past their work switches back
+        ours = bc.side.tips()[0]
+        self.assertEqual(ours.data, "ours")
+        theirs = bc[2]
+        branch = BlockChain(bc[:2] + [ours])
+        branch.mine("ours")
+        branch.mine("ours")
+        self.assertTrue(bc.accept_block(branch[3]))
+        self.assertEqual(bc.latest_block.index, 3)
+        self.assertNotEqual(bc.latest_block, branch[3])  # equal work, no switch
+        skipped = BlockChain.proof_of_work(5, branch[3].hash, "ours", branch[3].target)
+        self.assertFalse(bc.accept_block(skipped))
+        self.assertNotIn(skipped.hash, bc.side)
+        self.assertTrue(bc.accept_block(branch[4]))
+        self.assertEqual(bc, branch)
+        self.assertEqual(bc.chainwork, branch.chainwork)
+        self.assertIn(theirs.hash, bc.side)
+        self.assertIs(bc.get_block(theirs.hash), theirs)
+        self.assertIs(bc.get_block(branch[4].hash), bc[4])
+
+        # blocks already on our chain are not taken for a branch
+        side = len(bc.side)
+        self.assertFalse(bc.accept_block(bc.latest_block))
+        self.assertFalse(bc.accept_block(bc[1]))
+        self.assertEqual(len(bc.side), side)
+
+        # the most work wins, not the most blocks, and easier blocks than
+        # expected are rejected
+        easy = BlockChain(bc[:1])
+        for i in range(3):
+            easy.blocks.append(
+                BlockChain.proof_of_work(i + 1, easy[-1].hash, "easy", "0f" + "f" * 62)
+            )
+        hard = BlockChain(bc[:2])
+        self.assertFalse(hard.replace(easy))
+        self.assertTrue(easy.replace(hard))
+        self.assertEqual(easy, hard)
+
+    def test_retarget(self):
+        expected = BlockChain._retarget_blocks * BlockChain._interval
+        target = 2**255 - 1
+        # integer math keeps every bit of a 256 bit target
+        self.assertEqual(BlockChain.next_target(target, expected), target)
+        self.assertEqual(
+            BlockChain.next_target(target, expected + 1),
+            target * (expected + 1) // expected,
+        )
+        self.assertEqual(BlockChain.next_target(target, 0), target // 4)
+        self.assertEqual(BlockChain.next_target(target, expected * 10), 2**256 - 1)
+
+        timestamps = [i * 4 for i in range(10)]
+        self.assertEqual(
+            BlockChain.target_after(10, target, timestamps.__getitem__),
+            target * 36 // expected,
+        )
+        self.assertEqual(
+            BlockChain.target_after(9, target, timestamps.__getitem__), target
+        )
+
+        # blocks must meet the target expected at their height
+        bc = BlockChain()
+        bc.mine("data")
+        self.assertEqual(bc.expected_target(2), bc[1].target)
+        self.assertEqual(bc.retarget(), bc.expected_target(2))
+        easy = BlockChain.proof_of_work(2, bc[1].hash, "easy", "0f" + "f" * 62)
+        self.assertFalse(bc.add_block(easy))
+        self.assertFalse(bc.accept_block(easy))
+        self.assertTrue(bc.is_valid_chain())
+
+        # heights ahead are only trusted with a target the chain could retarget to
+        self.assertFalse(BlockChain.could_follow(easy, bc[1]))
+        far = Block(**{**easy.serialize(), "index": 10**9})
+        self.assertTrue(BlockChain.could_follow(far, bc[1]))
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            bc = BlockChain.load(path)
+            self.assertIsInstance(bc.blocks, BlockStore)
+            bc.mine("data")
+            bc.mine("data")
+            other = BlockChain(bc[:2])
+            other.mine("other data")
+            other.mine("other data")
+            bc.close()
+
+            bc = BlockChain.load(path)
+            self.assertEqual(len(bc), 3)
+            self.assertTrue(bc.is_valid_chain())
+            self.assertEqual(bc.blocks.height_of(bc[1].hash), 1)
+
+            # a reorg rewrites the store from the fork point
+            self.assertTrue(bc.replace(other))
+            self.assertEqual(bc.blocks.height_of(other[3].hash), 3)
+            bc.close()
+            self.assertEqual(BlockChain.load(path), other)
+
+            # the UTXO set and caches are read back, blocks stored after they
+            # were saved are replayed, and a corrupt state is rebuilt
+            bc = BlockChain.load(path)
+            coinbase = Transaction.coinbase(4, "aa", Decimal(128))
+            bc.mine(encode_transactions([coinbase]))
+            bc.blocks.close()
+            state = os.path.join(path, BlockChain.state_file)
+            for restored in (True, False):
+                bc = BlockChain.load(path)
+                self.assertEqual(bc._utxos is not None, restored)
+                replayed = BlockChain(list(bc.blocks))
+                self.assertEqual(bc.utxos.outputs, replayed.utxos.outputs)
+                self.assertEqual(bc.utxos.undo, replayed.utxos.undo)
+                self.assertEqual(bc.expected_target(5), replayed.expected_target(5))
+                self.assertEqual(bc.get_block(bc[4].hash), bc[4])
+                bc.close()
+                with open(state, "r+b") as f:
+                    f.truncate(100)
+
+    def test_sync(self):
+        bc = BlockChain()
+        for i in range(3):
+            bc.mine("data")
+
+        behind = BlockChain(bc.blocks[:1])
+        sync = BlockSync(behind)
+        sync.batch_size = 2
+        self.assertEqual(sync.plan(3), [(1, 2), (3, 3)])
+        self.assertEqual(sync.plan(3), [])  # already in flight
+
+        # out of order ranges are buffered until they connect
+        self.assertTrue(sync.receive(3, bc[3:4]))
+        self.assertEqual(behind.length, 1)
+        self.assertTrue(sync.receive(1, bc[1:3]))
+        self.assertEqual(behind, bc)
+        self.assertTrue(sync.synced)
+
+        # a far away height is requested a window at a time
+        sync.max_ranges = 1
+        self.assertEqual(sync.plan(10**9), [(4, 5)])
+        self.assertEqual(sync.plan(10**9), [])
+        sync.in_flight[4] -= sync.request_timeout
+        self.assertEqual(sync.plan(10**9), [(4, 5)])
+        # blocks past the window are not buffered
+        self.assertTrue(sync.receive(6, [Block(**{**bc[1].serialize(), "index": 6})]))
+        self.assertEqual(sync.pending, {})
+
+        # blocks from another fork do not connect
+        sync = BlockSync(BlockChain())
+        self.assertFalse(sync.receive(1, bc[1:2]))
+        self.assertEqual(sync.pending, {})
+
+    def test_tip_sync(self):
+        tips = TipSync()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        tips.tick("tip")
+        self.assertEqual(tips.stale([a, b], now=0), [a, b])
+
+        # peers heard from recently are not polled
+        tips.update(a, 3, now=0)
+        self.assertEqual(tips.stale([a, b], now=1), [b])
+        self.assertEqual(tips.at_least(3, [a, b]), [a])
+        self.assertEqual(tips.height(a), 3)
+
+        # polls back off while nothing changes
+        tips.tick("tip")
+        self.assertEqual(tips.interval, tips.min_interval)
+        for _ in range(10):
+            tips.tick("tip")
+        self.assertEqual(tips.interval, tips.max_interval)
+        tips.update(a, 3, now=2)
+        tips.tick("tip")
+        self.assertEqual(tips.interval, tips.max_interval)
+        tips.update(b, 0, now=2)
+        tips.tick("tip")
+        self.assertEqual(tips.interval, tips.min_interval)
+
+    def test_snapshot(self):
+        def coinbase(height: int) -> str:
+            return encode_transactions([Transaction.coinbase(height, "aa", 128)])
+
+        bc = BlockChain()
+        for i in range(1, 4):
+            self.assertTrue(bc.mine(coinbase(i)))
+        snapshot = Snapshot.from_blockchain(bc)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot")
+            hash = snapshot.save(path)
+            self.assertEqual(hash, snapshot.hash)
+            loaded = Snapshot.load(path, hash)
+            self.assertEqual(loaded.headers, snapshot.headers)
+            self.assertEqual(loaded.outputs, bc.utxos.outputs)
+            with self.assertRaises(ValueError):
+                Snapshot.load(path, "00" * 32)
+
+            with open(path, "r+b") as f:
+                f.seek(20)
+                byte = f.read(1)
+                f.seek(20)
+                f.write(bytes([byte[0] ^ 1]))
+            with self.assertRaises(ValueError):
+                Snapshot.load(path)
+
+            gap = Snapshot(snapshot.headers[:1] + snapshot.headers[2:], {})
+            gap.save(path)
+            with self.assertRaises(ValueError):
+                Snapshot.load(path)
+
+        # a chain started from the snapshot validates new blocks right away
+        started = loaded.to_blockchain()
+        self.assertTrue(started.mine(coinbase(4)))
+        self.assertFalse(started.has_bodies(0, 1))
+        self.assertTrue(started.has_bodies(4, 4))
+
+        # older blocks are checked against their headers, then replayed
+        backfill = Backfill(started, loaded)
+        self.assertEqual(backfill.plan(), [(0, 3)])
+        forged = Block(**{**bc[1].serialize(), "data": coinbase(5)})
+        self.assertFalse(backfill.receive(0, [bc[0], forged]))
+        self.assertEqual(started.backfilled, 1)
+        self.assertTrue(backfill.receive(1, bc[1:4]))
+        self.assertTrue(backfill.synced)
+        self.assertTrue(backfill.verified)
+        self.assertEqual(started[:4], bc[:4])
+        self.assertTrue(started.has_bodies(0, 4))
+
+        # bodies whose transactions do not replay are not put in place
+        bad = BlockChain.proof_of_work(
+            4,
+            bc[3].hash,
+            encode_transactions([Transaction.coinbase(4, "aa", 10**6)]),
+            bc.retarget(),
+        )
+        headers = snapshot.headers + [bad.header]
+        backfill = Backfill(
+            BlockChain.from_headers(headers, UTXOSet()), Snapshot(headers, {})
+        )
+        self.assertFalse(backfill.receive(0, bc[:4] + [bad]))
+        self.assertEqual(backfill.blockchain.backfilled, 4)
+        self.assertFalse(backfill.blockchain.has_bodies(4, 4))
+
+        # if the outputs do not match, the blocks on top are dropped
+        forged = Snapshot(
+            snapshot.headers,
+            {**snapshot.outputs, ("00" * 32, 0): TxOut(Decimal(1), "aa")},
+        )
+        started = forged.to_blockchain()
+        self.assertTrue(started.mine(coinbase(4)))
+        backfill = Backfill(started, forged)
+        self.assertTrue(backfill.receive(0, bc[:4]))
+        self.assertFalse(backfill.verified)
+        self.assertEqual(started, bc)
+        self.assertEqual(started.utxos.outputs, bc.utxos.outputs)
+        self.assertTrue(started.mine(coinbase(4)))
+
+    def test_headers(self):
+        bc = BlockChain()
+        for i in range(3):
+            bc.mine("data")
+        headers = [b.header for b in bc.blocks]
+        self.assertSerializable(BlockHeader, headers[1], globals())
+        self.assertEqual(codec.unpack_headers(codec.pack_headers(headers)), headers)
+
+        # headers alone are enough to follow the tip and check the work
+        light = HeaderChain(headers[:1])
+        sync = HeaderSync(light)
+        self.assertEqual(sync.plan(3), [(1, 3)])
+        self.assertTrue(sync.receive(1, headers[1:]))
+        self.assertEqual(light, HeaderChain(headers))
+        self.assertSerializable(HeaderChain, light, globals())
+        self.assertFalse(HeaderChain().add_header(headers[1]))
+        forged = BlockHeader(*headers[1].fields[:4], 0, *headers[1].fields[5:])
+        self.assertFalse(HeaderChain(headers[:1]).add_header(forged))
+
+        # bodies are checked against the headers
+        self.assertTrue(light.verify_body(bc[2]))
+        self.assertFalse(light.verify_body(Block(**{**bc[2].serialize(), "data": ""})))
+        stripped = {**bc[2].serialize(), "data": bc[2].merkle_root, "merkle_root": ""}
+        self.assertFalse(light.verify_body(Block(**stripped)))
+
+        # a longer chain from another genesis replaces ours
+        other = HeaderChain()
+        self.assertTrue(other.replace(headers))
+        self.assertEqual(other, light)
+        self.assertFalse(other.replace(headers[:2]))
+
+        # a fork below the headers we were sent is found by stepping back,
+        # then the peer's branch is downloaded in pages
+        class Search(HeaderForkSearch):
+            first_depth = 1
+            page_size = 2
+
+        fork = BlockChain(blocks=bc.blocks[:1])
+        for i in range(5):
+            fork.mine("fork")
+        theirs = [b.header for b in fork.blocks]
+        search = Search(light, 6)
+        self.assertEqual(search.request(), (3, 4))
+        self.assertIsNone(search.receive(theirs[3:5]))
+        self.assertEqual(search.start, 2)
+        self.assertIsNone(search.receive(theirs[2:4]))
+        self.assertEqual(search.start, 0)
+        self.assertIsNone(search.receive(theirs[0:2]))
+        self.assertIsNone(search.receive(theirs[2:4]))
+        self.assertIsNone(search.receive(theirs[4:6]))
+        self.assertTrue(search.receive([]))
+        self.assertEqual(light, HeaderChain(theirs))
+
+        # full nodes take the peer's blocks into the side index as they come
+        class BlockSearch(ForkSearch):
+            page_size = 2
+
+        ours = BlockChain(blocks=bc.blocks)
+        search = BlockSearch(ours, 4)
+        self.assertEqual(search.request(), (3, 4))
+        for start in (3, 2, 0, 2, 4):
+            self.assertEqual(search.start, start)
+            self.assertIsNone(search.receive(fork.blocks[start : start + 2]))
+        self.assertTrue(search.receive([]))
+        self.assertEqual(ours.latest_block, fork.latest_block)
+
+        # a chain from another genesis is collected whole
+        stranger = BlockChain()
+        search = BlockSearch(stranger, 1)
+        for start in (0, 2, 4):
+            self.assertIsNone(search.receive(fork.blocks[start : start + 2]))
+        self.assertTrue(search.receive([]))
+        self.assertEqual(stranger.blocks, fork.blocks)
+
+    def test_miner(self):
+        miner = Miner(workers=2)
+        args = (0, "0", int(time.time()), "test")
+        target = "0fff" + "f" * 60
+        nonce, hash = miner.search(*args, target=target)
+        b = Block(*args, nonce=nonce, target=target, hash=hash)
+        self.assertTrue(b.is_valid())
+
+        bc = BlockChain()
+        self.assertTrue(bc.mine("data", miner))
+        self.assertTrue(bc.is_valid_chain())
+
+        # nothing can meet this target, only cancelling ends the search
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(miner.search, *args, "0" * 64)
+            time.sleep(0.5)
+            miner.cancel()
+            self.assertIsNone(future.result(timeout=10))
+
+        # a cancel between taking a template and searching is not lost
+        miner.prepare()
+        miner.cancel()
+        self.assertIsNone(miner.search(*args, target=target))
+        self.assertIsNotNone(miner.search(*args, target=target))
+        miner.shutdown()
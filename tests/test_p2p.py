@@ -0,0 +1,349 @@
+import asyncio
+import threading
+import time
+import unittest
+from decimal import Decimal
+
+import umsgpack
+from kademlia.node import Node
+
+from chain import Block, BlockChain, codec
+from chain.connection import ConnectionPool
+from chain.gossip import Inventory, RateLimiter, SeenSet, Trickle
+from chain.mempool import Mempool
+from chain.p2p import Message, P2PServer, TCPClientProtocol, pack_message
+from chain.peers import PeerManager
+from chain.pipeline import ValidationPipeline
+from chain.transaction import (
+    TX_REGULAR,
+    Transaction,
+    TxIn,
+    TxOut,
+    encode_transactions,
+    signed_messages,
+)
+from chain.utils.elliptic import generate_keypair, get_signature_cache
+from chain.utils.framing import FrameDecoder
+
+
+class EchoProtocol(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.transport.write(data)
+
+
+class ClientProtocol(asyncio.Protocol):
+    def __init__(self) -> None:
+        self.received = asyncio.Queue()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.received.put_nowait(data)
+
+
+class PausedTransport(asyncio.BaseTransport):
+    def __init__(self) -> None:
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return False
+
+
+class RecordingTransport(PausedTransport):
+    """
+    Keeps the messages a protocol replies with
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.decoder = FrameDecoder()
+        self.sent = []
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 9999) if name == "peername" else default
+
+    def write(self, data: bytes):
+        self.sent += [umsgpack.loads(frame) for frame in self.decoder.feed(data)]
+
+    def types(self):
+        return [Message(message["type"]) for message in self.sent]
+
+    def close(self):
+        pass
+
+
+async def until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+class TestP2P(unittest.IsolatedAsyncioTestCase):
+    async def test_connection_pool(self):
+        loop = asyncio.get_event_loop()
+        server = await loop.create_server(EchoProtocol, "127.0.0.1", 0)
+        address = server.sockets[0].getsockname()[:2]
+
+        pool = ConnectionPool(ClientProtocol)
+        self.assertEqual(await pool.send_all([address, address], b"ping"), [True] * 2)
+        self.assertEqual(len(pool), 1)  # concurrent senders share one connection
+
+        protocol = await pool.get(address)
+        received = b""
+        while len(received) < 8:
+            received += await protocol.received.get()
+        self.assertEqual(received, b"pingping")
+        self.assertTrue(await pool.send(address, b"pong"))
+        self.assertIs(await pool.get(address), protocol)
+
+        # dropped connections are replaced
+        protocol.transport.close()
+        self.assertIsNot(await pool.get(address), protocol)
+
+        # unreachable peers back off
+        server.close()
+        await server.wait_closed()
+        pool.close()
+        self.assertFalse(await pool.send(address, b"ping"))
+        self.assertTrue(pool.in_backoff(address))
+        self.assertFalse(await pool.send(address, b"ping"))
+        self.assertEqual(pool.failures[address], 1)
+
+    def test_inventory(self):
+        seen = SeenSet(2)
+        for i in range(3):
+            seen.add(i)
+        self.assertNotIn(0, seen)
+        self.assertEqual(len(seen), 2)
+
+        inventory = Inventory()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        # announced once per peer
+        self.assertEqual(inventory.announce_to("h1", [a, b]), [a, b])
+        self.assertEqual(inventory.announce_to("h1", [a, b]), [])
+
+        # fetched once, from the first peer announcing it
+        self.assertEqual(inventory.wants(["h2"], a), ["h2"])
+        self.assertEqual(inventory.wants(["h2"], b), [])
+        self.assertEqual(inventory.announce_to("h2", [a, b]), [])
+        inventory.add("h3")
+        self.assertEqual(inventory.wants(["h3"], a), [])
+
+        # unanswered requests expire, and at most `max_requested` are kept
+        inventory.requested["h2"] -= inventory.request_timeout
+        self.assertEqual(inventory.wants(["h2"], b), ["h2"])
+        inventory.max_requested = 2
+        self.assertEqual(inventory.wants(["h4", "h5"], a), ["h4", "h5"])
+        self.assertEqual(list(inventory.requested), ["h4", "h5"])
+
+    def test_relay(self):
+        trickle = Trickle()
+        trickle.max_batch = 2
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        for h in ["h1", "h2", "h3"]:
+            trickle.push(h, [a])
+        trickle.push("h1", [b])
+        self.assertEqual(trickle.pop_batches(), {a: ["h1", "h2"], b: ["h1"]})
+        self.assertEqual(trickle.pop_batches(), {a: ["h3"]})
+        self.assertEqual(trickle.pop_batches(), {})
+
+        limiter = RateLimiter(rate=10, burst=20)
+        self.assertTrue(limiter.allow("peer", 20, now=0))
+        self.assertFalse(limiter.allow("peer", 1, now=0))
+        self.assertTrue(limiter.allow("other", 1, now=0))
+        self.assertTrue(limiter.allow("peer", 10, now=1))
+        self.assertFalse(limiter.allow("peer", 1, now=1))
+
+    async def test_peers(self):
+        peers = PeerManager()
+        fast, slow, down, new = [("10.0.0.%d" % i, 1) for i in range(4)]
+        peers.record_latency(fast, 0.01)
+        peers.record_latency(slow, 0.01)
+        peers.start_request(fast, 1, now=0)
+        peers.end_request(fast, 1, 100_000, now=0.1)
+        peers.start_request(slow, 1, now=0)
+        peers.end_request(slow, 1, 100_000, now=4)
+        peers.record_failure(down)
+        # new peers are assumed typical, between the fast and the slow one
+        self.assertEqual(peers.rank([down, slow, fast, new]), [fast, new, slow, down])
+        peers.max_active = 2
+        self.assertEqual(peers.active([down, slow, fast, new]), [fast, new])
+
+        # failing peers are not forgotten to make room
+        peers.max_peers = 3
+        peers.get(new)
+        self.assertIn(down, peers.stats)
+        self.assertNotIn(fast, peers.stats)
+        peers.max_peers = PeerManager.max_peers
+
+        # misbehaving peers are banned by ip, and not connected to
+        self.assertFalse(peers.misbehaved("10.0.0.1", 50))
+        self.assertTrue(peers.misbehaved("10.0.0.1", 50))
+        self.assertTrue(peers.is_banned("10.0.0.1"))
+        self.assertEqual(peers.rank([slow, fast]), [fast])
+        pool = ConnectionPool(ClientProtocol, peers)
+        self.assertIsNone(await pool.get(slow))
+        self.assertFalse(peers.is_banned("10.0.0.1", now=time.time() + peers.ban_time))
+
+    async def test_pipeline(self):
+        mined = BlockChain()
+        for i in range(3):
+            mined.mine(f"block {i}")
+        forged = Block.deserialize({**mined.blocks[3].serialize(), "data": "forged"})
+
+        blockchain = BlockChain(blocks=mined.blocks[:1])
+        pipeline = ValidationPipeline(blockchain)
+        pipeline.high_water, pipeline.low_water = 2, 0
+        pipeline.max_waiting = 4
+        pipeline.start()
+        transport = PausedTransport()
+        results = []
+
+        def done(result):
+            results.append(result)
+
+        payloads = [(codec.pack_block(b), False) for b in mined.blocks[1:3]]
+        payloads.append((codec.pack_block(forged), False))
+        payloads.append((codec.pack_blocks(mined.blocks[3:]), True))
+        for payload, many in payloads:
+            pipeline.submit(
+                payload, many, lambda bs: blockchain.add_block(bs[0]), done, transport
+            )
+        self.assertFalse(transport.reading)
+        # past `max_waiting` messages are dropped
+        pipeline.submit(payloads[0][0], False, lambda bs: done(None))
+        self.assertEqual(pipeline.queue.qsize(), 4)
+
+        # the forged block is dropped, the rest connect in order
+        while len(results) < 3:
+            await asyncio.sleep(0.01)
+        self.assertEqual(results, [True] * 3)
+        self.assertEqual(blockchain.latest_block, mined.latest_block)
+        self.assertTrue(transport.reading)
+
+        # the loop does not wait on the chain while a block is validated
+        validating, release = threading.Event(), threading.Event()
+        validate_block = blockchain.utxos.validate_block
+
+        def slow_validate(*args):
+            validating.set()
+            release.wait(5)
+            return validate_block(*args)
+
+        blockchain.utxos.validate_block = slow_validate
+        mined.mine("block 3")
+        added = pipeline.run(blockchain.add_block, mined.latest_block)
+        while not validating.is_set():
+            await asyncio.sleep(0.01)
+        self.assertTrue(blockchain.lock.acquire(timeout=0))
+        blockchain.lock.release()
+        self.assertEqual(blockchain.latest_block, mined.blocks[3])
+        release.set()
+        self.assertTrue(await added)
+        self.assertEqual(blockchain.latest_block, mined.latest_block)
+        pipeline.stop()
+
+    async def test_handlers(self):
+        server = P2PServer(mining=False)
+        # a routing table without peers, nothing is sent but replies
+        server.protocol = server._create_protocol()
+        server.pipeline.start()
+        transport = RecordingTransport()
+        protocol = TCPClientProtocol(server)
+        protocol.connection_made(transport)
+        ours = server.blockchain
+        theirs = BlockChain(blocks=list(ours.blocks))
+        theirs.mine("block 1")
+
+        def receive(message: dict) -> None:
+            transport.sent.clear()
+            protocol.receive_frames(pack_message(message))
+
+        # only blocks we do not know are asked for
+        receive(Message.send_inventory(9999, [ours.latest_block.hash], height=0))
+        self.assertEqual(transport.sent, [])
+        receive(Message.send_inventory(9999, [theirs.latest_block.hash], height=1))
+        self.assertEqual(transport.types(), [Message.GET_DATA])
+        self.assertEqual(transport.sent[0]["blocks"], [bytes.fromhex(theirs[1].hash)])
+        receive(Message.send_latest_block(theirs.latest_block))
+        self.assertTrue(await until(lambda: ours.latest_block == theirs[1]))
+        receive(Message.send_inventory(9999, [theirs.latest_block.hash], height=1))
+        self.assertEqual(transport.sent, [])
+
+        # and served by hash
+        receive(Message.get_data([theirs[1].hash, "00" * 32]))
+        self.assertEqual(transport.types(), [Message.RECEIVE_LATEST_BLOCK])
+
+        # a range on another fork leads to a fork point search, which takes the
+        # peer's branch without asking for its whole chain
+        fork = BlockChain(blocks=list(ours.blocks[:1]))
+        fork.mine("fork 1")
+        fork.mine("fork 2")
+        receive(Message.send_blocks(2, 2, fork[2:]))
+        self.assertTrue(await until(lambda: transport.sent))
+        self.assertEqual(transport.types(), [Message.REQUEST_BLOCKS])
+        self.assertEqual(transport.sent[0]["start_index"], 1)
+        receive(Message.send_blocks(1, 2, fork[1:]))
+        self.assertTrue(await until(lambda: ours.latest_block == fork.latest_block))
+        self.assertNotIn(Message.REQUEST_BLOCKCHAIN, transport.types())
+        self.assertIsNone(protocol.fork)
+        self.assertIn(theirs[1].hash, ours.side)
+
+        server.pipeline.stop()
+        server._close_chain()
+
+    async def test_transactions(self):
+        key, address = generate_keypair()
+        server = P2PServer(mining=False)
+        server.protocol = server._create_protocol()
+        peer = ("127.0.0.1", 9999)
+        server.protocol.router.add_contact(Node(b"peer" * 5, *peer))
+        server.mempool = server.template.mempool = Mempool()
+        coinbase = Transaction.coinbase(1, address, Decimal(Transaction._reward))
+        server.blockchain.mine(encode_transactions([coinbase]))
+        protocol = TCPClientProtocol(server)
+        protocol.connection_made(RecordingTransport())
+
+        def spend(prev, amount, tx_hash=None, signer=key):
+            txin = TxIn(0, tx_hash or prev.hash, prev.outputs[0].amount, address)
+            txin.sign(signer)
+            return Transaction(TX_REGULAR, [txin], [TxOut(Decimal(amount), address)])
+
+        first = spend(coinbase, 100)
+        # spends an output of the same batch
+        second = spend(first, 90)
+        double_spent = spend(coinbase, 120)
+        unknown = spend(coinbase, 100, tx_hash="ab" * 32)
+        forged = spend(second, 80, signer=generate_keypair()[0])
+        batch = [first, second, double_spent, unknown, forged]
+        protocol.receive_frames(pack_message(Message.send_transactions(batch)))
+        self.assertTrue(await until(lambda: len(server.mempool) == 2))
+        await asyncio.sleep(0.1)
+        self.assertEqual(server.mempool.transactions, {first, second})
+
+        # only valid ones are announced, and inputs that spend nothing never
+        # reach the signature check
+        self.assertEqual(
+            server.trickle.pop_batches(), {peer: [first.hash, second.hash]}
+        )
+        cache = get_signature_cache()
+        checked = [signed_messages(tx.inputs)[0] in cache for tx in batch]
+        self.assertEqual(checked[:2] + checked[3:], [True, True, False, False])
+        self.assertNotIn(forged.hash, server.inventory)
+
+        # known transactions are not checked or announced again
+        protocol.receive_frames(pack_message(Message.send_transactions([first])))
+        await asyncio.sleep(0.1)
+        self.assertEqual(server.trickle.pop_batches(), {})
+        server._close_chain()
@@ -1,9 +1,20 @@
 from decimal import Decimal
 import binascii
 
-from chain.transaction import TxIn, TxOut, Transaction, TX_REGULAR
+from chain import Block, BlockChain, codec
+from chain.transaction import (
+    TxIn,
+    TxOut,
+    Transaction,
+    TX_REGULAR,
+    TX_COINBASE,
+    encode_transactions,
+    verify_inputs,
+)
+from chain.utxo import UTXOSet
 from chain.mempool import get_mempool, Mempool
-from chain.utils.elliptic import generate_keypair
+from chain.template import BlockTemplate
+from chain.utils.elliptic import generate_keypair, get_signature_cache
 
 from . import TestCase
 
@@ -50,6 +61,18 @@ class TestTx(TestCase):
 
         tx = Transaction(TX_REGULAR, inputs, outputs)
         self.assertSerializable(Transaction, tx, globals())
+        unpacked = codec.unpack_transaction(codec.pack_transaction(tx))
+        self.assertEqual(repr(unpacked), repr(tx))
+        self.assertEqual(unpacked, tx)
+        self.assertEqual(codec.unpack_transactions(codec.pack_transactions([tx])), [tx])
+        # amounts whose exponent does not fit a signed byte are refused
+        with self.assertRaises(ValueError):
+            codec.pack_transaction(
+                Transaction(TX_REGULAR, [], [TxOut(Decimal("1e200"), "aaa")])
+            )
+        # and so are negative integers
+        with self.assertRaises(ValueError):
+            codec.pack_transaction(Transaction(TX_REGULAR, [TxIn(-1, "aaa", 1, pub)]))
 
         self.assertTrue(tx.has_enough_balance)
         self.assertEqual(tx.fee, Decimal(1))
@@ -73,3 +96,174 @@ class TestTx(TestCase):
         self.assertTrue(mempool.is_double_spent(tx))
         self.assertTrue(mempool.is_double_spent(tx1))
         self.assertFalse(mempool.is_double_spent(tx2))
+        self.assertEqual(mempool.conflicts(tx1), {tx})
+
+        # a block confirming a conflicting spend evicts the pooled one
+        tx3 = Transaction(TX_REGULAR, [inputs[0]], [TxOut(Decimal(50), "ccc")])
+        self.assertFalse(mempool.add(tx2))  # unsigned
+        tx2.inputs[0].sign(priv)
+        self.assertTrue(mempool.add(tx2))
+        mempool.trim_txs([tx3])
+        self.assertEqual(mempool.transactions, {tx2})
+        mempool.remove(tx2)
+        self.assertEqual(mempool.spends, {})
+
+    def test_mempool(self):
+        priv, pub = generate_keypair()
+
+        def pay(fee, tx_hash):
+            txin = TxIn(0, tx_hash, Decimal(100 + fee), pub)
+            txin.sign(priv)
+            return Transaction(TX_REGULAR, [txin], [TxOut(Decimal(100), "aaa")])
+
+        txs = [pay(fee, f"{fee:x}") for fee in (3, 1, 4, 2)]
+        mempool = Mempool(max_size=sum(tx.size for tx in txs[:3]), expiry=10)
+        for i, tx in enumerate(txs[:3]):
+            self.assertTrue(mempool.add(tx, now=i))
+        self.assertEqual(mempool.top(), [txs[2], txs[0], txs[1]])
+        self.assertEqual(mempool.top(1), [txs[2]])
+        self.assertIs(mempool.lowest(), txs[1])
+
+        # full, so the lowest fee rate makes room
+        self.assertTrue(mempool.add(txs[3], now=3))
+        self.assertNotIn(txs[1], mempool)
+        self.assertEqual(mempool.top(3), [txs[2], txs[0], txs[3]])
+        self.assertFalse(mempool.add(pay(0, "0"), now=3))
+        self.assertLessEqual(mempool.size, mempool.max_size)
+
+        mempool.expire(now=12.5)
+        self.assertEqual(mempool.transactions, {txs[3]})
+        self.assertFalse(mempool.add(Transaction(TX_COINBASE, [], [])))
+
+        # pooled once, even without inputs to conflict on
+        empty = Transaction(TX_REGULAR, [], [])
+        self.assertTrue(mempool.add(empty, now=12.5))
+        self.assertFalse(mempool.add(empty, now=12.5))
+        self.assertEqual(mempool.size, txs[3].size + empty.size)
+        self.assertEqual(mempool.top(5), [txs[3], empty])
+
+    def test_signature_cache(self):
+        priv, pub = generate_keypair()
+        txin = TxIn(0, "aaa", Decimal(100), pub)
+        txin.sign(priv)
+        tx = Transaction(TX_REGULAR, [txin], [])
+
+        cache = get_signature_cache()
+        cache.clear()
+        self.assertTrue(tx.valid)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 1, 1))
+        # verified again for free, e.g. when the block arrives
+        self.assertTrue(verify_inputs([txin]))
+        self.assertTrue(txin.valid)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # tampered inputs are different cache entries
+        forged = TxIn(0, "aaa", Decimal(200), pub, txin.signature)
+        self.assertFalse(forged.valid)
+        self.assertEqual(len(cache), 1)
+
+    def test_utxo(self):
+        priv, pub = generate_keypair()
+        coinbase = Transaction(TX_COINBASE, [], [TxOut(Decimal(128), pub)])
+        utxos = UTXOSet()
+        self.assertTrue(utxos.connect("block1", [coinbase]))
+        self.assertEqual(utxos.get_many([(coinbase.hash, 0)]), [coinbase.outputs[0]])
+
+        def spend(amount, outputs):
+            txin = TxIn(0, coinbase.hash, Decimal(amount), pub)
+            txin.sign(priv)
+            return Transaction(TX_REGULAR, [txin], outputs)
+
+        tx = spend(128, [TxOut(Decimal(100), "aaa")])
+        self.assertTrue(utxos.validate_transaction(tx))
+        # claiming more than the output holds
+        self.assertFalse(utxos.validate_transaction(spend(200, [])))
+        # spending the same output twice in one block
+        self.assertFalse(utxos.connect("block2", [tx, spend(128, [])]))
+        # coinbase can claim the reward plus fees only
+        reward = Transaction(TX_COINBASE, [], [TxOut(Decimal(157), pub)])
+        self.assertFalse(utxos.connect("block2", [reward, tx]))
+
+        reward = Transaction(TX_COINBASE, [], [TxOut(Decimal(156), pub)])
+        self.assertTrue(utxos.connect("block2", [reward, tx]))
+        self.assertNotIn((coinbase.hash, 0), utxos)
+        self.assertIn((tx.hash, 0), utxos)
+        self.assertFalse(utxos.validate_transaction(tx))
+
+        utxos.disconnect("block2", [reward, tx])
+        self.assertIn((coinbase.hash, 0), utxos)
+        self.assertEqual(len(utxos), 1)
+
+        # blocks carry transactions in their data
+        bc = BlockChain()
+        self.assertTrue(bc.mine(encode_transactions([coinbase])))
+        self.assertEqual(bc.latest_block.transactions, [coinbase])
+        self.assertFalse(bc.mine(encode_transactions([spend(200, [])])))
+        self.assertTrue(bc.mine(encode_transactions([tx])))
+        self.assertIn((tx.hash, 0), bc.utxos)
+
+        # the header commits to the transactions through the merkle root
+        block = bc.latest_block
+        proof = block.prove(tx.hash)
+        self.assertTrue(Block.verify_inclusion(tx.hash, proof, block.merkle_root))
+        self.assertFalse(
+            Block.verify_inclusion(coinbase.hash, proof, block.merkle_root)
+        )
+        self.assertIsNone(block.prove(coinbase.hash))
+        self.assertEqual(codec.unpack_block(codec.pack_block(block)), block)
+
+    def test_template(self):
+        priv, pub = generate_keypair()
+        bc = BlockChain()
+        mempool = Mempool()
+        template = BlockTemplate(bc, mempool, pub)
+        self.assertTrue(bc.mine(template.data()))
+        # coinbases differ by height, so their outputs do not collide
+        template.update()
+        self.assertNotEqual(template.coinbase().hash, bc[1].transactions[0].hash)
+        coinbase = bc[1].transactions[0]
+
+        def spend(tx, amount, fee):
+            txin = TxIn(0, tx.hash, tx.outputs[0].amount, pub)
+            txin.sign(priv)
+            return Transaction(TX_REGULAR, [txin], [TxOut(Decimal(amount - fee), pub)])
+
+        parent = spend(coinbase, 128, 1)
+        child = spend(parent, 127, 10)
+        unknown = spend(Transaction(TX_COINBASE, [], [TxOut(Decimal(5), pub)]), 5, 5)
+        # checked against the chain, inputs spend its outputs or pooled ones
+        pool = Mempool()
+        self.assertFalse(pool.add(unknown, utxos=bc.utxos))
+        self.assertFalse(pool.add(child, utxos=bc.utxos))
+        self.assertTrue(pool.add(parent, utxos=bc.utxos))
+        self.assertTrue(pool.add(child, utxos=bc.utxos))
+
+        for tx in (child, unknown, parent):
+            self.assertTrue(mempool.add(tx))
+
+        # the child pays more but waits for its parent, unknown inputs are left out
+        template.clear()
+        template.fill()
+        self.assertEqual(template.transactions, [parent, child])
+        self.assertEqual(template.coinbase().total_output, 128 + 11)
+
+        self.assertTrue(bc.mine(template.data()))
+        template.update()
+        self.assertEqual(mempool.transactions, {unknown})
+        self.assertEqual(len(template), 0)
+
+        # transactions arriving later are appended if they fit
+        template.max_size = child.size
+        grandchild = spend(child, 117, 1)
+        self.assertTrue(mempool.add(grandchild))
+        self.assertTrue(template.add(grandchild))
+        self.assertFalse(template.add(spend(grandchild, 116, 1)))
+
+        # transactions of blocks unwound by a reorg are pending again
+        other = BlockChain(bc.blocks[:2])
+        other.mine("other")
+        other.mine("other")
+        self.assertTrue(bc.replace(other))
+        template.update()
+        self.assertEqual(mempool.transactions, {unknown, parent, child, grandchild})
+        self.assertEqual(template.transactions, [parent])
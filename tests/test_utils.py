@@ -1,4 +1,7 @@
-from chain.utils.elliptic import generate_keypair, sign, verify
+from concurrent.futures import ProcessPoolExecutor
+
+from chain.utils.elliptic import generate_keypair, sign, verify, verify_batch
+from chain.utils.framing import FrameDecoder, FrameTooLarge, encode_frame
 from chain.utils.log import logger
 
 from . import TestCase
@@ -10,6 +13,42 @@ class TestUtils(TestCase):
         msg = "0" * 1024 * 1024 * 100  # assuming 100 MB block data
         self.assertTrue(verify(pub, sign(prv, msg), msg))
 
+    def test_verify_batch(self):
+        prv, pub = generate_keypair()
+        items = [(pub, sign(prv, str(i)), str(i)) for i in range(20)]
+        forged = items[:10] + [(pub, items[0][1], "forged")] + items[10:]
+        self.assertTrue(verify_batch(items))
+        self.assertFalse(verify_batch(forged))
+        self.assertFalse(verify_batch([(pub, "0x00", "bad signature")]))
+        with ProcessPoolExecutor(2) as executor:
+            self.assertTrue(verify_batch(items, executor, chunk_size=3))
+            self.assertFalse(verify_batch(forged, executor, chunk_size=3))
+
+    def test_framing(self):
+        messages = [b"", b"a" * 1000, b"b" * 70000]
+        stream = b"".join(encode_frame(m) for m in messages)
+
+        # any chunking of the stream yields the same messages
+        for chunk_size in (1, 3, 1460, len(stream)):
+            decoder = FrameDecoder()
+            frames = []
+            for i in range(0, len(stream), chunk_size):
+                frames.extend(decoder.feed(stream[i : i + chunk_size]))
+            self.assertEqual(frames, messages)
+            self.assertEqual(decoder.buffer, b"")
+
+        decoder = FrameDecoder(max_size=1024)
+        with self.assertRaises(FrameTooLarge):
+            decoder.feed(encode_frame(b"c" * 1025)[:4])
+
+        # complete frames before an oversized one are not lost
+        decoder = FrameDecoder(max_size=1024)
+        decoder.feed(stream[:3])
+        with self.assertRaises(FrameTooLarge) as raised:
+            decoder.feed(stream[3:1008] + encode_frame(b"c" * 1025))
+        self.assertEqual(raised.exception.frames, messages[:2])
+        self.assertEqual(decoder.buffer, b"")
+
     def test_log(self):
         print()
 